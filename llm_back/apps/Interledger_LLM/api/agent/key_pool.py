@@ -0,0 +1,302 @@
+"""
+Pool de API keys de OpenAI con reparto según los límites de cada key.
+
+Cada key (opcionalmente con su organización) tiene su propio cliente y su
+propio pool de conexiones. Un hook de respuesta de httpx lee los headers
+``x-ratelimit-*`` que OpenAI devuelve en cada llamada (peticiones y tokens
+restantes, y cuándo se reinician), y ``acquire`` entrega la key con más
+margen en ese momento. Un 429 deja la key en enfriamiento hasta que vence su
+``retry-after`` (o el reinicio del límite), así que las llamadas siguientes
+van a las demás keys en vez de encadenar 429; si todas están agotadas,
+``acquire`` espera a la primera que se reinicia.
+
+Configuración:
+    OPENAI_API_KEYS="sk-a,sk-b:org-xyz"   # key[:organización], separadas por comas
+    OPENAI_API_KEY="sk-a"                 # una sola key (si no hay OPENAI_API_KEYS)
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+from openai import DefaultHttpxClient, OpenAI
+
+from .. import metrics
+from ..deadline import current_deadline
+
+# Conexiones por key (cada key tiene su propio pool)
+OPENAI_KEY_MAX_CONNECTIONS = int(os.getenv("OPENAI_KEY_MAX_CONNECTIONS", "20"))
+# Segundos que una conexión ociosa del pool sigue abierta
+OPENAI_KEEPALIVE_SECONDS = float(os.getenv("OPENAI_KEEPALIVE_SECONDS", "60"))
+# Enfriamiento tras un 429 sin retry-after ni headers de reinicio
+OPENAI_KEY_COOLDOWN_SECONDS = float(os.getenv("OPENAI_KEY_COOLDOWN_SECONDS", "10"))
+# Espera máxima por una key con margen cuando todas están agotadas
+OPENAI_KEY_MAX_WAIT = float(os.getenv("OPENAI_KEY_MAX_WAIT", "2"))
+
+# Duración supuesta de una ventana nueva antes de recibir sus headers
+PROVISIONAL_WINDOW_SECONDS = 1.0
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """Segundos de un header de reinicio de OpenAI ("20ms", "1s", "6m0s")."""
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def parse_keys(raw: str) -> List[Tuple[str, Optional[str]]]:
+    """Entradas ``key[:organización]`` separadas por comas."""
+    keys = []
+    for entry in raw.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        api_key, _, organization = entry.partition(":")
+        keys.append((api_key.strip(), organization.strip() or None))
+    return keys
+
+
+@dataclass
+class _Limit:
+    """Un límite (peticiones o tokens) según los últimos headers recibidos."""
+
+    limit: Optional[int] = None
+    remaining: Optional[int] = None
+    resets_at: float = 0.0
+
+    def update(self, limit: Optional[str], remaining: Optional[str], reset: Optional[str], now: float) -> None:
+        if limit is not None and limit.isdigit():
+            self.limit = int(limit)
+        if remaining is not None and remaining.isdigit():
+            self.remaining = int(remaining)
+            self.resets_at = now + (parse_reset(reset) or 0.0)
+
+    def reserve(self, now: float) -> None:
+        if self.limit and now >= self.resets_at:
+            # Ventana nueva: se supone completa hasta que llegue la respuesta
+            self.remaining = self.limit
+            self.resets_at = now + PROVISIONAL_WINDOW_SECONDS
+        if self.remaining:
+            self.remaining -= 1
+
+    def exhausted_until(self, now: float) -> float:
+        """Momento en que se reinicia si está agotado (0 si no lo está)."""
+        if self.remaining == 0 and now < self.resets_at:
+            return self.resets_at
+        return 0.0
+
+    def headroom(self, now: float) -> float:
+        """Fracción disponible (1.0 si no se conoce o ya se reinició)."""
+        if not self.limit or self.remaining is None or now >= self.resets_at:
+            return 1.0
+        return max(0.0, self.remaining / self.limit)
+
+
+class PooledKey:
+    """Una key del pool: su cliente, sus límites y su enfriamiento."""
+
+    def __init__(
+        self,
+        name: str,
+        api_key: str,
+        organization: Optional[str] = None,
+        transport: Optional[httpx.BaseTransport] = None,
+    ):
+        self.name = name
+        self.organization = organization
+        self.requests = _Limit()
+        self.tokens = _Limit()
+        self.cooldown_until = 0.0
+        self.last_used = 0.0
+        self._lock = threading.Lock()
+        http_client = DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_KEY_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_KEY_MAX_CONNECTIONS,
+                keepalive_expiry=OPENAI_KEEPALIVE_SECONDS,
+            ),
+            event_hooks={"response": [self._on_response]},
+            transport=transport,
+        )
+        self.client = OpenAI(api_key=api_key, organization=organization, http_client=http_client)
+
+    def headroom(self, now: float) -> float:
+        """Margen de la key (0 a 1); 0 mientras está en enfriamiento."""
+        with self._lock:
+            if now < self.cooldown_until:
+                return 0.0
+            return min(self.requests.headroom(now), self.tokens.headroom(now))
+
+    def available_at(self, now: float) -> float:
+        """Cuándo vuelve a tener margen: fin del enfriamiento o reinicio del límite."""
+        with self._lock:
+            return max(
+                self.cooldown_until,
+                self.requests.exhausted_until(now),
+                self.tokens.exhausted_until(now),
+            )
+
+    def reserve(self, now: float) -> None:
+        """Descuenta la petición por adelantado; la respuesta trae el valor real."""
+        with self._lock:
+            self.last_used = now
+            self.requests.reserve(now)
+        metrics.inc(f"openai.key.{self.name}.requests")
+
+    def stats(self, now: float) -> Dict[str, Any]:
+        headroom = self.headroom(now)
+        with self._lock:
+            return {
+                "organization": self.organization,
+                "utilization": round(1.0 - headroom, 3),
+                "remaining_requests": self.requests.remaining if now < self.requests.resets_at else self.requests.limit,
+                "remaining_tokens": self.tokens.remaining if now < self.tokens.resets_at else self.tokens.limit,
+                "cooldown": round(max(0.0, self.cooldown_until - now), 1),
+            }
+
+    def _on_response(self, response: httpx.Response) -> None:
+        headers = response.headers
+        now = time.monotonic()
+        with self._lock:
+            self.requests.update(
+                headers.get("x-ratelimit-limit-requests"),
+                headers.get("x-ratelimit-remaining-requests"),
+                headers.get("x-ratelimit-reset-requests"),
+                now,
+            )
+            self.tokens.update(
+                headers.get("x-ratelimit-limit-tokens"),
+                headers.get("x-ratelimit-remaining-tokens"),
+                headers.get("x-ratelimit-reset-tokens"),
+                now,
+            )
+            if response.status_code == 429:
+                wait = parse_reset(headers.get("retry-after"))
+                if wait is None:
+                    exhausted = [limit.resets_at - now for limit in (self.requests, self.tokens) if limit.remaining == 0]
+                    # Sin retry-after ni límite agotado en los headers (p. ej. cuota)
+                    wait = max(exhausted) if exhausted else OPENAI_KEY_COOLDOWN_SECONDS
+                self.cooldown_until = max(self.cooldown_until, now + wait)
+        if response.status_code == 429:
+            metrics.inc(f"openai.key.{self.name}.rate_limited")
+        metrics.set_gauge(f"openai.key.{self.name}.utilization", 1.0 - self.headroom(now))
+
+
+class KeyPool:
+    """Reparte las llamadas entre las keys según su margen de rate limit."""
+
+    def __init__(
+        self,
+        keys: Sequence[Tuple[str, Optional[str]]],
+        transport: Optional[httpx.BaseTransport] = None,
+    ):
+        if not keys:
+            raise ValueError("El pool de keys de OpenAI está vacío")
+        self.keys = [
+            PooledKey(f"key{index}", api_key, organization, transport)
+            for index, (api_key, organization) in enumerate(keys)
+        ]
+        self._lock = threading.Lock()
+
+    def acquire(self, max_wait: float = OPENAI_KEY_MAX_WAIT) -> PooledKey:
+        """
+        Key con más margen; entre iguales, la usada hace más tiempo.
+
+        Si todas están agotadas o en enfriamiento espera (hasta ``max_wait``,
+        y nunca más de lo que le queda al deadline de la petición) a la que
+        recupera margen primero, en vez de mandar una llamada que volvería
+        con 429. Si tarda más que eso la entrega de todos modos.
+        """
+        start = time.monotonic()
+        deadline = current_deadline()
+        if deadline is not None:
+            max_wait = min(max_wait, deadline.remaining())
+        waited = False
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                best = max(self.keys, key=lambda key: (key.headroom(now), -key.last_used))
+                if best.headroom(now) > 0.0:
+                    break
+                best = min(self.keys, key=lambda key: key.available_at(now))
+                ready = best.available_at(now)
+                if ready - start > max_wait:
+                    metrics.inc("openai.pool.exhausted")
+                    break
+            time.sleep(max(0.001, ready - now))
+            waited = True
+        with self._lock:
+            best.reserve(now)
+        if waited:
+            metrics.observe("openai.pool.wait", now - start)
+        return best
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {key.name: key.stats(now) for key in self.keys}
+
+    def close(self) -> None:
+        for key in self.keys:
+            key.client.close()
+
+
+_pool: Optional[KeyPool] = None
+_pool_config: Optional[str] = None
+_pool_lock = threading.Lock()
+
+
+def _configured_keys() -> str:
+    raw = os.getenv("OPENAI_API_KEYS", "").strip()
+    if raw:
+        return raw
+    api_key = os.getenv("OPENAI_API_KEY", "").strip()
+    organization = os.getenv("OPENAI_ORG_ID", "").strip()
+    return f"{api_key}:{organization}" if api_key and organization else api_key
+
+
+def get_key_pool() -> KeyPool:
+    """Pool compartido; se vuelve a crear si cambian las keys configuradas."""
+    global _pool, _pool_config
+    config = _configured_keys()
+    if not config:
+        raise ValueError(
+            "OPENAI_API_KEY no está configurada. "
+            "Por favor, configura la variable de entorno OPENAI_API_KEY "
+            "(u OPENAI_API_KEYS para varias keys)"
+        )
+    if _pool is None or _pool_config != config:
+        with _pool_lock:
+            if _pool is None or _pool_config != config:
+                previous = _pool
+                _pool = KeyPool(parse_keys(config))
+                _pool_config = config
+                if previous is not None:
+                    # Sin esto cada cambio de keys dejaba abiertos los pools de conexiones anteriores
+                    previous.close()
+    return _pool
+
+
+def key_pool_stats() -> Dict[str, Any]:
+    """Estado de cada key para /metrics (vacío si no hay keys configuradas)."""
+    return _pool.stats() if _pool is not None else {}
+
+
+def close_key_pool() -> None:
+    """Cierra las conexiones del pool al apagar el servidor, si llegó a crearse."""
+    if _pool is not None:
+        _pool.close()
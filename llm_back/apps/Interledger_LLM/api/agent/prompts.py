@@ -0,0 +1,90 @@
+"""
+Prompts de las llamadas a OpenAI, definidos en un solo lugar.
+
+El prompt de extracción se compone de las instrucciones de
+``system_prompt.md`` y de un bloque de formato generado a partir de
+``PaymentExtraction`` (schemas.py), el mismo modelo que fija el esquema
+estricto de la respuesta. Así cada regla aparece una sola vez: antes
+system_prompt.md y el prompt fijo de ``process_message_with_extraction``
+repetían la tarea, el formato JSON y las reglas de null en cada mensaje.
+"""
+
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Type, get_args, get_origin
+
+from pydantic import BaseModel
+
+from .schemas import PaymentExtraction
+
+SYSTEM_PROMPT_PATH = Path(__file__).resolve().parent / "system_prompt.md"
+
+# El formato lo impone el esquema de TicketData; aquí solo van los criterios
+VISION_PROMPT = (
+    "Analiza el ticket y extrae el monto y el destinatario del pago.\n"
+    "- \"destinatario\" debe ser el número de cuenta o link de wallet/billetera; "
+    "si hay varios números, elige el que represente la cuenta/wallet.\n"
+    "- Usa dígitos, nunca números con palabras.\n"
+    "- Si no encuentras alguno de los datos, usa null."
+)
+
+_instructions_cache: Optional[Tuple[float, str]] = None
+_prompt_cache: Dict[Optional[str], str] = {}
+
+
+def load_instructions() -> str:
+    """Contenido de system_prompt.md; se relee solo si el archivo cambió."""
+    global _instructions_cache
+    try:
+        mtime = os.stat(SYSTEM_PROMPT_PATH).st_mtime
+    except FileNotFoundError:
+        return ""
+    if _instructions_cache is None or _instructions_cache[0] != mtime:
+        _instructions_cache = (mtime, SYSTEM_PROMPT_PATH.read_text(encoding="utf-8").strip())
+        _prompt_cache.clear()
+    return _instructions_cache[1]
+
+
+def render_output_format(model: Type[BaseModel] = PaymentExtraction) -> str:
+    """Bloque de formato de salida generado a partir del modelo."""
+    lines = ["Responde con un objeto JSON con estos campos (null si el dato no aparece):"]
+    for name, field in model.model_fields.items():
+        lines.append(f'- "{name}" ({_type_label(field.annotation)}): {field.description or ""}'.rstrip())
+    return "\n".join(lines)
+
+
+def extraction_prompt(instructions: Optional[str] = None) -> str:
+    """
+    Prompt de sistema completo para la extracción.
+
+    Args:
+        instructions: Reemplaza las instrucciones de system_prompt.md; el
+            bloque de formato se agrega siempre.
+    """
+    if instructions is None:
+        instructions = load_instructions()
+    prompt = _prompt_cache.get(instructions)
+    if prompt is None:
+        prompt = "\n\n".join(part for part in (instructions, render_output_format()) if part)
+        _prompt_cache[instructions] = prompt
+    return prompt
+
+
+def prompt_sections() -> List[Tuple[str, str]]:
+    """Secciones del prompt de extracción, para contarlas por separado."""
+    return [
+        ("instrucciones (system_prompt.md)", load_instructions()),
+        ("formato (PaymentExtraction)", render_output_format()),
+    ]
+
+
+def _type_label(annotation: Any) -> str:
+    if get_origin(annotation) in (list, List):
+        item = get_args(annotation)[0]
+        item_fields = ", ".join(f'"{name}"' for name in item.model_fields)
+        return f"lista de {{{item_fields}}}"
+    # Optional[X]: se describe X; el null ya está en el encabezado
+    types = [arg for arg in get_args(annotation) if arg is not type(None)] or [annotation]
+    return {float: "número", str: "texto"}.get(types[0], getattr(types[0], "__name__", str(types[0])))
@@ -0,0 +1,252 @@
+"""
+Router de modelos para las llamadas a OpenAI.
+
+Elige el nivel (tier) de modelo según la entrada, aplica un plazo máximo por
+llamada, lanza una petición duplicada (hedge) cuando la primaria tarda más que
+el percentil observado de latencia y, si el modelo primario falla, reintenta
+con un modelo alterno. Las tasas de hedge y fallback se registran en
+``metrics`` para poder ajustar la latencia de cola.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, TypeVar
+
+from .. import metrics
+from ..breaker import CircuitOpenError, openai_breaker
+from ..deadline import DeadlineExceeded, current_deadline, stage_timeout
+from ..qos import current_policy
+from ..usage import record_usage
+
+T = TypeVar("T")
+
+# Textos más largos que esto (en caracteres) y con baja confianza del
+# extractor rápido se envían al modelo más capaz
+LONG_TEXT_CHARS = int(os.getenv("ROUTER_LONG_TEXT_CHARS", "600"))
+# Confianza del extractor rápido a partir de la cual basta el modelo barato
+FAST_PATH_CONFIDENCE = float(os.getenv("ROUTER_FAST_PATH_CONFIDENCE", "0.8"))
+# Percentil de latencia tras el cual se lanza la petición duplicada
+HEDGE_PERCENTILE = float(os.getenv("ROUTER_HEDGE_PERCENTILE", "0.95"))
+# Muestras mínimas antes de confiar en el percentil observado
+HEDGE_MIN_SAMPLES = int(os.getenv("ROUTER_HEDGE_MIN_SAMPLES", "20"))
+MAX_WORKERS = int(os.getenv("ROUTER_MAX_WORKERS", "16"))
+
+
+@dataclass(frozen=True)
+class ModelTier:
+    """Configuración de un nivel de modelo."""
+    primary: str
+    fallback: Optional[str]
+    timeout: float  # plazo máximo por intento, en segundos
+    hedge_after: float  # retraso del hedge mientras no hay suficientes muestras
+    stage: str  # etapa del deadline de la petición que consume
+
+
+DEFAULT_TIERS: Dict[str, ModelTier] = {
+    "extraction_fast": ModelTier(
+        primary=os.getenv("EXTRACTION_MODEL_FAST", "gpt-4o-mini"),
+        fallback=os.getenv("EXTRACTION_MODEL_FAST_FALLBACK", "gpt-4o"),
+        timeout=float(os.getenv("EXTRACTION_TIMEOUT", "12")),
+        hedge_after=3.0,
+        stage="extraction",
+    ),
+    "extraction_strong": ModelTier(
+        primary=os.getenv("EXTRACTION_MODEL_STRONG", "gpt-4o"),
+        fallback=os.getenv("EXTRACTION_MODEL_STRONG_FALLBACK", "gpt-4o-mini"),
+        timeout=float(os.getenv("EXTRACTION_TIMEOUT", "12")),
+        hedge_after=5.0,
+        stage="extraction",
+    ),
+    "vision": ModelTier(
+        primary=os.getenv("VISION_MODEL", "gpt-4o"),
+        fallback=os.getenv("VISION_MODEL_FALLBACK", "gpt-4o-mini"),
+        timeout=float(os.getenv("VISION_TIMEOUT", "25")),
+        hedge_after=8.0,
+        stage="vision",
+    ),
+    # Visión más barata y rápida para cuando el servicio está saturado (qos.py)
+    "vision_economy": ModelTier(
+        primary=os.getenv("VISION_MODEL_ECONOMY", "gpt-4o-mini"),
+        fallback=os.getenv("VISION_MODEL_ECONOMY_FALLBACK", "gpt-4o"),
+        timeout=float(os.getenv("VISION_TIMEOUT", "25")),
+        hedge_after=5.0,
+        stage="vision",
+    ),
+}
+
+
+class ModelRouter:
+    """Selecciona modelos y ejecuta llamadas con plazo, hedge y fallback."""
+
+    def __init__(self, tiers: Optional[Dict[str, ModelTier]] = None):
+        self.tiers = dict(tiers or DEFAULT_TIERS)
+        self._executor = ThreadPoolExecutor(
+            max_workers=MAX_WORKERS, thread_name_prefix="model-router")
+
+    def select(
+        self,
+        kind: str,
+        text: str = "",
+        media_type: Optional[str] = None,
+        confidence: float = 0.0,
+    ) -> str:
+        """
+        Elige el tier para una llamada.
+
+        Con el servicio degradado (modo de qos.py de la petición actual) se
+        usa el extractor rápido sin importar la entrada y, en modo crítico,
+        el modelo de visión económico.
+
+        Args:
+            kind: "extraction" o "vision"
+            text: Texto de entrada (mensaje o transcripción)
+            media_type: "audio", "image" o None si la entrada era texto
+            confidence: Confianza (0-1) del extractor rápido sobre el texto
+
+        Returns:
+            Nombre del tier a usar
+        """
+        policy = current_policy()
+        if kind == "vision":
+            if policy.economy_vision:
+                metrics.inc("qos.shed.vision")
+                return "vision_economy"
+            return "vision"
+        if confidence >= FAST_PATH_CONFIDENCE:
+            return "extraction_fast"
+        # Las transcripciones largas y los textos largos ambiguos son los que
+        # más se benefician del modelo más capaz
+        if len(text) > LONG_TEXT_CHARS or (media_type == "audio" and len(text) > LONG_TEXT_CHARS // 2):
+            if policy.fast_extraction:
+                metrics.inc("qos.shed.extraction")
+                return "extraction_fast"
+            return "extraction_strong"
+        return "extraction_fast"
+
+    def call(self, tier_name: str, fn: Callable[[str, float], T]) -> T:
+        """
+        Ejecuta fn(model, timeout) con hedge y fallback.
+
+        fn debe respetar el timeout recibido (por ejemplo con
+        ``client.with_options(timeout=timeout)``) para que los intentos
+        abandonados no se queden ocupando hilos. El plazo de cada intento se
+        acota además por el deadline de la petición, si hay uno activo.
+        """
+        tier = self.tiers[tier_name]
+        metrics.inc(f"router.{tier_name}.calls")
+        try:
+            return self._hedged(tier_name, tier.primary, tier, fn)
+        except (DeadlineExceeded, CircuitOpenError, TimeoutError):
+            # Sin presupuesto, con OpenAI caído o tras agotar el plazo del
+            # tier, el modelo alterno solo duplicaría la espera
+            metrics.inc(f"router.{tier_name}.errors")
+            raise
+        except Exception:
+            if not tier.fallback:
+                metrics.inc(f"router.{tier_name}.errors")
+                raise
+            metrics.inc(f"router.{tier_name}.fallbacks")
+            try:
+                return self._hedged(tier_name, tier.fallback, tier, fn)
+            except Exception:
+                metrics.inc(f"router.{tier_name}.errors")
+                raise
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Tasas de hedge, victorias del hedge y fallback por tier."""
+        result = {}
+        for name in self.tiers:
+            calls = f"router.{name}.calls"
+            result[name] = {
+                "calls": metrics.counter(calls),
+                "hedge_rate": metrics.ratio(f"router.{name}.hedged", calls),
+                "hedge_win_rate": metrics.ratio(f"router.{name}.hedge_wins", calls),
+                "fallback_rate": metrics.ratio(f"router.{name}.fallbacks", calls),
+                "error_rate": metrics.ratio(f"router.{name}.errors", calls),
+            }
+        return result
+
+    def _timed(self, stage: str, model: str, fn: Callable[[str, float], T], timeout: float) -> T:
+        start = time.monotonic()
+        with openai_breaker.guard():
+            result = fn(model, timeout)
+        elapsed = time.monotonic() - start
+        metrics.observe(f"router.model.{model}", elapsed)
+        # Cada intento (incluidos los hedges que pierden) se cobra: se registran todos
+        record_usage(stage, model, result, elapsed)
+        return result
+
+    def _submit(self, fn: Callable[..., T], *args) -> "Future[T]":
+        # Los hilos del pool no heredan el contexto: cada intento corre en una
+        # copia, así ve el deadline, el modo de servicio y la etapa de la petición
+        context = contextvars.copy_context()
+        return self._executor.submit(context.run, fn, *args)
+
+    def _hedged(
+        self,
+        tier_name: str,
+        model: str,
+        tier: ModelTier,
+        fn: Callable[[str, float], T],
+    ) -> T:
+        timeout = stage_timeout(tier.stage, tier.timeout)
+        deadline = time.monotonic() + timeout
+        hedge_delay = metrics.percentile(
+            f"router.model.{model}", HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+        if hedge_delay is None:
+            hedge_delay = tier.hedge_after
+
+        primary = self._submit(self._timed, tier.stage, model, fn, timeout)
+        pending = {primary}
+        done, _ = wait(pending, timeout=min(hedge_delay, timeout))
+        if not done:
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                metrics.inc(f"router.{tier_name}.hedged")
+                pending.add(self._submit(
+                    self._timed, tier.stage, model, fn, remaining))
+
+        last_error: Optional[BaseException] = None
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(
+                pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is None:
+                    if future is not primary:
+                        metrics.inc(f"router.{tier_name}.hedge_wins")
+                    return future.result()
+                last_error = error
+
+        if last_error is not None and not pending:
+            raise last_error
+        _cancel_all(pending)
+        request_deadline = current_deadline()
+        if request_deadline is not None:
+            request_deadline.check(tier.stage)
+        raise TimeoutError(
+            f"El modelo {model} no respondió en {timeout:.1f}s")
+
+
+def _cancel_all(futures: "set[Future]") -> None:
+    for future in futures:
+        future.cancel()
+
+
+_router: Optional[ModelRouter] = None
+
+
+def get_router() -> ModelRouter:
+    """Obtiene el router compartido, inicializándolo si es necesario"""
+    global _router
+    if _router is None:
+        _router = ModelRouter()
+    return _router
@@ -0,0 +1,118 @@
+"""
+Modelos de salida estructurada de la extracción y de la visión.
+
+Las llamadas a OpenAI usan structured outputs con esquema estricto
+(``chat.completions.parse`` y ``responses.parse``): el modelo solo puede
+devolver JSON que cumple el esquema, y el SDK lo valida con
+``model_validate_json`` en una sola pasada. Los validadores de aquí hacen en
+esa misma pasada la limpieza que antes se repartía entre regex sobre el
+monto, un fallback por regex cuando el JSON no decodificaba, el parseo de
+bloques de código de la visión y ``_normalize_account_text`` en main.py.
+
+``TicketData`` (visión) y ``PaymentExtraction`` (extracción) comparten los
+campos y validadores de ``PaymentFields``.
+"""
+
+from __future__ import annotations
+
+from typing import Any, List, Optional
+
+from pydantic import BaseModel, Field, field_validator, model_validator
+
+DEFAULT_RESPONSE = "Procesando tu solicitud..."
+
+SPANISH_NUMBER_MAP = {
+    "cero": "0",
+    "uno": "1",
+    "una": "1",
+    "dos": "2",
+    "tres": "3",
+    "cuatro": "4",
+    "cinco": "5",
+    "seis": "6",
+    "siete": "7",
+    "ocho": "8",
+    "nueve": "9",
+    "diez": "10",
+}
+
+
+def normalize_account_text(value: str) -> str:
+    """Cuenta dictada con palabras o con espacios ("cinco cinco 12") a dígitos."""
+    digits: List[str] = []
+    for word in value.lower().strip().split():
+        clean = "".join(ch for ch in word if ch.isalnum())
+        if not clean:
+            continue
+        if clean.isdigit():
+            digits.append(clean)
+        elif clean in SPANISH_NUMBER_MAP:
+            digits.append(SPANISH_NUMBER_MAP[clean])
+    if digits:
+        return "".join(digits)
+    return value.strip()
+
+
+def _clean_destinatario(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    return normalize_account_text(str(value)) or None
+
+
+class PaymentFields(BaseModel):
+    """Monto y destinatario de un pago."""
+
+    monto: Optional[float] = Field(
+        None, description="Monto del pago en dígitos, sin símbolo de moneda.")
+    destinatario: Optional[str] = Field(
+        None, description="Cuenta, teléfono, wallet o nombre de quien recibe.")
+
+    @field_validator("destinatario", mode="before")
+    @classmethod
+    def _destinatario(cls, value: Any) -> Optional[str]:
+        return _clean_destinatario(value)
+
+
+class TicketData(PaymentFields):
+    """Datos que la visión extrae de un ticket."""
+
+
+class PagoItem(BaseModel):
+    """Un pago cuando el mensaje pide varios."""
+
+    # Puede faltar ("200 ... a Ana y a Beto"): se completa con el monto pendiente de la sesión
+    monto: Optional[float]
+    destinatario: str
+
+    @field_validator("destinatario", mode="before")
+    @classmethod
+    def _destinatario(cls, value: Any) -> str:
+        return _clean_destinatario(value) or ""
+
+
+class PaymentExtraction(PaymentFields):
+    """Resultado de la extracción de un mensaje."""
+
+    pagos: List[PagoItem] = Field(
+        default_factory=list,
+        description=(
+            "Solo si pide varios pagos: uno por destinatario, en orden; "
+            "monto y destinatario son los del primero."
+        ),
+    )
+    response: str = Field(
+        description="Respuesta breve y amigable que confirma la transacción.")
+
+    @model_validator(mode="after")
+    def _consistent(self) -> "PaymentExtraction":
+        # Pagos sin destinatario no se envían (sin monto se completan con la
+        # sesión); monto/destinatario y pagos quedan siempre de acuerdo: pagos
+        # es la lista completa, monto y destinatario el primero
+        self.pagos = [pago for pago in self.pagos if pago.destinatario]
+        if self.pagos and (self.monto is None or not self.destinatario):
+            self.monto, self.destinatario = self.pagos[0].monto, self.pagos[0].destinatario
+        if not self.pagos and self.monto is not None and self.destinatario:
+            self.pagos = [PagoItem(monto=self.monto, destinatario=self.destinatario)]
+        if not self.response.strip():
+            self.response = DEFAULT_RESPONSE
+        return self
@@ -0,0 +1,271 @@
+"""
+Pre-procesamiento de notas de voz antes de transcribirlas.
+
+WhatsApp envía las notas de voz como Opus/OGG aunque ws_bot las guarde con
+extensión .mp3, y las notas largas suelen traer mucho silencio. Este módulo:
+
+1. Detecta el contenedor real por sus bytes mágicos.
+2. Decodifica a PCM mono de 16 kHz (WAV con la librería estándar; el resto con
+   ``ffmpeg`` si está instalado).
+3. Recorta el silencio inicial y final con un detector de energía por tramas.
+4. Parte el audio largo en silencios en trozos de ~``CHUNK_SECONDS``.
+
+Los trozos se transcriben en paralelo con ``transcribe_chunks`` y el texto se
+une en orden. Si no es posible decodificar (sin ffmpeg), se sube el archivo
+original tal cual pero con la extensión correcta; ``check_decoder`` lo
+avisa al arrancar.
+"""
+
+from __future__ import annotations
+
+import io
+import math
+import os
+import shutil
+import subprocess
+import wave
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Tuple
+
+SAMPLE_RATE = 16000
+FRAME_MS = 30
+# Relleno que se conserva alrededor de la voz al recortar/partir
+PADDING_MS = 200
+# Duración objetivo y máxima de cada trozo a transcribir
+CHUNK_SECONDS = float(os.getenv("AUDIO_CHUNK_SECONDS", "45"))
+MAX_CHUNK_SECONDS = float(os.getenv("AUDIO_MAX_CHUNK_SECONDS", "90"))
+# Silencio mínimo para considerar un punto de corte
+MIN_SPLIT_SILENCE_MS = 300
+# Energía RMS mínima (muestras int16) para considerar voz
+ENERGY_FLOOR = float(os.getenv("AUDIO_ENERGY_FLOOR", "300"))
+MAX_PARALLEL_CHUNKS = int(os.getenv("AUDIO_MAX_PARALLEL_CHUNKS", "4"))
+
+_MAGIC = (
+    (b"OggS", "ogg"),
+    (b"fLaC", "flac"),
+    (b"ID3", "mp3"),
+    (b"\x1aE\xdf\xa3", "webm"),
+    (b"#!AMR", "amr"),
+)
+
+
+@dataclass
+class AudioChunk:
+    """Trozo listo para subir: contenido codificado y su posición en el audio."""
+    content: bytes
+    filename: str
+    start: float
+    end: float
+
+
+@dataclass
+class PreparedAudio:
+    """Resultado del pre-procesamiento."""
+    container: str
+    original_seconds: Optional[float]
+    chunks: List[AudioChunk] = field(default_factory=list)
+
+    @property
+    def trimmed_seconds(self) -> float:
+        return sum(chunk.end - chunk.start for chunk in self.chunks)
+
+
+def detect_container(head: bytes) -> str:
+    """Detecta el contenedor de audio a partir de los primeros bytes."""
+    for magic, name in _MAGIC:
+        if head.startswith(magic):
+            return name
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    if head[4:8] == b"ftyp":
+        return "m4a"
+    if len(head) > 1 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0:
+        if (head[1] & 0x06) == 0:
+            return "aac"  # ADTS
+        return "mp3"
+    return "unknown"
+
+
+def ffmpeg_available() -> bool:
+    return shutil.which("ffmpeg") is not None
+
+
+def check_decoder() -> bool:
+    """Avisa al arrancar si falta ffmpeg: sin él solo se procesan WAV de 16 kHz mono."""
+    available = ffmpeg_available()
+    if not available:
+        print(
+            "Advertencia: ffmpeg no está en el PATH; las notas de voz Opus/MP3 "
+            "se subirán completas, sin recortar silencios ni partir en trozos"
+        )
+    return available
+
+
+def decode_to_pcm(path: str, container: str) -> Optional[array]:
+    """Decodifica a PCM int16 mono a SAMPLE_RATE, o None si no es posible."""
+    if container == "wav":
+        samples = _read_wav(path)
+        if samples is not None:
+            return samples
+    if not ffmpeg_available():
+        return None
+    result = subprocess.run(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", path,
+         "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-"],
+        capture_output=True,
+        check=False,
+    )
+    if result.returncode != 0 or not result.stdout:
+        return None
+    samples = array("h")
+    samples.frombytes(result.stdout[: len(result.stdout) // 2 * 2])
+    return samples
+
+
+def frame_energies(samples: array, rate: int = SAMPLE_RATE) -> List[float]:
+    """
+    Energía RMS por trama de FRAME_MS.
+
+    Se submuestrea cada trama (1 de cada 4 muestras): para distinguir voz de
+    silencio basta y mantiene el costo bajo incluso en notas de 5 minutos.
+    """
+    frame = int(rate * FRAME_MS / 1000)
+    energies = []
+    for offset in range(0, len(samples), frame):
+        window = samples[offset:offset + frame:4]
+        if not window:
+            break
+        energies.append(math.sqrt(sum(s * s for s in window) / len(window)))
+    return energies
+
+
+def voiced_frames(energies: List[float]) -> List[bool]:
+    """Marca las tramas con voz con un umbral adaptativo al ruido de fondo."""
+    if not energies:
+        return []
+    ordered = sorted(energies)
+    noise = ordered[len(ordered) // 10]
+    loud = ordered[len(ordered) * 9 // 10]
+    # Si casi no hay pausas el percentil 10 ya es voz: acotar por el nivel alto
+    threshold = max(ENERGY_FLOOR, min(noise * 3, loud * 0.2))
+    return [energy >= threshold for energy in energies]
+
+
+def split_points(voiced: List[bool]) -> List[Tuple[int, int]]:
+    """
+    Rangos de tramas [inicio, fin) con voz, sin silencio inicial ni final y
+    partidos en el silencio más cercano a cada CHUNK_SECONDS.
+    """
+    if not any(voiced):
+        return []
+    frames_per_second = 1000 / FRAME_MS
+    pad = int(PADDING_MS / FRAME_MS)
+    min_gap = int(MIN_SPLIT_SILENCE_MS / FRAME_MS)
+    target = int(CHUNK_SECONDS * frames_per_second)
+    hard_max = int(MAX_CHUNK_SECONDS * frames_per_second)
+
+    first = voiced.index(True)
+    last = len(voiced) - 1 - voiced[::-1].index(True)
+    start = max(0, first - pad)
+    end = min(len(voiced), last + pad + 1)
+
+    ranges = []
+    chunk_start = start
+    silence_run = 0
+    for i in range(start, end):
+        silence_run = 0 if voiced[i] else silence_run + 1
+        length = i - chunk_start
+        at_gap = silence_run >= min_gap and length >= target
+        if at_gap or length >= hard_max:
+            cut = i - silence_run // 2 if at_gap else i
+            ranges.append((chunk_start, cut))
+            chunk_start = cut
+            silence_run = 0
+    if end - chunk_start > 0:
+        ranges.append((chunk_start, end))
+    return ranges
+
+
+def prepare_audio(path: str) -> PreparedAudio:
+    """Detecta, recorta y parte una nota de voz para transcribirla."""
+    with open(path, "rb") as audio_file:
+        head = audio_file.read(16)
+    container = detect_container(head)
+    samples = decode_to_pcm(path, container)
+
+    if samples is None:
+        # Sin decodificador: subir tal cual, pero con la extensión real
+        with open(path, "rb") as audio_file:
+            content = audio_file.read()
+        ext = container if container != "unknown" else os.path.splitext(path)[1].lstrip(".") or "mp3"
+        return PreparedAudio(
+            container=container,
+            original_seconds=None,
+            chunks=[AudioChunk(content, f"audio.{ext}", 0.0, 0.0)],
+        )
+
+    frame = int(SAMPLE_RATE * FRAME_MS / 1000)
+    prepared = PreparedAudio(
+        container=container, original_seconds=len(samples) / SAMPLE_RATE)
+    for index, (first, last) in enumerate(split_points(voiced_frames(frame_energies(samples)))):
+        pcm = samples[first * frame:last * frame]
+        content, ext = _encode_chunk(pcm)
+        prepared.chunks.append(AudioChunk(
+            content=content,
+            filename=f"chunk_{index}.{ext}",
+            start=first * frame / SAMPLE_RATE,
+            end=min(last * frame, len(samples)) / SAMPLE_RATE,
+        ))
+    return prepared
+
+
+def transcribe_chunks(
+    chunks: List[AudioChunk],
+    transcribe: Callable[[AudioChunk], str],
+    max_workers: int = MAX_PARALLEL_CHUNKS,
+) -> str:
+    """Transcribe los trozos en paralelo y une el texto en orden."""
+    if not chunks:
+        return ""
+    if len(chunks) == 1:
+        return transcribe(chunks[0]).strip()
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+        texts = list(executor.map(transcribe, chunks))
+    return " ".join(text.strip() for text in texts if text and text.strip())
+
+
+def _read_wav(path: str) -> Optional[array]:
+    try:
+        with wave.open(path, "rb") as wav:
+            if wav.getsampwidth() != 2 or wav.getnchannels() != 1 or wav.getframerate() != SAMPLE_RATE:
+                return None
+            samples = array("h")
+            samples.frombytes(wav.readframes(wav.getnframes()))
+            return samples
+    except (wave.Error, EOFError):
+        return None
+
+
+def _encode_chunk(pcm: array) -> Tuple[bytes, str]:
+    """Codifica un trozo a Opus/OGG con ffmpeg (mucho más ligero) o a WAV."""
+    raw = pcm.tobytes()
+    if ffmpeg_available():
+        result = subprocess.run(
+            ["ffmpeg", "-nostdin", "-loglevel", "error",
+             "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-i", "-",
+             "-c:a", "libopus", "-b:a", "24k", "-f", "ogg", "-"],
+            input=raw,
+            capture_output=True,
+            check=False,
+        )
+        if result.returncode == 0 and result.stdout:
+            return result.stdout, "ogg"
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(raw)
+    return buffer.getvalue(), "wav"
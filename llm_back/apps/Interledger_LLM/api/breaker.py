@@ -0,0 +1,226 @@
+"""
+Circuit breakers para las dependencias externas (OpenAI y Open Payments).
+
+Cada breaker lleva una ventana móvil de resultados. Si la tasa de error supera
+el umbral, pasa a "open" y rechaza las llamadas de inmediato con
+``CircuitOpenError``. Cuando vence el tiempo de enfriamiento pasa a
+"half_open" y deja pasar unas pocas llamadas de prueba: si salen bien vuelve a
+"closed" y si fallan vuelve a abrirse. Así una caída de la dependencia cuesta
+milisegundos por petición en lugar de un timeout completo.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterator, Optional, Tuple
+
+from . import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_STATE_GAUGE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Mensaje para el usuario cuando una dependencia está abierta
+UNAVAILABLE_MESSAGE = (
+    "Sorry, I'm having trouble reaching one of our services right now. "
+    "Please try again in a minute."
+)
+
+
+class CircuitOpenError(Exception):
+    """La llamada se rechazó porque el breaker está abierto."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(
+            f"Servicio '{name}' no disponible (circuit breaker abierto)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Breaker con estados closed/open/half_open y ventana móvil de errores."""
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate: float = 0.5,
+        min_calls: int = 5,
+        window: float = 30.0,
+        open_seconds: float = 15.0,
+        half_open_calls: int = 1,
+        is_failure: Optional[Callable[[BaseException], bool]] = None,
+    ):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.is_failure = is_failure or (lambda exc: True)
+        self._lock = threading.Lock()
+        self._results: Deque[Tuple[float, bool]] = deque()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._publish()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._maybe_half_open()
+            return self._state
+
+    def allow(self) -> None:
+        """Lanza CircuitOpenError si la llamada no debe intentarse."""
+        with self._lock:
+            self._maybe_half_open()
+            if self._state == OPEN:
+                metrics.inc(f"breaker.{self.name}.rejected")
+                raise CircuitOpenError(self.name, self._retry_after())
+            if self._state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    metrics.inc(f"breaker.{self.name}.rejected")
+                    raise CircuitOpenError(self.name, self._retry_after())
+                self._probes += 1
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._transition(CLOSED)
+                self._results.clear()
+            self._record(True)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._transition(OPEN)
+                return
+            self._record(False)
+            total = len(self._results)
+            failures = sum(1 for _, ok in self._results if not ok)
+            if total >= self.min_calls and failures / total >= self.failure_rate:
+                self._transition(OPEN)
+
+    @contextmanager
+    def guard(self) -> Iterator[None]:
+        """
+        Protege un bloque de código (síncrono o con awaits dentro).
+
+        Las excepciones que ``is_failure`` considera fallas de la dependencia
+        cuentan contra el breaker; el resto (p. ej. errores de validación)
+        cuentan como éxito porque la dependencia sí respondió. Una
+        cancelación no cuenta: solo libera la prueba en semiabierto.
+        """
+        self.allow()
+        try:
+            yield
+        except CircuitOpenError:
+            raise
+        except Exception as exc:
+            if self.is_failure(exc):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        except BaseException:
+            self._release_probe()
+            raise
+        else:
+            self.record_success()
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            self._maybe_half_open()
+            self._prune(time.monotonic())
+            total = len(self._results)
+            failures = sum(1 for _, ok in self._results if not ok)
+            return {
+                "state": self._state,
+                "calls_in_window": total,
+                "error_rate": failures / total if total else 0.0,
+                "retry_after": self._retry_after() if self._state == OPEN else 0.0,
+            }
+
+    def _record(self, ok: bool) -> None:
+        now = time.monotonic()
+        self._results.append((now, ok))
+        self._prune(now)
+
+    def _prune(self, now: float) -> None:
+        while self._results and now - self._results[0][0] > self.window:
+            self._results.popleft()
+
+    def _release_probe(self) -> None:
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def _maybe_half_open(self) -> None:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN)
+
+    def _retry_after(self) -> float:
+        return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    def _transition(self, state: str) -> None:
+        if state == self._state:
+            return
+        self._state = state
+        self._probes = 0
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+            metrics.inc(f"breaker.{self.name}.opened")
+        self._publish()
+
+    def _publish(self) -> None:
+        metrics.set_gauge(f"breaker.{self.name}.state", _STATE_GAUGE[self._state])
+
+
+def _is_openai_failure(exc: BaseException) -> bool:
+    import openai
+
+    # Un 429 es de una sola key: el pool (agent/key_pool.py) la enfría y manda
+    # las siguientes llamadas a las demás. Contarlo aquí abriría el breaker,
+    # que es uno para todo el proceso, aunque otras keys tengan margen
+    return isinstance(exc, (
+        openai.APIConnectionError,  # incluye APITimeoutError
+        openai.InternalServerError,
+        TimeoutError,
+    ))
+
+
+def _is_payment_failure(exc: BaseException) -> bool:
+    import asyncio
+    import httpx
+
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, (httpx.RequestError, asyncio.TimeoutError))
+
+
+openai_breaker = CircuitBreaker(
+    "openai",
+    failure_rate=float(os.getenv("OPENAI_BREAKER_FAILURE_RATE", "0.5")),
+    open_seconds=float(os.getenv("OPENAI_BREAKER_OPEN_SECONDS", "15")),
+    is_failure=_is_openai_failure,
+)
+
+payment_breaker = CircuitBreaker(
+    "payments",
+    failure_rate=float(os.getenv("PAYMENT_BREAKER_FAILURE_RATE", "0.5")),
+    open_seconds=float(os.getenv("PAYMENT_BREAKER_OPEN_SECONDS", "15")),
+    is_failure=_is_payment_failure,
+)
+
+
+def breaker_states() -> Dict[str, Dict[str, object]]:
+    return {
+        breaker.name: breaker.snapshot()
+        for breaker in (openai_breaker, payment_breaker)
+    }
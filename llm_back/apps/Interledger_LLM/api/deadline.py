@@ -0,0 +1,147 @@
+"""
+Presupuesto de tiempo (deadline) por petición.
+
+El webhook crea un ``Deadline`` al recibir el mensaje y lo publica en una
+ContextVar; cada etapa (descarga, transcripción, visión, extracción, TTS y
+pago) deriva su timeout del tiempo restante con ``stage_timeout`` en lugar de
+usar valores fijos. ``asyncio.to_thread`` copia el contexto, así que las
+etapas que corren en hilos también ven el deadline de su petición.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Dict, Iterator, Optional, TypeVar
+
+from . import metrics
+
+T = TypeVar("T")
+
+# Presupuesto total por petición; debe ser menor que el timeout de ws_bot
+REQUEST_BUDGET_SECONDS = float(os.getenv("REQUEST_BUDGET_SECONDS", "55"))
+# Por debajo de este margen no tiene sentido arrancar una etapa nueva
+MIN_STAGE_SECONDS = float(os.getenv("MIN_STAGE_SECONDS", "0.5"))
+
+
+class DeadlineExceeded(Exception):
+    """El presupuesto de la petición se agotó durante una etapa."""
+
+    def __init__(self, stage: str):
+        super().__init__(f"Presupuesto de tiempo agotado en la etapa '{stage}'")
+        self.stage = stage
+
+
+class Deadline:
+    """Presupuesto de tiempo de una petición y registro de sus etapas."""
+
+    def __init__(self, budget: float = REQUEST_BUDGET_SECONDS):
+        self.budget = budget
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + budget
+        self.stages: Dict[str, float] = {}
+        self.exhausted_by: Optional[str] = None
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def check(self, stage: str) -> None:
+        """Lanza DeadlineExceeded si ya no queda presupuesto para la etapa."""
+        if self.remaining() <= MIN_STAGE_SECONDS:
+            self._exhaust(stage)
+
+    def timeout_for(self, stage: str, cap: Optional[float] = None) -> float:
+        """Timeout para una etapa: lo que resta del presupuesto, acotado por cap."""
+        self.check(stage)
+        remaining = self.remaining()
+        return min(remaining, cap) if cap is not None else remaining
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Mide una etapa y, si consumió el presupuesto, la marca como culpable."""
+        self.check(name)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            self.stages[name] = self.stages.get(name, 0.0) + duration
+            metrics.observe(f"stage.{name}", duration)
+            if self.remaining() <= 0 and self.exhausted_by is None:
+                self.exhausted_by = name
+
+    async def run(self, name: str, awaitable: Awaitable[T], cap: Optional[float] = None) -> T:
+        """Ejecuta una etapa asíncrona cancelándola al agotarse el presupuesto."""
+        try:
+            self.check(name)
+        except DeadlineExceeded:
+            # La etapa nunca arranca: cerrar la corrutina evita el warning
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            raise
+        with self.stage(name):
+            timeout = self.remaining() if cap is None else min(self.remaining(), cap)
+            try:
+                return await asyncio.wait_for(awaitable, timeout=timeout)
+            except asyncio.TimeoutError:
+                if cap is None or timeout < cap:
+                    self._exhaust(name)
+                raise
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "budget": self.budget,
+            "elapsed": round(self.elapsed(), 3),
+            "stages": {name: round(value, 3) for name, value in self.stages.items()},
+            "exhausted_by": self.exhausted_by,
+        }
+
+    def _exhaust(self, stage: str) -> None:
+        if self.exhausted_by is None:
+            self.exhausted_by = stage
+        metrics.inc(f"deadline.exceeded.{self.exhausted_by}")
+        raise DeadlineExceeded(self.exhausted_by)
+
+
+_current: ContextVar[Optional[Deadline]] = ContextVar(
+    "request_deadline", default=None)
+
+
+def start_deadline(budget: Optional[float] = None) -> Deadline:
+    """Crea el deadline de la petición actual y lo publica en el contexto."""
+    deadline = Deadline(budget if budget and budget > 0 else REQUEST_BUDGET_SECONDS)
+    _current.set(deadline)
+    return deadline
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current.get()
+
+
+@contextmanager
+def track_stage(name: str) -> Iterator[None]:
+    """Mide una etapa contra el deadline actual, si hay uno activo."""
+    deadline = _current.get()
+    if deadline is None:
+        yield
+        return
+    with deadline.stage(name):
+        yield
+
+
+def stage_timeout(stage: str, default: float) -> float:
+    """
+    Timeout para una etapa derivado del deadline actual.
+
+    Sin deadline activo (por ejemplo en scripts) devuelve default.
+    """
+    deadline = _current.get()
+    if deadline is None:
+        return default
+    return deadline.timeout_for(stage, cap=default)
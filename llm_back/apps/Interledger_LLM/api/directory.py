@@ -0,0 +1,294 @@
+"""
+Directorio local de destinatarios con índice difuso en memoria.
+
+El ``destinatario`` que extrae el LLM es texto libre ("santiago bocanegra",
+"5512345678", "amazon"). Antes de enviar el pago se resuelve contra un
+directorio de contactos (JSON, CSV o SQLite) con cuatro índices:
+
+1. Número de cuenta exacto (solo dígitos).
+2. Nombre o alias normalizado exacto.
+3. Clave fonética en español (b/v, s/z/c, ll/y, h muda, ...).
+4. Trigramas de caracteres, puntuados con el coeficiente de Dice.
+
+La búsqueda difusa recorre primero los trigramas más raros y se detiene al
+llegar a ``MAX_POSTINGS_SCANNED`` entradas, así que su costo no crece con el
+tamaño del directorio. El archivo se vuelve a cargar en segundo plano cuando cambia.
+
+Solo las coincidencias exactas (1 y 2) bastan para pagar; las fonéticas y
+difusas proponen un destinatario que el usuario debe confirmar.
+"""
+
+from __future__ import annotations
+
+import csv
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+RECIPIENT_DIRECTORY_PATH = os.getenv(
+    "RECIPIENT_DIRECTORY_PATH",
+    str(Path(__file__).resolve().parent / "recipients.json"),
+)
+# Cada cuánto se revisa si el archivo cambió
+RELOAD_CHECK_SECONDS = float(os.getenv("RECIPIENT_RELOAD_CHECK_SECONDS", "5"))
+# Similitud mínima (Dice sobre trigramas) para aceptar una coincidencia difusa
+MIN_FUZZY_SCORE = float(os.getenv("RECIPIENT_MIN_FUZZY_SCORE", "0.55"))
+# Máximo de entradas que se recorren por búsqueda difusa: se usan primero los
+# trigramas más raros (más discriminantes) hasta agotar este presupuesto
+MAX_POSTINGS_SCANNED = int(os.getenv("RECIPIENT_MAX_POSTINGS_SCANNED", "8000"))
+MAX_CANDIDATES = int(os.getenv("RECIPIENT_MAX_CANDIDATES", "100"))
+EXACT_METHODS = ("account", "name")
+
+
+@dataclass(frozen=True)
+class Recipient:
+    name: str
+    account: Optional[str] = None
+    wallet_url: Optional[str] = None
+    alias_of: Optional[str] = None  # nombre completo cuando esta entrada es un alias
+
+
+@dataclass(frozen=True)
+class RecipientMatch:
+    recipient: Recipient
+    score: float
+    method: str  # "account", "name", "phonetic" o "fuzzy"
+
+    @property
+    def exact(self) -> bool:
+        """Cuenta, nombre o alias exactos; solo estas se pagan sin confirmar."""
+        return self.method in EXACT_METHODS
+
+    @property
+    def name(self) -> str:
+        """Nombre completo del destinatario, aunque la coincidencia sea un alias."""
+        return self.recipient.alias_of or self.recipient.name
+
+    @property
+    def receiver(self) -> str:
+        """Valor a enviar como receiverWalletUrl al servicio de pagos."""
+        return self.recipient.wallet_url or self.recipient.account or self.recipient.name
+
+
+def normalize_name(value: str) -> str:
+    """Minúsculas, sin acentos ni signos y con espacios simples."""
+    decomposed = unicodedata.normalize("NFKD", value.lower())
+    without_accents = "".join(
+        ch for ch in decomposed if not unicodedata.combining(ch))
+    return " ".join(re.sub(r"[^a-z0-9ñ ]+", " ", without_accents).split())
+
+
+_PHONETIC_RULES = (
+    (re.compile(r"ll"), "y"),
+    (re.compile(r"qu"), "k"),
+    (re.compile(r"c(?=[ei])"), "s"),
+    (re.compile(r"g(?=[ei])"), "j"),
+    (re.compile(r"ch"), "x"),
+    (re.compile(r"c"), "k"),
+    (re.compile(r"z"), "s"),
+    (re.compile(r"v"), "b"),
+    (re.compile(r"w"), "u"),
+    (re.compile(r"h"), ""),
+    (re.compile(r"(.)\1+"), r"\1"),
+)
+
+
+def phonetic_key(value: str) -> str:
+    """Clave fonética aproximada para nombres en español."""
+    tokens = []
+    for token in normalize_name(value).split():
+        if token.isdigit():
+            continue
+        for pattern, replacement in _PHONETIC_RULES:
+            token = pattern.sub(replacement, token)
+        if token:
+            tokens.append(token)
+    return " ".join(tokens)
+
+
+def trigrams(value: str) -> List[str]:
+    padded = f"  {value} "
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+class RecipientIndex:
+    """Índices inmutables sobre una lista de destinatarios."""
+
+    def __init__(self, recipients: Iterable[Recipient]):
+        self.recipients: List[Recipient] = []
+        self.by_account: Dict[str, int] = {}
+        self.by_name: Dict[str, int] = {}
+        self.by_phonetic: Dict[str, int] = {}
+        self.by_trigram: Dict[str, List[int]] = defaultdict(list)
+        self.trigram_sets: List[frozenset] = []
+
+        for recipient in recipients:
+            index = len(self.recipients)
+            self.recipients.append(recipient)
+            if recipient.account:
+                self.by_account.setdefault(_digits(recipient.account), index)
+            name = normalize_name(recipient.name)
+            self.by_name.setdefault(name, index)
+            self.by_phonetic.setdefault(phonetic_key(name), index)
+            grams = frozenset(trigrams(name))
+            self.trigram_sets.append(grams)
+            for gram in grams:
+                self.by_trigram[gram].append(index)
+
+    def __len__(self) -> int:
+        return len(self.recipients)
+
+    def lookup(self, query: str) -> Optional[RecipientMatch]:
+        digits = _digits(query)
+        if digits and len(digits) >= 6 and digits in self.by_account:
+            return RecipientMatch(self.recipients[self.by_account[digits]], 1.0, "account")
+
+        name = normalize_name(query)
+        if not name:
+            return None
+        if name in self.by_name:
+            return RecipientMatch(self.recipients[self.by_name[name]], 1.0, "name")
+        key = phonetic_key(name)
+        if key and key in self.by_phonetic:
+            return RecipientMatch(self.recipients[self.by_phonetic[key]], 0.9, "phonetic")
+        return self._fuzzy(name)
+
+    def _fuzzy(self, name: str) -> Optional[RecipientMatch]:
+        grams = set(trigrams(name))
+        postings = sorted(
+            (self.by_trigram[gram] for gram in grams if gram in self.by_trigram),
+            key=len,
+        )
+        hits: Counter = Counter()
+        scanned = 0
+        for posting in postings:
+            if hits and scanned + len(posting) > MAX_POSTINGS_SCANNED:
+                break
+            hits.update(posting[:MAX_POSTINGS_SCANNED])
+            scanned += len(posting)
+        # Los trigramas raros solo proponen candidatos; la similitud se calcula
+        # completa sobre el conjunto de trigramas de cada candidato
+        best: Optional[Tuple[float, int]] = None
+        for index, _ in hits.most_common(MAX_CANDIDATES):
+            candidate = self.trigram_sets[index]
+            score = 2 * len(grams & candidate) / (len(grams) + len(candidate))
+            if best is None or score > best[0]:
+                best = (score, index)
+        if best is None or best[0] < MIN_FUZZY_SCORE:
+            return None
+        return RecipientMatch(self.recipients[best[1]], round(best[0], 3), "fuzzy")
+
+
+class RecipientDirectory:
+    """Directorio con recarga en caliente cuando cambia el archivo de origen."""
+
+    def __init__(self, path: str = RECIPIENT_DIRECTORY_PATH):
+        self.path = path
+        self._index = RecipientIndex(())
+        self._mtime: Optional[float] = None
+        self._last_check = 0.0
+        self._reloading = threading.Lock()
+        self.reload()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def resolve(self, query: Optional[str]) -> Optional[RecipientMatch]:
+        """Resuelve un destinatario en texto libre; None si no hay coincidencia."""
+        if not query:
+            return None
+        self._maybe_reload()
+        return self._index.lookup(query)
+
+    def reload(self) -> None:
+        """Recarga el directorio y reemplaza el índice de forma atómica."""
+        mtime = _mtime(self.path)
+        if mtime is None:
+            self._index, self._mtime = RecipientIndex(()), None
+            return
+        self._index = RecipientIndex(load_recipients(self.path))
+        self._mtime = mtime
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now - self._last_check < RELOAD_CHECK_SECONDS:
+            return
+        self._last_check = now
+        if _mtime(self.path) == self._mtime:
+            return
+        if self._reloading.acquire(blocking=False):
+            # Reconstruir fuera del request; mientras, se sirve el índice anterior
+            threading.Thread(target=self._reload_in_background, daemon=True).start()
+
+    def _reload_in_background(self) -> None:
+        try:
+            self.reload()
+        except Exception as exc:
+            print(f"No se pudo recargar el directorio {self.path}: {exc}")
+        finally:
+            self._reloading.release()
+
+
+def load_recipients(path: str) -> List[Recipient]:
+    """
+    Carga destinatarios desde JSON, CSV o SQLite.
+
+    JSON: lista de objetos con name, account, wallet_url y aliases (lista).
+    CSV: columnas name, account, wallet_url y aliases (separados por "|").
+    SQLite: tabla recipients(name, account, wallet_url).
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix in (".db", ".sqlite", ".sqlite3"):
+        with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as conn:
+            rows = conn.execute(
+                "SELECT name, account, wallet_url FROM recipients").fetchall()
+        return [Recipient(name, account, wallet_url) for name, account, wallet_url in rows if name]
+    with open(path, "r", encoding="utf-8") as source:
+        if suffix == ".csv":
+            records = list(csv.DictReader(source))
+        else:
+            records = json.load(source)
+    recipients = []
+    for record in records:
+        name = (record.get("name") or "").strip()
+        if not name:
+            continue
+        account = record.get("account") or None
+        wallet_url = record.get("wallet_url") or None
+        recipients.append(Recipient(name, account, wallet_url))
+        aliases = record.get("aliases") or []
+        if isinstance(aliases, str):
+            aliases = [alias.strip() for alias in aliases.split("|") if alias.strip()]
+        for alias in aliases:
+            recipients.append(Recipient(alias, account, wallet_url, alias_of=name))
+    return recipients
+
+
+def _digits(value: str) -> str:
+    return "".join(ch for ch in value if ch.isdigit())
+
+
+def _mtime(path: str) -> Optional[float]:
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+_directory: Optional[RecipientDirectory] = None
+
+
+def get_directory() -> RecipientDirectory:
+    """Obtiene el directorio compartido, inicializándolo si es necesario"""
+    global _directory
+    if _directory is None:
+        _directory = RecipientDirectory()
+    return _directory
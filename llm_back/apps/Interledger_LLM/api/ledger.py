@@ -0,0 +1,287 @@
+"""
+Bitácora local de transacciones (SQLite en modo WAL).
+
+Cada pago que produce el webhook (payload, estado y confirmación) se guarda
+para que ws_bot pueda mostrarle al usuario sus transacciones recientes.
+
+- Las escrituras no ocurren en el request: ``record`` solo encola la fila y un
+  hilo escritor inserta todo lo acumulado (hasta ``LEDGER_BATCH_SIZE`` filas)
+  en una sola transacción, así que bajo carga los commits se agrupan solos.
+- Las lecturas usan una conexión de solo lectura por hilo; gracias a WAL no
+  se bloquean con el escritor.
+- La consulta por usuario usa el índice ``(wa_id, created_at)`` y paginación
+  por cursor (keyset), así que su costo no depende de cuántas filas hay ni de
+  qué tan atrás está la página.
+"""
+
+from __future__ import annotations
+
+import os
+import queue
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import metrics
+
+LEDGER_DB_PATH = os.getenv(
+    "LEDGER_DB_PATH",
+    str(Path(__file__).resolve().parent / "ledger.db"),
+)
+LEDGER_BATCH_SIZE = int(os.getenv("LEDGER_BATCH_SIZE", "200"))
+# Filas pendientes máximas; si el escritor no alcanza se descartan (y se cuentan)
+LEDGER_QUEUE_SIZE = int(os.getenv("LEDGER_QUEUE_SIZE", "10000"))
+MAX_PAGE_SIZE = 50
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY,
+    wa_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    amount TEXT,
+    asset_code TEXT,
+    asset_scale INTEGER,
+    receiver TEXT,
+    destinatario TEXT,
+    status TEXT,
+    payment_id TEXT,
+    confirmation_url TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_wa_id_created
+    ON transactions (wa_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_transactions_created
+    ON transactions (created_at);
+"""
+
+_COLUMNS = (
+    "wa_id", "created_at", "amount", "asset_code", "asset_scale", "receiver",
+    "destinatario", "status", "payment_id", "confirmation_url", "error",
+)
+_INSERT = (
+    f"INSERT INTO transactions ({', '.join(_COLUMNS)}) "
+    f"VALUES ({', '.join('?' for _ in _COLUMNS)})"
+)
+_SELECT = f"SELECT id, {', '.join(_COLUMNS)} FROM transactions"
+
+
+@dataclass
+class TransactionPage:
+    items: List[Dict[str, Any]]
+    next_cursor: Optional[str]
+
+
+def transaction_row(
+    wa_id: str,
+    destinatario: Optional[str],
+    payment_payload: Dict[str, Any],
+    payment_result: Any,
+) -> Tuple[Any, ...]:
+    """Arma la fila de la bitácora a partir del payload y el resultado del pago."""
+    result = payment_result if isinstance(payment_result, dict) else {}
+    confirmation = result.get("service_response")
+    if not isinstance(confirmation, dict):
+        confirmation = {}
+    return (
+        wa_id,
+        time.time(),
+        payment_payload.get("amount"),
+        payment_payload.get("assetCode"),
+        payment_payload.get("assetScale"),
+        payment_payload.get("receiverWalletUrl"),
+        destinatario,
+        result.get("status"),
+        confirmation.get("paymentId"),
+        confirmation.get("confirmationUrl"),
+        result.get("error"),
+    )
+
+
+class TransactionLedger:
+    """Bitácora con escritura por lotes en segundo plano y lecturas paginadas."""
+
+    def __init__(self, path: str = LEDGER_DB_PATH):
+        self.path = path
+        self._pending: "queue.Queue[Optional[Tuple[Any, ...]]]" = queue.Queue(
+            maxsize=LEDGER_QUEUE_SIZE)
+        self._readers = threading.local()
+        self._flushed = threading.Condition()
+        self._enqueued = 0
+        self._written = 0
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+        self._writer = threading.Thread(
+            target=self._write_loop, name="ledger-writer", daemon=True)
+        self._writer.start()
+
+    def record(self, row: Tuple[Any, ...]) -> bool:
+        """Encola una fila sin bloquear; False si la cola está llena."""
+        try:
+            self._pending.put_nowait(row)
+        except queue.Full:
+            metrics.inc("ledger.dropped")
+            return False
+        with self._flushed:
+            self._enqueued += 1
+        metrics.set_gauge("ledger.queue_depth", self._pending.qsize())
+        return True
+
+    def recent(
+        self,
+        wa_id: str,
+        limit: int = 10,
+        cursor: Optional[str] = None,
+    ) -> TransactionPage:
+        """
+        Transacciones de un usuario, de la más reciente a la más antigua.
+
+        Args:
+            wa_id: Usuario de WhatsApp
+            limit: Tamaño de página (máximo MAX_PAGE_SIZE)
+            cursor: ``next_cursor`` de la página anterior
+
+        Returns:
+            TransactionPage; ``next_cursor`` es None en la última página.
+        """
+        start = time.perf_counter()
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        sql = f"{_SELECT} WHERE wa_id = ?"
+        params: List[Any] = [wa_id]
+        if cursor:
+            created_at, row_id = _parse_cursor(cursor)
+            sql += " AND (created_at < ? OR (created_at = ? AND id < ?))"
+            params += [created_at, created_at, row_id]
+        sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        params.append(limit + 1)
+
+        rows = self._reader().execute(sql, params).fetchall()
+        items = [dict(zip(("id",) + _COLUMNS, row)) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = items[-1]
+            next_cursor = f"{last['created_at']!r}:{last['id']}"
+        metrics.observe("ledger.query", time.perf_counter() - start)
+        return TransactionPage(items, next_cursor)
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Espera a que se escriban las filas encoladas hasta ahora."""
+        deadline = time.monotonic() + timeout
+        with self._flushed:
+            target = self._enqueued
+            while self._written < target:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._flushed.wait(remaining)
+        return True
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Escribe lo pendiente y detiene el hilo escritor."""
+        try:
+            self._pending.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._writer.join(timeout)
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        if read_only:
+            conn = sqlite3.connect(
+                f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Con WAL, NORMAL solo arriesga el último lote ante un corte de luz
+            conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=2000")
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._readers, "conn", None)
+        if conn is None:
+            conn = self._connect(read_only=True)
+            self._readers.conn = conn
+        return conn
+
+    def _write_loop(self) -> None:
+        conn = self._connect()
+        stopping = False
+        while not stopping:
+            first = self._pending.get()
+            batch = []
+            if first is None:
+                stopping = True
+            else:
+                batch.append(first)
+            # Juntar lo que ya esté en cola, sin esperar más
+            while len(batch) < LEDGER_BATCH_SIZE:
+                try:
+                    row = self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                if row is None:
+                    stopping = True
+                    continue
+                batch.append(row)
+            if batch:
+                self._write_batch(conn, batch)
+        # Filas que quedaron detrás de la señal de cierre
+        leftover = []
+        while True:
+            try:
+                row = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            if row is not None:
+                leftover.append(row)
+        if leftover:
+            self._write_batch(conn, leftover)
+        conn.close()
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: List[Tuple[Any, ...]]) -> None:
+        start = time.perf_counter()
+        try:
+            with conn:
+                conn.executemany(_INSERT, batch)
+        except sqlite3.Error as exc:
+            metrics.inc("ledger.write_errors")
+            print(f"No se pudieron guardar {len(batch)} transacciones: {exc}")
+        else:
+            metrics.inc("ledger.written", len(batch))
+            metrics.observe("ledger.flush", time.perf_counter() - start)
+        finally:
+            metrics.set_gauge("ledger.queue_depth", self._pending.qsize())
+            with self._flushed:
+                self._written += len(batch)
+                self._flushed.notify_all()
+
+
+def _parse_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        created_at, row_id = cursor.split(":")
+        return float(created_at), int(row_id)
+    except ValueError:
+        raise ValueError(f"Cursor inválido: {cursor!r}")
+
+
+_ledger: Optional[TransactionLedger] = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger() -> TransactionLedger:
+    """Obtiene la bitácora compartida, inicializándola si es necesario"""
+    global _ledger
+    if _ledger is None:
+        with _ledger_lock:
+            if _ledger is None:
+                _ledger = TransactionLedger()
+    return _ledger
+
+
+def close_ledger() -> None:
+    """Cierra la bitácora compartida si llegó a crearse."""
+    if _ledger is not None:
+        _ledger.close()
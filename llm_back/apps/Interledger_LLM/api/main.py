@@ -1,15 +1,69 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Header, Request
 from pydantic import BaseModel
-from typing import Optional, Dict, Any, List
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from typing import Optional, Dict, Any, List, AsyncIterator, Tuple
 from .agent.main import process_message_with_extraction, get_client
-from .payment import send_payment_async, DEFAULT_ASSET_CODE, DEFAULT_ASSET_SCALE
+from .agent.key_pool import close_key_pool, key_pool_stats
+from .agent.prompts import VISION_PROMPT
+from .agent.router import get_router
+from .agent.schemas import TicketData
+from . import metrics
+from .audio import AudioChunk, check_decoder, prepare_audio, transcribe_chunks
+from .media_store import (
+    MEDIA_SCHEME,
+    MediaTooLarge,
+    resolve_media_source,
+    store_stream,
+)
+from .media_urls import MEDIA_URL_TTL_SECONDS, signed_url, verify_signed_id
+from .tts import openai_speech_stream, synthesize_to_file
+from .breaker import (
+    UNAVAILABLE_MESSAGE,
+    CircuitOpenError,
+    breaker_states,
+    openai_breaker,
+)
+from .directory import RecipientMatch, get_directory
+from .ledger import MAX_PAGE_SIZE, close_ledger, get_ledger, transaction_row
+from .outbox import PAYMENT_OUTBOX_ENABLED, get_outbox
+from .profiling import (
+    ADMIN_TOKEN,
+    PROFILE_INTERVAL,
+    ProfilerBusy,
+    get_slow_log,
+    sample_stacks,
+    start_tracemalloc,
+)
+from .qos import begin_request, current_mode, current_policy, get_qos
+from .scheduler import CONFIRMATION, TEXT, get_scheduler
+from .sessions import close_session_store, get_session_store
+from .usage import usage_report
+from .warmup import get_readiness
+from .deadline import (
+    DeadlineExceeded,
+    current_deadline,
+    stage_timeout,
+    start_deadline,
+    track_stage,
+)
+from .payment import (
+    DEFAULT_ASSET_CODE,
+    DEFAULT_ASSET_SCALE,
+    close_payment_client,
+    send_payment_async,
+    send_payments_batch,
+)
 import os
-import json
+import asyncio
 import time
 import tempfile
 import base64
+import hmac
+import uuid
+from contextlib import asynccontextmanager
 from pathlib import Path
 from dotenv import load_dotenv
+import orjson
 import requests
 
 # Cargar variables de entorno desde .env si existe
@@ -18,7 +72,46 @@ project_root = os.path.abspath(os.path.join(
 env_path = os.path.join(project_root, ".env")
 load_dotenv(env_path)
 
-app = FastAPI(title="WhatsApp LLM API", version="1.0.0")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """
+    Arranque: aviso si falta ffmpeg, despachador del outbox (retoma los pagos
+    pendientes) y calentamiento en segundo plano; /ready responde 503 hasta
+    que termina.
+    Apagado: detiene ambos, escribe las transacciones pendientes y cierra los
+    pools de conexiones.
+    """
+    start_tracemalloc()
+    check_decoder()
+    tasks = [asyncio.create_task(get_readiness().run())]
+    if PAYMENT_OUTBOX_ENABLED:
+        tasks.append(asyncio.create_task(get_outbox().run()))
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        close_ledger()
+        close_session_store()
+        close_key_pool()
+        await close_payment_client()
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse serializada con orjson."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+app = FastAPI(
+    title="WhatsApp LLM API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
+)
 
 VERIFY_TOKEN = os.getenv("WHATSAPP_VERIFY_TOKEN", "whatsapp-verify-token")
 
@@ -35,6 +128,13 @@ class WhatsAppMessage(BaseModel):
     message: str
     identity_key_hash: Optional[str] = None
     media: Optional[List[MediaItem]] = None
+    # Datos opacos de ws_bot que se devuelven tal cual en el aviso del pago
+    reply_context: Optional[Dict[str, Any]] = None
+
+
+class SessionLanguage(BaseModel):
+    """Idioma elegido por el usuario en ws_bot"""
+    language: str
 
 
 class LLMResponse(BaseModel):
@@ -49,10 +149,16 @@ class LLMResponse(BaseModel):
     payment_payload: Optional[Dict[str, Any]] = None
     payment_status: Optional[Dict[str, Any]] = None
     payment_confirmation: Optional[Dict[str, Any]] = None
+    payments: Optional[List[Dict[str, Any]]] = None  # Resultados cuando hay varios destinatarios
+    mode: str = "normal"  # Modo de servicio con el que se atendió (normal, degraded, critical)
 
 
 AUDIO_OUTPUT_DIR = Path(__file__).resolve().parent / "audio_responses"
 AUDIO_OUTPUT_DIR.mkdir(exist_ok=True)
+# Los audios se borran cuando ya venció su URL firmada (con un margen)
+AUDIO_RETENTION_SECONDS = MEDIA_URL_TTL_SECONDS + 60
+AUDIO_PRUNE_INTERVAL_SECONDS = 300
+_last_audio_prune = 0.0
 
 
 def _is_remote_url(path: str) -> bool:
@@ -78,8 +184,9 @@ def _is_image_source(source: str) -> bool:
 
 
 def _download_to_temp(url: str, suffix: str) -> str:
-    response = requests.get(url, timeout=30)
-    response.raise_for_status()
+    with track_stage("download"):
+        response = requests.get(url, timeout=stage_timeout("download", 30))
+        response.raise_for_status()
     fd, temp_path = tempfile.mkstemp(suffix=suffix)
     with os.fdopen(fd, "wb") as tmp:
         tmp.write(response.content)
@@ -87,7 +194,12 @@ def _download_to_temp(url: str, suffix: str) -> str:
 
 
 def _transcribe_audio(source: str) -> str:
-    client = get_client()
+    """
+    Transcribe una nota de voz.
+
+    El audio se pre-procesa (contenedor real, recorte de silencios y trozos
+    partidos en pausas) y los trozos se transcriben en paralelo.
+    """
     temp_path = None
     file_path = source
 
@@ -98,40 +210,75 @@ def _transcribe_audio(source: str) -> str:
         file_path = temp_path
 
     try:
-        with open(file_path, "rb") as audio_file:
-            transcription = client.audio.transcriptions.create(
-                model="gpt-4o-transcribe",
-                file=audio_file,
-                response_format="text",
-                language="es",
-            )
-        return transcription.strip()
+        with track_stage("audio_preprocessing"):
+            prepared = prepare_audio(file_path)
+        metrics.inc("audio.chunks", len(prepared.chunks))
+        if prepared.original_seconds:
+            metrics.inc("audio.seconds_trimmed",
+                        prepared.original_seconds - prepared.trimmed_seconds)
+
+        # Los hilos del pool no heredan el contexto: el timeout se calcula aquí
+        timeout = stage_timeout("transcription", 60)
+
+        def transcribe_chunk(chunk: AudioChunk) -> str:
+            # Cada trozo toma la key con más margen del pool
+            with openai_breaker.guard():
+                return get_client().with_options(timeout=timeout).audio.transcriptions.create(
+                    model="gpt-4o-transcribe",
+                    file=(chunk.filename, chunk.content),
+                    response_format="text",
+                    language="es",
+                )
+
+        return transcribe_chunks(prepared.chunks, transcribe_chunk)
     finally:
         if temp_path and os.path.exists(temp_path):
             os.remove(temp_path)
 
 
 def _synthesize_audio_response(text: str) -> str:
-    client = get_client()
-    timestamp = int(time.time())
-    filename = AUDIO_OUTPUT_DIR / f"respuesta_{timestamp}.mp3"
-
-    response = client.audio.speech.create(
-        model="gpt-4o-mini-tts",
-        voice="coral",
-        input=text,
-    )
+    """
+    Sintetiza la respuesta en audio, con las oraciones en paralelo.
+
+    Returns:
+        URL firmada de corta duración en /audio/{id} para descargar el MP3
+    """
+    file_id = f"respuesta_{uuid.uuid4().hex}"
+    filename = AUDIO_OUTPUT_DIR / f"{file_id}.mp3"
+
+    stream = openai_speech_stream(get_client, timeout=stage_timeout("tts", 30))
+    synthesize_to_file(text, filename, stream)
+    _prune_audio_responses()
+
+    return signed_url("audio", file_id)
 
-    with open(filename, "wb") as audio_file:
-        audio_file.write(response.content)
 
-    return f"file://{filename.absolute()}"
+def _prune_audio_responses(force: bool = False) -> int:
+    """Borra los audios de respuesta cuya URL firmada ya venció."""
+    global _last_audio_prune
+    now = time.time()
+    if not force and now - _last_audio_prune < AUDIO_PRUNE_INTERVAL_SECONDS:
+        return 0
+    _last_audio_prune = now
+    removed = 0
+    for path in AUDIO_OUTPUT_DIR.glob("*.mp3"):
+        try:
+            if now - path.stat().st_mtime > AUDIO_RETENTION_SECONDS:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            continue
+    if removed:
+        metrics.inc("audio.responses_pruned", removed)
+    return removed
 
 
 def _encode_image_to_base64(source: str) -> Dict[str, str]:
     if _is_remote_url(source):
-        response = requests.get(source, timeout=30)
-        response.raise_for_status()
+        with track_stage("download"):
+            response = requests.get(
+                source, timeout=stage_timeout("download", 30))
+            response.raise_for_status()
         content = response.content
         path = source.split("?")[0]
     else:
@@ -152,78 +299,9 @@ def _encode_image_to_base64(source: str) -> Dict[str, str]:
     return {"data": encoded, "mime": mime_type, "is_remote": _is_remote_url(source), "original": source}
 
 
-def _parse_json_text(text: str) -> Dict[str, Any]:
-    candidate = text.strip()
-    if "```json" in candidate:
-        start = candidate.find("```json") + 7
-        end = candidate.find("```", start)
-        candidate = candidate[start:end].strip()
-    elif "```" in candidate:
-        start = candidate.find("```") + 3
-        end = candidate.find("```", start)
-        candidate = candidate[start:end].strip()
-
-    try:
-        data = json.loads(candidate)
-        return data if isinstance(data, dict) else {}
-    except json.JSONDecodeError:
-        return {}
-
-
-SPANISH_NUMBER_MAP = {
-    "cero": "0",
-    "uno": "1",
-    "una": "1",
-    "dos": "2",
-    "tres": "3",
-    "cuatro": "4",
-    "cinco": "5",
-    "seis": "6",
-    "siete": "7",
-    "ocho": "8",
-    "nueve": "9",
-    "diez": "10",
-}
-
-
-def _normalize_account_text(value: str) -> str:
-    words = value.lower().strip().split()
-    digits: List[str] = []
-
-    for w in words:
-        w_clean = "".join(ch for ch in w if ch.isalnum())
-        if not w_clean:
-            continue
-        if w_clean.isdigit():
-            digits.append(w_clean)
-        elif w_clean in SPANISH_NUMBER_MAP:
-            digits.append(SPANISH_NUMBER_MAP[w_clean])
-
-    if digits:
-        return "".join(digits)
-
-    return value.strip()
-
-# file:///Users/misaelalvarezcamarillo/Desktop/misil.jpg
-
-
 def _analyze_image(source: str) -> Dict[str, Any]:
     image_info = _encode_image_to_base64(source)
-    prompt = (
-        "Analiza el ticket y devuelve únicamente un JSON en este formato exacto:\n"
-        "{\n"
-        '  "monto": numero,\n'
-        '  "destinatario": "string"\n'
-        "}\n"
-        "- \"monto\" debe ser un número (sin símbolo de moneda).\n"
-        "- \"destinatario\" debe ser el número de cuenta o link de wallet/billetera"
-        "- No escribas números con palabras; siempre usa dígitos.\n"
-        "- Si no encuentras alguno de los datos, usa null.\n"
-        "- No incluyas texto adicional fuera del JSON.\n"
-        "- Si hay múltiples números, elige el que represente la cuenta/wallet."
-    )
-
-    client = get_client()
+    router = get_router()
     if image_info["is_remote"]:
         image_payload = {
             "type": "input_image",
@@ -235,54 +313,100 @@ def _analyze_image(source: str) -> Dict[str, Any]:
             "type": "input_image",
             "image_url": data_url,
         }
-    response = client.responses.create(
-        model="gpt-4o",
-        input=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "input_text", "text": prompt},
-                    image_payload,
-                ],
-            }
-        ],
+    response = router.call(
+        router.select("vision", media_type="image"),
+        lambda model, timeout: get_client().with_options(timeout=timeout, max_retries=0).responses.parse(
+            model=model,
+            input=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "input_text", "text": VISION_PROMPT},
+                        image_payload,
+                    ],
+                }
+            ],
+            text_format=TicketData,
+        ),
     )
 
-    parsed = _parse_json_text(response.output_text)
-    monto = parsed.get("monto")
-    destinatario = parsed.get("destinatario")
-
-    try:
-        if isinstance(monto, str):
-            monto = float(monto.replace("$", "").replace(",", "").strip())
-    except (ValueError, AttributeError):
-        monto = None
-
-    if isinstance(destinatario, str):
-        destinatario = _normalize_account_text(destinatario) or None
+    # Validado contra TicketData por el SDK; None si el modelo se negó
+    ticket = response.output_parsed or TicketData()
+    return ticket.model_dump()
 
-    return {"monto": monto, "destinatario": destinatario}
 
-
-def _load_system_prompt() -> Optional[str]:
-    system_prompt_path = os.path.join(
-        os.path.dirname(__file__),
-        "agent",
-        "system_prompt.md",
-    )
-    if os.path.exists(system_prompt_path):
-        with open(system_prompt_path, "r", encoding="utf-8") as f:
-            return f.read().strip()
-    return None
+async def _iter_whatsapp_events(
+    wa_id: str,
+    name: str,
+    message: str,
+    media: Optional[List[Dict[str, str]]] = None,
+    reply_context: Optional[Dict[str, Any]] = None,
+) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Eventos de ``_whatsapp_events``; si la petición tarda más que
+    SLOW_REQUEST_SECONDS (con éxito o no) queda en /admin/slow-requests con
+    el tiempo de cada etapa.
+    """
+    deadline = current_deadline() or start_deadline()
+    events: List[str] = []
+    error = None
+    try:
+        async for event, data in _whatsapp_events(wa_id, name, message, media, reply_context):
+            events.append(event)
+            yield event, data
+    except BaseException as exc:
+        error = type(exc).__name__
+        raise
+    finally:
+        get_slow_log().observe(
+            deadline,
+            wa_id=wa_id,
+            media=[item.get("type") for item in media or []],
+            mode=current_mode(),
+            events=events,
+            error=error,
+        )
 
 
-async def _handle_whatsapp_message(
+async def _whatsapp_events(
     wa_id: str,
     name: str,
     message: str,
     media: Optional[List[Dict[str, str]]] = None,
-) -> Dict[str, Any]:
-    system_prompt = _load_system_prompt()
+    reply_context: Optional[Dict[str, Any]] = None,
+) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Procesa un mensaje de WhatsApp emitiendo cada resultado en cuanto está listo.
+
+    Eventos emitidos, en orden: "response" (texto conversacional y datos
+    extraídos), "audio_url", "payment_payload", "payment_status" y
+    "payment_confirmation". Si el mensaje pide pagos a varios destinatarios,
+    en lugar de los eventos de pago se emite uno solo, "payments", con los
+    resultados en orden. Los eventos que no aplican se omiten.
+
+    Con el outbox de pagos activo (PAYMENT_OUTBOX_ENABLED) los pagos solo se
+    encolan: su estado es "queued" y la URL de confirmación llega a ws_bot
+    después, por el despachador, junto con reply_context.
+
+    Las llamadas bloqueantes (OpenAI, descargas) se ejecutan en hilos para no
+    detener el event loop mientras se transmite la respuesta; pasan por el
+    planificador (scheduler.py) en la cola de la clase del mensaje (texto,
+    audio o imagen), y el pago en la de confirmación. Cada etapa
+    consume el deadline de la petición (se crea uno si no hay activo) y se
+    cancela al agotarse.
+
+    La conversación de cada wa_id (sessions.py) aporta el idioma, los datos
+    de un pago que quedó incompleto en un mensaje anterior y un resumen de
+    los turnos previos; se guarda justo antes de emitir "response".
+
+    El modo de servicio (qos.py) se decide al inicio y viaja en "response"
+    como ``mode``; con el servicio degradado las notas de voz se responden
+    solo con texto y no se emite "audio_url".
+    """
+    deadline = current_deadline() or start_deadline()
+    mode = begin_request()
+    sessions = get_session_store()
+    session = await asyncio.to_thread(sessions.get, wa_id)
 
     user_message = message or ""
     audio_input = False
@@ -306,109 +430,258 @@ async def _handle_whatsapp_message(
                 selected_media_url = media_url
                 break
 
+    if selected_media_url:
+        # Medios subidos por ws_bot a /media: leerlos del almacén local
+        selected_media_url = resolve_media_source(selected_media_url)
+
+    if not selected_media_url:
+        if _is_audio_source(message):
+            selected_media_type, selected_media_url = "audio", message
+        elif _is_image_source(message):
+            selected_media_type, selected_media_url = "image", message
+
+    # Todas las etapas del mensaje se encolan en la clase de su medio
+    scheduler = get_scheduler()
+    work_class = selected_media_type or TEXT
+
     if selected_media_type == "audio":
         audio_input = True
-        user_message = _transcribe_audio(selected_media_url)
+        user_message = await deadline.run("transcription", scheduler.run(
+            work_class, _transcribe_audio, selected_media_url))
     elif selected_media_type == "image":
         image_input = True
-        image_analysis = _analyze_image(selected_media_url)
-        summary_parts = []
-        monto = image_analysis.get("monto")
-        destinatario = image_analysis.get("destinatario")
-        if monto is not None:
-            summary_parts.append(f"un monto aproximado de ${monto:,.2f}")
-        if destinatario:
-            summary_parts.append(
-                f"una cuenta o wallet con número {destinatario}")
-        summary = ", ".join(
-            summary_parts) if summary_parts else "sin datos claros"
-        user_message = (
-            "El usuario envió un ticket de compra. "
-            f"Se identificó {summary}. "
-            "Confirma la transacción al usuario con un mensaje claro."
-        )
-    elif _is_audio_source(message):
-        audio_input = True
-        user_message = _transcribe_audio(message)
-    elif _is_image_source(message):
-        image_input = True
-        image_analysis = _analyze_image(message)
-        summary_parts = []
-        monto = image_analysis.get("monto")
-        destinatario = image_analysis.get("destinatario")
-        if monto is not None:
-            summary_parts.append(f"un monto aproximado de ${monto:,.2f}")
-        if destinatario:
-            summary_parts.append(
-                f"una cuenta o wallet con número {destinatario}")
-        summary = ", ".join(
-            summary_parts) if summary_parts else "sin datos claros"
-        user_message = (
-            "El usuario envió un ticket de compra. "
-            f"Se identificó {summary}. "
-            "Confirma la transacción al usuario con un mensaje claro."
-        )
-
-    result = process_message_with_extraction(user_message, system_prompt)
+        image_analysis = await deadline.run("vision", scheduler.run(
+            work_class, _analyze_image, selected_media_url))
+        user_message = _describe_image_analysis(image_analysis)
+
+    result = await deadline.run("extraction", scheduler.run(
+        work_class, process_message_with_extraction, user_message,
+        media_type=selected_media_type, context=session.context()))
+    get_qos().observe_latency(deadline.stages.get("extraction", 0.0))
     monto = result.get("monto")
     destinatario = result.get("destinatario")
     response_text = result.get("response", "")
-
-    # Normalizar destinatario a dígitos si es posible
-    if isinstance(destinatario, str):
-        destinatario = _normalize_account_text(destinatario) or None
+    pagos = [dict(pago) for pago in result.get("pagos") or []]
+
+    # Completar con lo dicho antes ("manda 200" y luego "a 5512345678", o
+    # "a Ana y a Beto"): cada pago de la lista toma los datos que le falten
+    if monto is None and session.monto is not None:
+        monto = session.monto
+        metrics.inc("sessions.slots_filled")
+    if not destinatario and session.destinatario:
+        destinatario = session.destinatario
+        metrics.inc("sessions.slots_filled")
+    for pago in pagos:
+        if pago.get("monto") is None and session.monto is not None:
+            pago["monto"] = session.monto
+            metrics.inc("sessions.slots_filled")
+    if not pagos and monto is not None and destinatario:
+        pagos = [{"monto": monto, "destinatario": destinatario}]
+    # El destinatario ya viene normalizado a dígitos por PaymentExtraction
+    pagos = [
+        (pago["monto"], pago["destinatario"]) for pago in pagos
+        if pago.get("monto") is not None and pago.get("destinatario")
+    ]
+
+    # El pedido de confirmación de un turno anterior ya va en el contexto
+    session.unconfirmed = []
+    matches = await asyncio.to_thread(
+        _resolve_recipients, [pago_destinatario for _, pago_destinatario in pagos])
+    if any(match and not match.exact for match in matches):
+        # Un destinatario aproximado (fonético o difuso) puede ser otra
+        # persona: no se envía nada hasta que el usuario confirme el nombre
+        session.unconfirmed = [
+            [pago_monto, match.name if match else pago_destinatario]
+            for (pago_monto, pago_destinatario), match in zip(pagos, matches)
+        ]
+        response_text = _confirmation_request(session.unconfirmed)
+        metrics.inc("directory.confirmation_requested")
+        pagos, matches = [], []
 
     # Ajustar la respuesta para asegurarnos de que incluya los datos numéricos
+    # y el nombre completo del destinatario resuelto
     additions = []
-    if monto is not None and f"{monto}" not in response_text:
-        additions.append(f"monto ${monto:,.2f}")
-    if destinatario and destinatario not in response_text:
-        additions.append(f"cuenta {destinatario}")
+    if len(pagos) > 1:
+        for (pago_monto, pago_destinatario), match in zip(pagos, matches):
+            label = match.name if match else pago_destinatario
+            if label not in response_text:
+                additions.append(f"${pago_monto:,.2f} a {label}")
+    elif not session.unconfirmed:
+        match = matches[0] if matches else None
+        if monto is not None and f"{monto}" not in response_text:
+            additions.append(f"monto ${monto:,.2f}")
+        if destinatario and destinatario not in response_text and not (match and match.method == "name"):
+            additions.append(f"cuenta {destinatario}")
+        if match and match.name not in response_text:
+            additions.append(f"destinatario {match.name}")
     if additions:
         response_text = response_text.rstrip(". ")
         response_text += ". " + \
             " ".join(f"Confirmo {item}." for item in additions)
 
-    response_payload: Dict[str, Any] = {
+    # Se guarda antes del primer evento: si el cliente de /stream se desconecta
+    # al recibirlo, el generador se cierra y no se perdería el turno
+    session.remember_payment(monto, destinatario)
+    session.add_turn(user_message, response_text)
+    await asyncio.to_thread(sessions.save, session)
+
+    yield "response", {
         "monto": monto,
         "destinatario": destinatario,
         "response": response_text,
+        "image_analysis": image_analysis,
+        "mode": mode,
+    }
+
+    if audio_input and response_text and current_policy().skip_tts:
+        metrics.inc("qos.shed.tts")
+    elif audio_input and response_text:
+        audio_url = await deadline.run("tts", scheduler.run(
+            work_class, _synthesize_audio_response, response_text))
+        yield "audio_url", audio_url
+
+    payloads = [
+        _build_payment_payload(
+            wa_id, pago_monto, match.receiver if match else pago_destinatario)
+        for (pago_monto, pago_destinatario), match in zip(pagos, matches)
+    ]
+    if not payloads:
+        return
+    if PAYMENT_OUTBOX_ENABLED:
+        # Solo se guarda la intención; el despachador envía el pago y avisa a ws_bot
+        keys = await scheduler.run(
+            CONFIRMATION,
+            get_outbox().enqueue,
+            wa_id,
+            [(pago_destinatario, payload) for (_, pago_destinatario), payload in zip(pagos, payloads)],
+            reply_context,
+        )
+        payment_results = [
+            {"status": "queued", "payload": payload, "idempotency_key": key}
+            for payload, key in zip(payloads, keys)
+        ]
+        if len(payloads) == 1:
+            yield "payment_payload", payloads[0]
+            yield "payment_status", payment_results[0]
+        else:
+            yield "payments", payment_results
+    elif len(payloads) == 1:
+        payment_payload = payloads[0]
+        yield "payment_payload", payment_payload
+        async with scheduler.slot(CONFIRMATION):
+            payment_result = await deadline.run(
+                "payment", send_payment_async(payment_payload, idempotency_key=uuid.uuid4().hex))
+        # La escritura a la bitácora ocurre en segundo plano, por lotes
+        get_ledger().record(transaction_row(
+            wa_id, pagos[0][1], payment_payload, payment_result))
+        yield "payment_status", payment_result
+
+        confirmation = payment_result.get("service_response") if isinstance(
+            payment_result, dict) else None
+        if confirmation and isinstance(confirmation, dict):
+            yield "payment_confirmation", confirmation
+    else:
+        # Varios destinatarios: se envían en paralelo y los resultados
+        # conservan el orden del mensaje
+        async with scheduler.slot(CONFIRMATION):
+            payment_results = await deadline.run(
+                "payment", send_payments_batch(payloads))
+        for (_, pago_destinatario), payload, payment_result in zip(pagos, payloads, payment_results):
+            get_ledger().record(transaction_row(
+                wa_id, pago_destinatario, payload, payment_result))
+        yield "payments", payment_results
+
+
+def _resolve_recipients(destinatarios: List[str]) -> List[Optional[RecipientMatch]]:
+    """
+    Resuelve los destinatarios contra el directorio local (cuenta, nombre,
+    fonética o trigramas); None si no aparece y se envía tal cual.
+    """
+    directory = get_directory()
+    matches = [directory.resolve(destinatario) for destinatario in destinatarios]
+    for match in matches:
+        metrics.inc(f"directory.{match.method if match else 'miss'}")
+    return matches
+
+
+def _confirmation_request(unconfirmed: List[List[Any]]) -> str:
+    pagos = ", ".join(f"${monto:,.2f} a {nombre}" for monto, nombre in unconfirmed)
+    return (
+        f"¿Quieres enviar {pagos}? No encontré exactamente el nombre que "
+        "escribiste; responde «sí» para confirmar o dime el nombre o la cuenta correctos."
+    )
+
+
+def _build_payment_payload(wa_id: str, monto: Any, receiver: str) -> Dict[str, Any]:
+    try:
+        amount_major = float(monto)
+        amount_value = str(
+            int(round(amount_major * (10 ** DEFAULT_ASSET_SCALE))))
+    except (ValueError, TypeError):
+        amount_value = str(monto)
+    return {
+        "senderWalletUrl": wa_id,
+        "receiverWalletUrl": receiver,
+        "amount": amount_value,
+        "assetCode": DEFAULT_ASSET_CODE,
+        "assetScale": DEFAULT_ASSET_SCALE,
+    }
+
+
+def _describe_image_analysis(image_analysis: Dict[str, Any]) -> str:
+    summary_parts = []
+    monto = image_analysis.get("monto")
+    destinatario = image_analysis.get("destinatario")
+    if monto is not None:
+        summary_parts.append(f"un monto aproximado de ${monto:,.2f}")
+    if destinatario:
+        summary_parts.append(
+            f"una cuenta o wallet con número {destinatario}")
+    summary = ", ".join(
+        summary_parts) if summary_parts else "sin datos claros"
+    return (
+        "El usuario envió un ticket de compra. "
+        f"Se identificó {summary}. "
+        "Confirma la transacción al usuario con un mensaje claro."
+    )
+
+
+async def _handle_whatsapp_message(
+    wa_id: str,
+    name: str,
+    message: str,
+    media: Optional[List[Dict[str, str]]] = None,
+    reply_context: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    response_payload: Dict[str, Any] = {
+        "monto": None,
+        "destinatario": None,
+        "response": "",
         "wa_id": wa_id,
         "name": name,
         "audio_url": None,
-        "image_analysis": image_analysis,
+        "image_analysis": None,
         "payment_payload": None,
         "payment_status": None,
     }
 
-    if audio_input and response_payload["response"]:
-        response_payload["audio_url"] = _synthesize_audio_response(
-            response_payload["response"])
+    async for event, data in _iter_whatsapp_events(wa_id, name, message, media, reply_context):
+        if event == "response":
+            response_payload.update(data)
+        else:
+            response_payload[event] = data
 
-    if monto is not None and destinatario:
-        try:
-            amount_major = float(monto)
-            amount_value = str(
-                int(round(amount_major * (10 ** DEFAULT_ASSET_SCALE))))
-        except (ValueError, TypeError):
-            amount_value = str(monto)
-        payment_payload = {
-            "senderWalletUrl": wa_id,
-            "receiverWalletUrl": destinatario,
-            "amount": amount_value,
-            "assetCode": DEFAULT_ASSET_CODE,
-            "assetScale": DEFAULT_ASSET_SCALE,
-        }
-        response_payload["payment_payload"] = payment_payload
-        payment_result = await send_payment_async(payment_payload)
-        response_payload["payment_status"] = payment_result
+    return response_payload
 
-        confirmation = payment_result.get("service_response") if isinstance(
-            payment_result, dict) else None
-        if confirmation and isinstance(confirmation, dict):
-            response_payload["payment_confirmation"] = confirmation
 
-    return response_payload
+def _unavailable_payload(wa_id: str, name: str) -> Dict[str, Any]:
+    """Respuesta amigable cuando una dependencia tiene el breaker abierto."""
+    return LLMResponse(
+        response=UNAVAILABLE_MESSAGE, wa_id=wa_id, name=name).model_dump()
+
+
+def _ndjson_line(event: str, data: Any) -> bytes:
+    return orjson.dumps({"event": event, "data": data}, option=orjson.OPT_APPEND_NEWLINE)
 
 
 @app.get("/")
@@ -417,6 +690,153 @@ async def root():
     return {"status": "ok", "message": "WhatsApp LLM API is running"}
 
 
+@app.get("/ready")
+async def ready():
+    """
+    Readiness: 200 solo cuando terminó el calentamiento y el servicio de pagos
+    responde (resultado en caché por READY_CACHE_SECONDS). OpenAI se sondea
+    solo al calentar; su resultado se reporta como informativo y no decide.
+    """
+    report = await get_readiness().report()
+    if not report["ready"]:
+        return FastJSONResponse(report, status_code=503)
+    return report
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Métricas internas del servicio (contadores, gauges, latencias y router)"""
+    data = metrics.snapshot()
+    data["router"] = get_router().stats()
+    data["breakers"] = breaker_states()
+    data["openai_keys"] = key_pool_stats()
+    data["scheduler"] = get_scheduler().stats()
+    data["qos"] = get_qos().stats()
+    data["sessions"] = get_session_store().stats()
+    return data
+
+
+def _require_admin(token: Optional[str]) -> None:
+    """Los endpoints /admin solo existen con ADMIN_TOKEN configurado."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not token or not hmac.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Token de administración inválido")
+
+
+@app.get("/admin/profile", response_class=PlainTextResponse)
+async def admin_profile(
+    seconds: float = Query(10, gt=0),
+    interval: float = Query(PROFILE_INTERVAL, gt=0),
+    idle: bool = False,
+    x_admin_token: Optional[str] = Header(None),
+):
+    """
+    Perfila el proceso por muestreo durante ``seconds`` segundos.
+
+    Responde las pilas en formato colapsado (una por línea con su número de
+    muestras), listo para flamegraph.pl, speedscope o inferno. Con
+    ``idle=true`` incluye los hilos que solo están esperando.
+    """
+    _require_admin(x_admin_token)
+    try:
+        collapsed, samples = await asyncio.to_thread(sample_stacks, seconds, interval, idle)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(collapsed + "\n", headers={"X-Profile-Samples": str(samples)})
+
+
+@app.get("/admin/slow-requests")
+async def admin_slow_requests(
+    limit: int = Query(20, ge=1),
+    x_admin_token: Optional[str] = Header(None),
+):
+    """Peticiones más lentas que SLOW_REQUEST_SECONDS, de la más reciente a la más antigua"""
+    _require_admin(x_admin_token)
+    slow_log = get_slow_log()
+    return {"threshold": slow_log.threshold, "items": slow_log.recent(limit)}
+
+
+@app.get("/usage")
+async def get_usage(hours: float = Query(24, gt=0)):
+    """Tokens y costo estimado de las llamadas a OpenAI por etapa y modelo"""
+    report = await asyncio.to_thread(usage_report, time.time() - hours * 3600)
+    return {
+        "hours": hours,
+        "stages": report,
+        "cost_usd": round(sum(row["cost_usd"] or 0 for row in report), 6),
+    }
+
+
+@app.put("/sessions/{wa_id}/language")
+async def set_session_language(wa_id: str, body: SessionLanguage):
+    """Guarda el idioma elegido en ws_bot; las respuestas siguientes lo usan"""
+    session = await asyncio.to_thread(get_session_store().set_language, wa_id, body.language)
+    return {"wa_id": wa_id, "language": session.language}
+
+
+@app.get("/transactions/{wa_id}")
+async def list_transactions(
+    wa_id: str,
+    limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+):
+    """
+    Transacciones recientes de un usuario, de la más reciente a la más antigua.
+
+    La respuesta incluye ``next_cursor``; se envía como ``cursor`` para pedir
+    la página siguiente (None en la última).
+    """
+    try:
+        page = await asyncio.to_thread(get_ledger().recent, wa_id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"wa_id": wa_id, "items": page.items, "next_cursor": page.next_cursor}
+
+
+@app.put("/media", status_code=201)
+async def upload_media(request: Request, content_type: Optional[str] = Header(None)):
+    """
+    Recibe un medio (imagen o audio) como cuerpo crudo en streaming.
+
+    El archivo se guarda por su hash SHA-256; la respuesta incluye el
+    ``source`` (``media://<id>``) que debe enviarse en ``media`` del webhook.
+    """
+    try:
+        media_id = await store_stream(request.stream(), content_type)
+    except MediaTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return {"id": media_id, "source": f"{MEDIA_SCHEME}{media_id}"}
+
+
+@app.api_route("/audio/{signed_id}", methods=["GET", "HEAD"])
+async def get_audio(signed_id: str, if_none_match: Optional[str] = Header(None)):
+    """
+    Sirve un audio de respuesta (TTS) a partir de un id firmado.
+
+    Soporta peticiones Range (descarga parcial/reanudable), ETag con
+    If-None-Match y Cache-Control hasta que vence el id. Si el servidor ASGI
+    ofrece la extensión http.response.pathsend, el archivo se envía sin
+    copiarlo a memoria.
+    """
+    file_id, remaining = verify_signed_id(signed_id)
+    if file_id is None:
+        raise HTTPException(status_code=404, detail="Audio no encontrado o expirado")
+    path = AUDIO_OUTPUT_DIR / f"{file_id}.mp3"
+    try:
+        stat_result = path.stat()
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Audio no encontrado o expirado")
+
+    headers = {"Cache-Control": f"private, max-age={remaining}, immutable"}
+    response = FileResponse(
+        path, media_type="audio/mpeg", headers=headers, stat_result=stat_result)
+    etag = response.headers.get("etag")
+    if if_none_match and etag and etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers={**headers, "ETag": etag})
+    return response
+
+
 @app.get("/webhook/whatsapp")
 async def verify_webhook(
     mode: Optional[str] = Query(None, alias="hub.mode"),
@@ -433,7 +853,10 @@ async def verify_webhook(
 
 
 @app.post("/webhook/whatsapp", response_model=LLMResponse)
-async def receive_whatsapp_message(message: WhatsAppMessage):
+async def receive_whatsapp_message(
+    message: WhatsAppMessage,
+    x_request_budget: Optional[float] = Header(None),
+):
     """
     Endpoint para recibir mensajes de WhatsApp y procesarlos con el LLM.
 
@@ -444,8 +867,12 @@ async def receive_whatsapp_message(message: WhatsAppMessage):
         "message": "capital dem mexicox?",
         "identity_key_hash": null
     }
+
+    El header opcional X-Request-Budget (segundos) fija el presupuesto total
+    de la petición; por defecto se usa REQUEST_BUDGET_SECONDS.
     """
     try:
+        start_deadline(x_request_budget)
         media_payload = None
         if message.media:
             media_payload = [item.dict() for item in message.media]
@@ -455,21 +882,81 @@ async def receive_whatsapp_message(message: WhatsAppMessage):
             name=message.name,
             message=message.message,
             media=media_payload,
+            reply_context=message.reply_context,
         )
         return LLMResponse(**response_payload)
 
+    except CircuitOpenError:
+        return LLMResponse(**_unavailable_payload(message.wa_id, message.name))
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error processing message: {str(e)}")
 
 
+@app.post("/webhook/whatsapp/stream")
+async def receive_whatsapp_message_stream(
+    message: WhatsAppMessage,
+    x_request_budget: Optional[float] = Header(None),
+):
+    """
+    Variante en streaming de /webhook/whatsapp (NDJSON, un evento por línea).
+
+    Emite {"event": "response", ...} en cuanto el LLM genera la respuesta
+    conversacional y después los eventos "audio_url", "payment_payload",
+    "payment_status" y "payment_confirmation" (o "payments") conforme se completan. El último
+    evento es "done" con la respuesta completa (mismo formato que LLMResponse)
+    o "error" si algo falla.
+    """
+    media_payload = None
+    if message.media:
+        media_payload = [item.dict() for item in message.media]
+
+    async def event_stream() -> AsyncIterator[bytes]:
+        response_payload: Dict[str, Any] = {
+            "wa_id": message.wa_id,
+            "name": message.name,
+        }
+        start_deadline(x_request_budget)
+        try:
+            async for event, data in _iter_whatsapp_events(
+                wa_id=message.wa_id,
+                name=message.name,
+                message=message.message,
+                media=media_payload,
+                reply_context=message.reply_context,
+            ):
+                if event == "response":
+                    response_payload.update(data)
+                else:
+                    response_payload[event] = data
+                yield _ndjson_line(event, data)
+            done = LLMResponse(**response_payload)
+            yield _ndjson_line("done", done.model_dump())
+        except CircuitOpenError:
+            unavailable = _unavailable_payload(message.wa_id, message.name)
+            yield _ndjson_line("response", {"response": unavailable["response"]})
+            yield _ndjson_line("done", unavailable)
+        except DeadlineExceeded as e:
+            yield _ndjson_line("error", {"detail": str(e), "stage": e.stage})
+        except Exception as e:
+            yield _ndjson_line("error", {"detail": f"Error processing message: {str(e)}"})
+
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+
 @app.post("/webhook/whatsapp/raw")
-async def receive_whatsapp_message_raw(message: dict):
+async def receive_whatsapp_message_raw(
+    message: dict,
+    x_request_budget: Optional[float] = Header(None),
+):
     """
     Endpoint alternativo que acepta el formato raw del mensaje de WhatsApp.
     Útil si el mensaje viene en un formato diferente.
     """
     try:
+        start_deadline(x_request_budget)
         # Extraer información del mensaje
         wa_id = message.get("wa_id", "unknown")
         name = message.get("name", "Unknown User")
@@ -484,10 +971,15 @@ async def receive_whatsapp_message_raw(message: dict):
             name=name,
             message=message_text,
             media=media_payload,
+            reply_context=message.get("reply_context"),
         )
 
         return response_payload
 
+    except CircuitOpenError:
+        return _unavailable_payload(wa_id, name)
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error processing message: {str(e)}")
@@ -0,0 +1,124 @@
+"""
+Almacén local de medios direccionado por contenido.
+
+ws_bot sube las imágenes y notas de voz directamente (PUT /media) y recibe un
+``source`` de la forma ``media://<sha256>.<ext>``. Así los bytes cruzan la red
+interna una sola vez, en lugar de que llm_back (u OpenAI) los vuelva a bajar
+desde el túnel público de ngrok. Los archivos se borran al cumplir
+MEDIA_RETENTION_SECONDS.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import tempfile
+import time
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+MEDIA_SCHEME = "media://"
+MEDIA_STORE_DIR = Path(os.getenv(
+    "MEDIA_STORE_DIR", Path(__file__).resolve().parent / "media_store"))
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(25 * 1024 * 1024)))
+MEDIA_RETENTION_SECONDS = int(os.getenv("MEDIA_RETENTION_SECONDS", str(6 * 3600)))
+# Intervalo mínimo entre limpiezas (se ejecutan al recibir nuevas subidas)
+CLEANUP_INTERVAL_SECONDS = 300
+
+_EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/gif": "gif",
+    "audio/ogg": "ogg",
+    "audio/opus": "ogg",
+    "audio/mpeg": "mp3",
+    "audio/mp4": "m4a",
+    "audio/aac": "aac",
+    "audio/amr": "amr",
+    "audio/wav": "wav",
+    "audio/x-wav": "wav",
+}
+_MEDIA_ID_PATTERN = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]{1,5}$")
+_last_cleanup = 0.0
+
+
+class MediaTooLarge(Exception):
+    """La subida excede MEDIA_MAX_BYTES."""
+
+
+def extension_for(content_type: Optional[str]) -> str:
+    base = (content_type or "").split(";")[0].strip().lower()
+    return _EXTENSIONS.get(base, "bin")
+
+
+async def store_stream(chunks: AsyncIterator[bytes], content_type: Optional[str]) -> str:
+    """
+    Guarda un flujo de bytes calculando su hash al vuelo.
+
+    Returns:
+        El id del medio (``<sha256>.<ext>``). Subir el mismo contenido dos veces
+        devuelve el mismo id sin duplicar el archivo.
+    """
+    MEDIA_STORE_DIR.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=MEDIA_STORE_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > MEDIA_MAX_BYTES:
+                    raise MediaTooLarge(
+                        f"El medio excede {MEDIA_MAX_BYTES} bytes")
+                digest.update(chunk)
+                temp_file.write(chunk)
+        media_id = f"{digest.hexdigest()}.{extension_for(content_type)}"
+        final_path = MEDIA_STORE_DIR / media_id
+        if final_path.exists():
+            # Ya lo teníamos: refrescar su edad para la retención
+            os.utime(final_path)
+        else:
+            os.replace(temp_path, final_path)
+            temp_path = None
+        return media_id
+    finally:
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+        cleanup_expired()
+
+
+def is_media_source(source: Optional[str]) -> bool:
+    return bool(source) and source.startswith(MEDIA_SCHEME)
+
+
+def resolve_media_source(source: str) -> str:
+    """Convierte ``media://<id>`` en la ruta local; otras fuentes no cambian."""
+    if not is_media_source(source):
+        return source
+    media_id = source[len(MEDIA_SCHEME):]
+    path = MEDIA_STORE_DIR / media_id
+    if not _MEDIA_ID_PATTERN.match(media_id) or not path.is_file():
+        raise FileNotFoundError(f"Medio no encontrado o expirado: {source}")
+    return str(path)
+
+
+def cleanup_expired(force: bool = False) -> int:
+    """Borra los medios más viejos que MEDIA_RETENTION_SECONDS."""
+    global _last_cleanup
+    now = time.time()
+    if not force and now - _last_cleanup < CLEANUP_INTERVAL_SECONDS:
+        return 0
+    _last_cleanup = now
+    removed = 0
+    if not MEDIA_STORE_DIR.exists():
+        return 0
+    for path in MEDIA_STORE_DIR.iterdir():
+        try:
+            if now - path.stat().st_mtime > MEDIA_RETENTION_SECONDS:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            continue
+    return removed
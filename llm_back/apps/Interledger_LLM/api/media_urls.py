@@ -0,0 +1,69 @@
+"""
+Identificadores firmados y de corta duración para los archivos servidos por HTTP.
+
+Un id firmado tiene la forma ``<file_id>.<expira>.<firma>``, donde la firma
+es un HMAC-SHA256 truncado de ``file_id`` y la expiración. Así el endpoint
+``/audio/{id}`` no expone rutas del sistema de archivos y los enlaces caducan.
+
+Con varios workers o réplicas debe definirse MEDIA_SIGNING_KEY; si no, cada
+proceso genera su propia llave y solo reconoce los ids que él firmó.
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import os
+import re
+import secrets
+import time
+from typing import Optional, Tuple
+
+MEDIA_URL_TTL_SECONDS = int(os.getenv("MEDIA_URL_TTL_SECONDS", "900"))
+# URL base con la que ws_bot alcanza a este servicio
+PUBLIC_BASE_URL = os.getenv("LLM_PUBLIC_BASE_URL", "http://llm_backend:8000").rstrip("/")
+
+_SIGNING_KEY = os.getenv("MEDIA_SIGNING_KEY", "").encode() or secrets.token_bytes(32)
+_FILE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def _signature(file_id: str, expires: int) -> str:
+    digest = hmac.new(_SIGNING_KEY, f"{file_id}.{expires}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:18]).decode().rstrip("=")
+
+
+def sign_file_id(file_id: str, ttl: int = MEDIA_URL_TTL_SECONDS) -> str:
+    """Genera un id firmado que vence en ttl segundos."""
+    if not _FILE_ID_PATTERN.match(file_id):
+        raise ValueError(f"file_id inválido: {file_id!r}")
+    expires = int(time.time()) + ttl
+    return f"{file_id}.{expires}.{_signature(file_id, expires)}"
+
+
+def verify_signed_id(signed_id: str) -> Tuple[Optional[str], int]:
+    """
+    Valida un id firmado.
+
+    Returns:
+        (file_id, segundos restantes). file_id es None si la firma es inválida
+        o el id ya venció.
+    """
+    try:
+        file_id, expires_text, signature = signed_id.split(".")
+        expires = int(expires_text)
+    except ValueError:
+        return None, 0
+    if not _FILE_ID_PATTERN.match(file_id):
+        return None, 0
+    if not hmac.compare_digest(signature, _signature(file_id, expires)):
+        return None, 0
+    remaining = expires - int(time.time())
+    if remaining <= 0:
+        return None, 0
+    return file_id, remaining
+
+
+def signed_url(route: str, file_id: str) -> str:
+    """URL pública (para ws_bot) de un archivo: ``{PUBLIC_BASE_URL}/{route}/{id}``."""
+    return f"{PUBLIC_BASE_URL}/{route.strip('/')}/{sign_file_id(file_id)}"
@@ -0,0 +1,94 @@
+"""
+Métricas en memoria del servicio: contadores, gauges y ventanas de latencia.
+
+Es un registro sencillo y thread-safe pensado para ajustar el servicio
+(latencias de cola, tasas de hedge/fallback, etc.) sin dependencias externas.
+Se expone completo en el endpoint GET /metrics.
+"""
+
+from __future__ import annotations
+
+import threading
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, Optional
+
+# Número de muestras recientes que se conservan por serie de latencia
+LATENCY_WINDOW = 500
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = defaultdict(float)
+_gauges: Dict[str, float] = {}
+_latencies: Dict[str, Deque[float]] = defaultdict(
+    lambda: deque(maxlen=LATENCY_WINDOW))
+
+
+def inc(name: str, value: float = 1.0) -> None:
+    """Incrementa un contador."""
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name: str, value: float) -> None:
+    """Fija el valor actual de un gauge."""
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name: str, seconds: float) -> None:
+    """Registra una muestra de latencia (en segundos)."""
+    with _lock:
+        _latencies[name].append(seconds)
+
+
+def counter(name: str) -> float:
+    with _lock:
+        return _counters.get(name, 0.0)
+
+
+def percentile(name: str, q: float, min_samples: int = 1) -> Optional[float]:
+    """
+    Percentil q (0-1) de la ventana reciente de una serie de latencia.
+
+    Returns:
+        None si la serie tiene menos de min_samples muestras.
+    """
+    with _lock:
+        samples = sorted(_latencies.get(name, ()))
+    if len(samples) < max(min_samples, 1):
+        return None
+    index = min(len(samples) - 1, int(round(q * (len(samples) - 1))))
+    return samples[index]
+
+
+def ratio(numerator: str, denominator: str) -> float:
+    """Cociente entre dos contadores (0 si el denominador es 0)."""
+    with _lock:
+        total = _counters.get(denominator, 0.0)
+        return _counters.get(numerator, 0.0) / total if total else 0.0
+
+
+def snapshot() -> Dict[str, Any]:
+    """Copia de todas las métricas con resumen de percentiles por latencia."""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        latencies = {name: sorted(values)
+                     for name, values in _latencies.items()}
+
+    def _pick(samples, q):
+        return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+    return {
+        "counters": counters,
+        "gauges": gauges,
+        "latencies": {
+            name: {
+                "count": len(samples),
+                "p50": _pick(samples, 0.50),
+                "p95": _pick(samples, 0.95),
+                "p99": _pick(samples, 0.99),
+            }
+            for name, samples in latencies.items()
+            if samples
+        },
+    }
@@ -0,0 +1,368 @@
+"""
+Outbox durable de pagos (SQLite en modo WAL).
+
+El webhook ya no espera al servicio de pagos: guarda la intención de pago en
+el outbox (una fila por pago, con su idempotency key) y responde de
+inmediato. Un despachador en segundo plano:
+
+1. Toma los pagos pendientes por lotes y los envía con ``send_payments_batch``
+   usando la llave guardada, así que reenviar tras un reintento o una caída
+   del proceso no duplica el pago.
+2. Reintenta los errores transitorios (red, 5xx, breaker abierto) con backoff
+   exponencial; los errores definitivos (4xx) o agotar los intentos marcan el
+   pago como fallido.
+3. Avisa a ws_bot (``WS_BOT_NOTIFY_URL``) con la URL de confirmación o el
+   error, reintentando hasta que ws_bot lo acepte (un 4xx de ws_bot no se
+   reintenta).
+
+Estados de una fila: ``pending`` (pago por enviar) -> ``notify`` (resultado
+listo para ws_bot) -> ``done``. Si ws_bot no acepta el aviso tras
+``OUTBOX_MAX_ATTEMPTS`` intentos, la fila queda en ``dead``.
+
+Varios workers o réplicas pueden compartir el archivo: cada despachador
+reclama sus filas con un solo ``UPDATE ... RETURNING`` (``pending`` ->
+``sending``, ``notify`` -> ``notifying``) antes de enviarlas, así que dos
+despachadores nunca toman la misma fila. Un reclamo que no se resuelve en
+``OUTBOX_CLAIM_TIMEOUT`` (el proceso murió a medio envío) vuelve a su estado
+anterior y se reintenta con la misma llave.
+
+Está desactivado por defecto: con él, el webhook responde ``queued`` en vez
+del resultado del pago, y ws_bot recibe la confirmación después.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+
+from . import metrics
+from .ledger import get_ledger, transaction_row
+from .payment import send_payments_batch
+
+PAYMENT_OUTBOX_ENABLED = os.getenv(
+    "PAYMENT_OUTBOX_ENABLED", "false").lower() in ("1", "true", "yes")
+PAYMENT_OUTBOX_PATH = os.getenv(
+    "PAYMENT_OUTBOX_PATH",
+    str(Path(__file__).resolve().parent / "payment_outbox.db"),
+)
+# Endpoint de ws_bot que recibe el resultado de cada pago
+WS_BOT_NOTIFY_URL = os.getenv(
+    "WS_BOT_NOTIFY_URL", "http://ws_bot:8080/payments/notify")
+# Secreto compartido con ws_bot; va en X-Notify-Token y ws_bot rechaza avisos sin él
+PAYMENT_NOTIFY_TOKEN = os.getenv("PAYMENT_NOTIFY_TOKEN", "")
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BASE_BACKOFF = float(os.getenv("OUTBOX_BASE_BACKOFF", "1"))
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", "300"))
+# Sin pagos nuevos, cada cuánto se revisan los reintentos programados
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+NOTIFY_TIMEOUT = 10.0
+# Tiempo tras el cual un reclamo sin resolver se considera abandonado; debe
+# superar lo que tarda un lote de pagos
+OUTBOX_CLAIM_TIMEOUT = float(os.getenv("OUTBOX_CLAIM_TIMEOUT", "300"))
+# Las filas terminadas (done/dead) se borran tras este tiempo; la bitácora conserva el pago
+OUTBOX_RETENTION_SECONDS = int(os.getenv("OUTBOX_RETENTION_SECONDS", str(7 * 24 * 3600)))
+PRUNE_INTERVAL_SECONDS = 3600
+# Ventana para calcular la tasa de drenado (pagos resueltos por segundo)
+DRAIN_RATE_WINDOW = 60.0
+
+PENDING = "pending"
+SENDING = "sending"
+NOTIFY = "notify"
+NOTIFYING = "notifying"
+DONE = "done"
+DEAD = "dead"
+# Estado reclamado por un despachador a partir de cada estado pendiente
+CLAIMED = {PENDING: SENDING, NOTIFY: NOTIFYING}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS payment_outbox (
+    id INTEGER PRIMARY KEY,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    wa_id TEXT NOT NULL,
+    destinatario TEXT,
+    payload TEXT NOT NULL,
+    reply_context TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    result TEXT,
+    last_error TEXT,
+    claimed_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_payment_outbox_due
+    ON payment_outbox (state, next_attempt_at);
+"""
+
+
+def backoff_seconds(attempts: int, retry_after: Optional[float] = None) -> float:
+    """Espera antes del siguiente intento (exponencial, acotada)."""
+    delay = min(OUTBOX_MAX_BACKOFF, OUTBOX_BASE_BACKOFF * (2 ** max(attempts - 1, 0)))
+    if retry_after:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def is_retryable(result: Dict[str, Any]) -> bool:
+    """Errores de red, 5xx y breaker abierto se reintentan; los 4xx no."""
+    status_code = result.get("status_code")
+    return status_code is None or status_code >= 500
+
+
+class PaymentOutbox:
+    """Outbox persistente con despachador asíncrono."""
+
+    def __init__(self, path: str = PAYMENT_OUTBOX_PATH):
+        self.path = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(_SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(payment_outbox)")}
+        if "claimed_at" not in columns:
+            # Archivos creados antes de los reclamos
+            with self._conn:
+                self._conn.execute("ALTER TABLE payment_outbox ADD COLUMN claimed_at REAL")
+        self._lock = threading.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._resolved: Deque[float] = deque()
+        self._last_prune = 0.0
+        self._publish_depth()
+
+    def enqueue(
+        self,
+        wa_id: str,
+        items: Sequence[Tuple[Optional[str], Dict[str, Any]]],
+        reply_context: Optional[Dict[str, Any]] = None,
+    ) -> List[str]:
+        """
+        Guarda las intenciones de pago y despierta al despachador.
+
+        Args:
+            wa_id: Usuario que pidió los pagos
+            items: Pares (destinatario extraído, payload del servicio de pagos)
+            reply_context: Datos de ws_bot que se devuelven tal cual en el aviso
+
+        Returns:
+            La idempotency key de cada pago, en el mismo orden que items.
+        """
+        now = time.time()
+        keys = [uuid.uuid4().hex for _ in items]
+        context = json.dumps(reply_context) if reply_context else None
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO payment_outbox (idempotency_key, wa_id, destinatario, payload, "
+                "reply_context, state, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (key, wa_id, destinatario, json.dumps(payload), context, PENDING, now, now)
+                    for key, (destinatario, payload) in zip(keys, items)
+                ],
+            )
+        metrics.inc("outbox.enqueued", len(keys))
+        self._publish_depth()
+        self._wake()
+        return keys
+
+    def depth(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT state, COUNT(*) FROM payment_outbox WHERE state IN (?, ?, ?, ?) GROUP BY state",
+                (PENDING, SENDING, NOTIFY, NOTIFYING),
+            ).fetchall()
+        counts = dict(rows)
+        # Las filas reclamadas siguen pendientes hasta resolverse
+        return {state: counts.get(state, 0) + counts.get(claimed, 0) for state, claimed in CLAIMED.items()}
+
+    async def run(self) -> None:
+        """Bucle del despachador; se cancela al apagar el servidor."""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        async with httpx.AsyncClient(timeout=NOTIFY_TIMEOUT) as notify_client:
+            while True:
+                self._wakeup.clear()
+                try:
+                    worked = await self.dispatch_once(notify_client)
+                except Exception as exc:
+                    metrics.inc("outbox.dispatch_errors")
+                    print(f"Error en el despachador del outbox: {exc}")
+                    worked = False
+                if not worked:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+
+    async def dispatch_once(self, notify_client: httpx.AsyncClient) -> bool:
+        """Envía un lote de pagos y un lote de avisos vencidos; True si hubo trabajo."""
+        await asyncio.to_thread(self._reclaim_stale)
+        payments = await asyncio.to_thread(self._claim, PENDING)
+        if payments:
+            await self._send_payments(payments)
+        notifications = await asyncio.to_thread(self._claim, NOTIFY)
+        if notifications:
+            await asyncio.gather(*(self._notify(notify_client, row) for row in notifications))
+        if time.time() - self._last_prune > PRUNE_INTERVAL_SECONDS:
+            await asyncio.to_thread(self.prune)
+        self._publish_depth()
+        return bool(payments or notifications)
+
+    async def _send_payments(self, rows: List[Dict[str, Any]]) -> None:
+        results = await send_payments_batch(
+            [row["payload"] for row in rows],
+            idempotency_keys=[row["idempotency_key"] for row in rows],
+        )
+        now = time.time()
+        updates = []
+        for row, result in zip(rows, results):
+            attempts = row["attempts"] + 1
+            failed = result.get("status") == "error"
+            if failed and is_retryable(result) and attempts < OUTBOX_MAX_ATTEMPTS:
+                metrics.inc("outbox.retries")
+                updates.append((PENDING, attempts, now + backoff_seconds(
+                    attempts, result.get("retry_after")), None, result.get("error"), row["id"]))
+                continue
+            metrics.inc("outbox.failed" if failed else "outbox.sent")
+            metrics.observe("outbox.age", now - row["created_at"])
+            self._resolved.append(now)
+            get_ledger().record(transaction_row(
+                row["wa_id"], row["destinatario"], row["payload"], result))
+            # El aviso a ws_bot empieza su propio conteo de intentos
+            updates.append((NOTIFY, 0, now, json.dumps(result), result.get("error"), row["id"]))
+        await asyncio.to_thread(self._update, updates)
+
+    async def _notify(self, client: httpx.AsyncClient, row: Dict[str, Any]) -> None:
+        result = row["result"] or {}
+        body = {
+            "wa_id": row["wa_id"],
+            "idempotency_key": row["idempotency_key"],
+            "destinatario": row["destinatario"],
+            "status": result.get("status"),
+            "service_response": result.get("service_response"),
+            "error": result.get("error"),
+            "reply_context": row["reply_context"],
+        }
+        try:
+            response = await client.post(
+                WS_BOT_NOTIFY_URL, json=body, headers={"X-Notify-Token": PAYMENT_NOTIFY_TOKEN})
+            response.raise_for_status()
+        except httpx.HTTPError as exc:
+            attempts = row["attempts"] + 1
+            metrics.inc("outbox.delivery_retries")
+            # ws_bot rechaza con 4xx un aviso que nunca aceptará: no se reintenta
+            rejected = (
+                isinstance(exc, httpx.HTTPStatusError)
+                and 400 <= exc.response.status_code < 500
+                and exc.response.status_code != 429
+            )
+            state = NOTIFY if attempts < OUTBOX_MAX_ATTEMPTS and not rejected else DEAD
+            if state == DEAD:
+                metrics.inc("outbox.dead")
+            await asyncio.to_thread(self._update, [(
+                state, attempts, time.time() + backoff_seconds(attempts),
+                row["result_raw"], f"Aviso a ws_bot: {exc}", row["id"])])
+            return
+        metrics.inc("outbox.delivered")
+        await asyncio.to_thread(self._update, [(
+            DONE, row["attempts"], time.time(), row["result_raw"], None, row["id"])])
+
+    def prune(self) -> int:
+        """Borra las filas terminadas más viejas que OUTBOX_RETENTION_SECONDS."""
+        self._last_prune = time.time()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "DELETE FROM payment_outbox WHERE state IN (?, ?) AND next_attempt_at < ?",
+                (DONE, DEAD, self._last_prune - OUTBOX_RETENTION_SECONDS),
+            )
+        return cursor.rowcount
+
+    def _claim(self, state: str) -> List[Dict[str, Any]]:
+        """Reclama de forma atómica un lote de filas vencidas en ``state``."""
+        now = time.time()
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "UPDATE payment_outbox SET state = ?, claimed_at = ? WHERE id IN ("
+                "SELECT id FROM payment_outbox WHERE state = ? AND next_attempt_at <= ? "
+                "ORDER BY next_attempt_at LIMIT ?) "
+                "RETURNING id, idempotency_key, wa_id, destinatario, payload, reply_context, "
+                "attempts, created_at, result",
+                (CLAIMED[state], now, state, now, OUTBOX_BATCH_SIZE),
+            ).fetchall()
+        return [
+            {
+                "id": row_id,
+                "idempotency_key": key,
+                "wa_id": wa_id,
+                "destinatario": destinatario,
+                "payload": json.loads(payload),
+                "reply_context": json.loads(context) if context else None,
+                "attempts": attempts,
+                "created_at": created_at,
+                "result": json.loads(result) if result else None,
+                "result_raw": result,
+            }
+            for row_id, key, wa_id, destinatario, payload, context, attempts, created_at, result in rows
+        ]
+
+    def _reclaim_stale(self) -> None:
+        """Devuelve a su estado anterior los reclamos abandonados."""
+        cutoff = time.time() - OUTBOX_CLAIM_TIMEOUT
+        reclaimed = 0
+        with self._lock, self._conn:
+            for state, claimed in CLAIMED.items():
+                reclaimed += self._conn.execute(
+                    "UPDATE payment_outbox SET state = ?, claimed_at = NULL "
+                    "WHERE state = ? AND claimed_at < ?",
+                    (state, claimed, cutoff),
+                ).rowcount
+        if reclaimed:
+            metrics.inc("outbox.reclaimed", reclaimed)
+
+    def _update(self, updates: List[Tuple[Any, ...]]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE payment_outbox SET state = ?, attempts = ?, next_attempt_at = ?, "
+                "result = ?, last_error = ?, claimed_at = NULL WHERE id = ?",
+                updates,
+            )
+
+    def _wake(self) -> None:
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _publish_depth(self) -> None:
+        counts = self.depth()
+        metrics.set_gauge("outbox.depth", counts[PENDING] + counts[NOTIFY])
+        metrics.set_gauge("outbox.pending", counts[PENDING])
+        metrics.set_gauge("outbox.notify", counts[NOTIFY])
+        cutoff = time.time() - DRAIN_RATE_WINDOW
+        while self._resolved and self._resolved[0] < cutoff:
+            self._resolved.popleft()
+        metrics.set_gauge("outbox.drain_rate", round(len(self._resolved) / DRAIN_RATE_WINDOW, 3))
+
+
+_outbox: Optional[PaymentOutbox] = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox() -> PaymentOutbox:
+    """Obtiene el outbox compartido, inicializándolo si es necesario"""
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = PaymentOutbox()
+    return _outbox
@@ -1,27 +1,69 @@
-
 from __future__ import annotations
 
 import os
-from typing import Dict, Any
+import uuid
+from typing import Dict, Any, List, Optional, Sequence, Tuple
 
 import httpx
 import asyncio
 
+from . import metrics
+from .breaker import CircuitOpenError, payment_breaker
+from .deadline import stage_timeout
+
 PAYMENT_SERVICE_URL = "http://open_payments_api:3000/send-payment"
+# Endpoint que sondea /ready (y que mantiene abierta la conexión del pool)
+PAYMENT_HEALTH_URL = os.getenv("PAYMENT_HEALTH_URL", "http://open_payments_api:3000/health")
 DEFAULT_ASSET_CODE = os.getenv("PAYMENT_ASSET_CODE", "MX")
 DEFAULT_ASSET_SCALE = int(os.getenv("PAYMENT_ASSET_SCALE", "2"))
+# Pagos en vuelo a la vez dentro de un lote
+PAYMENT_BATCH_CONCURRENCY = int(os.getenv("PAYMENT_BATCH_CONCURRENCY", "8"))
+# Conexiones del pool compartido hacia el servicio de pagos
+PAYMENT_MAX_CONNECTIONS = int(os.getenv("PAYMENT_MAX_CONNECTIONS", "20"))
+# Segundos que una conexión ociosa del pool sigue abierta
+PAYMENT_KEEPALIVE_SECONDS = float(os.getenv("PAYMENT_KEEPALIVE_SECONDS", "60"))
+
+# Un AsyncClient queda ligado al event loop donde se usa por primera vez
+_client: Optional[Tuple[asyncio.AbstractEventLoop, httpx.AsyncClient]] = None
+
+
+def get_payment_client() -> httpx.AsyncClient:
+    """Cliente HTTP compartido (keep-alive) para el event loop actual."""
+    global _client
+    loop = asyncio.get_running_loop()
+    if _client is None or _client[0] is not loop or _client[1].is_closed:
+        _client = (loop, httpx.AsyncClient(limits=httpx.Limits(
+            max_connections=PAYMENT_MAX_CONNECTIONS,
+            max_keepalive_connections=PAYMENT_MAX_CONNECTIONS,
+            keepalive_expiry=PAYMENT_KEEPALIVE_SECONDS,
+        )))
+    return _client[1]
+
 
+async def close_payment_client() -> None:
+    """Cierra el pool de conexiones al apagar el servidor."""
+    global _client
+    if _client is not None:
+        client, _client = _client[1], None
+        await client.aclose()
 
-async def send_payment_async(payload: Dict[str, Any]) -> Dict[str, Any]:
+
+async def send_payment_async(
+    payload: Dict[str, Any],
+    idempotency_key: Optional[str] = None,
+) -> Dict[str, Any]:
     """
     Envía el pago al servicio remoto de forma asíncrona.
 
     Args:
         payload: Diccionario con las llaves esperadas por el servicio:
             senderWalletUrl, receiverWalletUrl, amount, assetCode, assetScale
+        idempotency_key: Se envía en el header Idempotency-Key para que un
+            reintento del mismo pago no lo duplique
 
     Returns:
-        Diccionario con resultado y detalles
+        Diccionario con resultado y detalles. Si el circuit breaker del
+        servicio está abierto se devuelve un error sin intentar la llamada.
     """
     if not PAYMENT_SERVICE_URL:
         return {
@@ -30,12 +72,14 @@ async def send_payment_async(payload: Dict[str, Any]) -> Dict[str, Any]:
             "payload": payload,
         }
 
+    headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
+        with payment_breaker.guard():
+            response = await get_payment_client().post(
                 PAYMENT_SERVICE_URL,
                 json=payload,
-                timeout=30,
+                headers=headers,
+                timeout=stage_timeout("payment", 30),
             )
             response.raise_for_status()
 
@@ -48,14 +92,66 @@ async def send_payment_async(payload: Dict[str, Any]) -> Dict[str, Any]:
                 "status": "success",
                 "payload": payload,
                 "service_response": data,
+                "idempotency_key": idempotency_key,
             }
-    except httpx.RequestError as exc:
+    except httpx.HTTPError as exc:
+        return {
+            "status": "error",
+            "payload": payload,
+            "error": str(exc),
+            # None si no hubo respuesta (error de red o timeout)
+            "status_code": exc.response.status_code if isinstance(exc, httpx.HTTPStatusError) else None,
+            "idempotency_key": idempotency_key,
+        }
+    except CircuitOpenError as exc:
+        # Falla rápida mientras el servicio de pagos está caído
         return {
             "status": "error",
             "payload": payload,
             "error": str(exc),
+            "retry_after": round(exc.retry_after, 1),
+            "idempotency_key": idempotency_key,
         }
 
+
+async def send_payments_batch(
+    payloads: Sequence[Dict[str, Any]],
+    idempotency_keys: Optional[Sequence[str]] = None,
+    max_concurrency: int = PAYMENT_BATCH_CONCURRENCY,
+) -> List[Dict[str, Any]]:
+    """
+    Envía varios pagos en paralelo sobre el pool compartido.
+
+    Args:
+        payloads: Pagos a enviar (mismo formato que send_payment_async)
+        idempotency_keys: Una llave por pago. Para re-enviar un lote (p. ej.
+            al reprocesar pendientes) deben pasarse las mismas llaves; si se
+            omiten se generan nuevas, únicas por lote.
+        max_concurrency: Máximo de pagos en vuelo a la vez
+
+    Returns:
+        Resultados en el mismo orden que payloads. Un pago que falla no
+        cancela a los demás: su resultado tiene status "error".
+    """
+    if idempotency_keys is None:
+        batch_id = uuid.uuid4().hex
+        idempotency_keys = [f"{batch_id}-{i}" for i in range(len(payloads))]
+    elif len(idempotency_keys) != len(payloads):
+        raise ValueError("Se requiere una idempotency key por pago")
+
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def send(payload: Dict[str, Any], key: str) -> Dict[str, Any]:
+        async with semaphore:
+            return await send_payment_async(payload, idempotency_key=key)
+
+    results = await asyncio.gather(
+        *(send(payload, key) for payload, key in zip(payloads, idempotency_keys)))
+    metrics.inc("payment.batch_items", len(results))
+    metrics.inc("payment.batch_errors",
+                sum(1 for result in results if result.get("status") == "error"))
+    return list(results)
+
 # Alias para mantener compatibilidad si la función es llamada de manera síncrona
 
 
@@ -63,4 +159,10 @@ def send_payment(payload: Dict[str, Any]) -> Dict[str, Any]:
     """
     Wrapper síncrono para send_payment_async para retrocompatibilidad.
     """
-    return asyncio.run(send_payment_async(payload))
+    async def send_and_close() -> Dict[str, Any]:
+        try:
+            return await send_payment_async(payload)
+        finally:
+            await close_payment_client()
+
+    return asyncio.run(send_and_close())
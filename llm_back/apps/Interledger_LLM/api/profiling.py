@@ -0,0 +1,194 @@
+"""
+Perfilado bajo demanda y registro de peticiones lentas (endpoints /admin).
+
+- ``sample_stacks`` es un perfilador por muestreo: un hilo toma cada
+  ``interval`` segundos la pila de todos los hilos (``sys._current_frames``)
+  durante N segundos y devuelve las pilas en formato colapsado
+  (``hilo;modulo:funcion;... cuenta``), el que leen flamegraph.pl, speedscope
+  e inferno. No instrumenta nada: fuera de la ventana de muestreo no cuesta,
+  y durante ella cuesta una lectura de pilas por intervalo. Las pilas de
+  hilos ociosos (event loop en select, hilos del pool esperando trabajo) se
+  omiten salvo que se pidan.
+- ``SlowRequestLog`` guarda en un buffer circular (``SLOW_REQUEST_BUFFER``)
+  las peticiones que tardan más de ``SLOW_REQUEST_SECONDS``: el tiempo por
+  etapa del deadline, el modo de servicio y una foto de memoria (RSS,
+  contadores del GC y, si ``tracemalloc`` está activo, las líneas que más
+  memoria tienen asignada).
+
+Los endpoints exigen el header ``X-Admin-Token`` igual a ``ADMIN_TOKEN``;
+sin ``ADMIN_TOKEN`` configurado no existen (404).
+"""
+
+from __future__ import annotations
+
+import gc
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from . import metrics
+from .deadline import Deadline
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# Duración máxima de un perfil y el intervalo de muestreo por defecto
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+# Peticiones más lentas que esto se registran en /admin/slow-requests
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "10"))
+SLOW_REQUEST_BUFFER = int(os.getenv("SLOW_REQUEST_BUFFER", "50"))
+# Frames por asignación que guarda tracemalloc (0 = desactivado; cuesta CPU y memoria)
+SLOW_REQUEST_TRACEMALLOC_FRAMES = int(os.getenv("SLOW_REQUEST_TRACEMALLOC_FRAMES", "0"))
+TRACEMALLOC_TOP = 10
+
+# Funciones hoja de un hilo que solo está esperando
+_IDLE_LEAVES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+}
+
+_profile_lock = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    """Ya hay un perfil en curso."""
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", os.path.basename(code.co_filename))
+    return f"{module}:{code.co_name}"
+
+
+def _stack(frame) -> List[str]:
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+def sample_stacks(
+    seconds: float,
+    interval: float = PROFILE_INTERVAL,
+    include_idle: bool = False,
+) -> Tuple[str, int]:
+    """
+    Muestrea las pilas de todos los hilos durante ``seconds`` segundos.
+
+    Args:
+        seconds: Duración del perfil (máximo PROFILE_MAX_SECONDS)
+        interval: Segundos entre muestras
+        include_idle: Incluir hilos bloqueados esperando (select, colas, locks)
+
+    Returns:
+        (pilas en formato colapsado, número de muestras tomadas)
+
+    Raises:
+        ProfilerBusy: Si ya hay otro perfil en curso
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy("Ya hay un perfil en curso")
+    try:
+        seconds = max(0.0, min(seconds, PROFILE_MAX_SECONDS))
+        interval = max(0.001, interval)
+        own = threading.get_ident()
+        counts: Counter = Counter()
+        samples = 0
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                if not include_idle and (os.path.basename(code.co_filename), code.co_name) in _IDLE_LEAVES:
+                    continue
+                thread = names.get(ident, str(ident)).replace(";", "_").replace(" ", "_")
+                counts[";".join([thread] + _stack(frame))] += 1
+            samples += 1
+            time.sleep(interval)
+        metrics.inc("profile.samples", samples)
+        collapsed = "\n".join(f"{stack} {count}" for stack, count in counts.most_common())
+        return collapsed, samples
+    finally:
+        _profile_lock.release()
+
+
+def memory_snapshot() -> Dict[str, Any]:
+    """RSS del proceso, contadores del GC y, si está activo, lo que más asignó tracemalloc."""
+    snapshot: Dict[str, Any] = {
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "gc_counts": list(gc.get_count()),
+    }
+    try:
+        with open("/proc/self/statm", "r", encoding="ascii") as statm:
+            snapshot["rss_bytes"] = int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics("lineno")[:TRACEMALLOC_TOP]
+        snapshot["traced_bytes"] = current
+        snapshot["traced_peak_bytes"] = peak
+        snapshot["top_allocations"] = [
+            {"line": str(stat.traceback[0]), "size": stat.size, "count": stat.count}
+            for stat in top
+        ]
+    return snapshot
+
+
+class SlowRequestLog:
+    """Buffer circular con las peticiones más lentas que el umbral."""
+
+    def __init__(self, threshold: float = SLOW_REQUEST_SECONDS, size: int = SLOW_REQUEST_BUFFER):
+        self.threshold = threshold
+        self._records: Deque[Dict[str, Any]] = deque(maxlen=max(1, size))
+        self._lock = threading.Lock()
+
+    def observe(self, deadline: Deadline, **details: Any) -> Optional[Dict[str, Any]]:
+        """Registra la petición si tardó más que el umbral; devuelve el registro."""
+        elapsed = deadline.elapsed()
+        if elapsed < self.threshold:
+            return None
+        record = {
+            "at": time.time(),
+            "elapsed": round(elapsed, 3),
+            **details,
+            "deadline": deadline.summary(),
+            "memory": memory_snapshot(),
+        }
+        with self._lock:
+            self._records.append(record)
+        metrics.inc("slow_requests")
+        return record
+
+    def recent(self, limit: int = SLOW_REQUEST_BUFFER) -> List[Dict[str, Any]]:
+        """Registros de la más reciente a la más antigua."""
+        with self._lock:
+            records = list(self._records)
+        return records[::-1][:max(0, limit)]
+
+
+def start_tracemalloc() -> None:
+    """Activa tracemalloc al arrancar si SLOW_REQUEST_TRACEMALLOC_FRAMES > 0."""
+    if SLOW_REQUEST_TRACEMALLOC_FRAMES > 0 and not tracemalloc.is_tracing():
+        tracemalloc.start(SLOW_REQUEST_TRACEMALLOC_FRAMES)
+
+
+_slow_log: Optional[SlowRequestLog] = None
+
+
+def get_slow_log() -> SlowRequestLog:
+    """Obtiene el registro de peticiones lentas compartido, inicializándolo si es necesario"""
+    global _slow_log
+    if _slow_log is None:
+        _slow_log = SlowRequestLog()
+    return _slow_log
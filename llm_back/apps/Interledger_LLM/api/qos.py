@@ -0,0 +1,193 @@
+"""
+Modo de degradación según la carga (calidad de servicio).
+
+Cuando el servicio está saturado, cada nota de voz sigue pagando la síntesis
+de la respuesta y cada mensaje el modelo de extracción más capaz. El
+controlador mira dos señales:
+
+- la profundidad de las colas del planificador (trabajos de texto, audio e
+  imagen esperando lugar), y
+- la latencia reciente de la etapa de extracción (media móvil exponencial),
+
+y elige uno de tres modos, cada uno con el trabajo opcional que se omite:
+
+- ``normal``: nada.
+- ``degraded``: sin TTS (la respuesta va solo en texto) y siempre el
+  extractor rápido (``extraction_fast``).
+- ``critical``: además, el modelo de visión económico (``vision_economy``).
+
+Sube de modo en cuanto una señal cruza su umbral; baja un nivel a la vez,
+solo después de ``QOS_MIN_HOLD_SECONDS`` en el modo actual y con ambas
+señales por debajo de ``QOS_RECOVERY_RATIO`` veces sus umbrales (histéresis),
+para no oscilar en el borde. El modo se decide al inicio de cada mensaje y
+se publica en una ContextVar, como el deadline, para que el router y las
+etapas que corren en hilos lo vean; la respuesta lo incluye en ``mode``.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+from . import metrics
+from .scheduler import get_scheduler
+
+NORMAL = "normal"
+DEGRADED = "degraded"
+CRITICAL = "critical"
+MODES: List[str] = [NORMAL, DEGRADED, CRITICAL]
+
+QOS_ENABLED = os.getenv("QOS_ENABLED", "true").lower() not in ("0", "false", "no")
+# Trabajos en cola (sin contar confirmaciones) a partir de los cuales se degrada
+QOS_QUEUE_DEGRADED = int(os.getenv("QOS_QUEUE_DEGRADED", "8"))
+QOS_QUEUE_CRITICAL = int(os.getenv("QOS_QUEUE_CRITICAL", "24"))
+# Latencia de extracción (segundos, media móvil) a partir de la cual se degrada
+QOS_LATENCY_DEGRADED = float(os.getenv("QOS_LATENCY_DEGRADED", "4"))
+QOS_LATENCY_CRITICAL = float(os.getenv("QOS_LATENCY_CRITICAL", "8"))
+# Para bajar de modo ambas señales deben estar por debajo de esta fracción
+# de los umbrales del modo actual
+QOS_RECOVERY_RATIO = float(os.getenv("QOS_RECOVERY_RATIO", "0.5"))
+# Tiempo mínimo en un modo antes de bajar al anterior
+QOS_MIN_HOLD_SECONDS = float(os.getenv("QOS_MIN_HOLD_SECONDS", "20"))
+# Peso de cada muestra nueva en la media móvil de latencia
+QOS_LATENCY_ALPHA = float(os.getenv("QOS_LATENCY_ALPHA", "0.2"))
+
+
+@dataclass(frozen=True)
+class ModePolicy:
+    """Trabajo opcional que se omite en un modo."""
+    skip_tts: bool = False  # responder solo con texto a las notas de voz
+    fast_extraction: bool = False  # usar siempre el extractor rápido
+    economy_vision: bool = False  # usar el modelo de visión económico
+
+
+POLICIES: Dict[str, ModePolicy] = {
+    NORMAL: ModePolicy(),
+    DEGRADED: ModePolicy(skip_tts=True, fast_extraction=True),
+    CRITICAL: ModePolicy(skip_tts=True, fast_extraction=True, economy_vision=True),
+}
+
+
+def _queued_work() -> int:
+    """Trabajos esperando lugar en las clases no urgentes del planificador."""
+    classes = get_scheduler().stats()["classes"]
+    return sum(state["queued"] for state in classes.values() if not state["urgent"])
+
+
+class QosController:
+    """Elige el modo de servicio a partir de la cola y la latencia, con histéresis."""
+
+    def __init__(
+        self,
+        queue_depth: Callable[[], int] = _queued_work,
+        queue_thresholds: Optional[List[float]] = None,
+        latency_thresholds: Optional[List[float]] = None,
+        min_hold: float = QOS_MIN_HOLD_SECONDS,
+        enabled: bool = QOS_ENABLED,
+    ):
+        self.queue_depth = queue_depth
+        # Umbral para entrar a cada modo después de normal
+        self.queue_thresholds = queue_thresholds or [QOS_QUEUE_DEGRADED, QOS_QUEUE_CRITICAL]
+        self.latency_thresholds = latency_thresholds or [QOS_LATENCY_DEGRADED, QOS_LATENCY_CRITICAL]
+        self.min_hold = min_hold
+        self.enabled = enabled
+        self.level = 0
+        self.changed_at = time.monotonic()
+        self.latency: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def mode(self) -> str:
+        return MODES[self.level]
+
+    def observe_latency(self, seconds: float) -> None:
+        """Agrega una muestra de latencia de extracción a la media móvil."""
+        with self._lock:
+            if self.latency is None:
+                self.latency = seconds
+            else:
+                self.latency += QOS_LATENCY_ALPHA * (seconds - self.latency)
+
+    def evaluate(self, now: Optional[float] = None) -> str:
+        """Recalcula el modo con las señales actuales y lo devuelve."""
+        if not self.enabled:
+            return NORMAL
+        now = time.monotonic() if now is None else now
+        queued = self.queue_depth()
+        with self._lock:
+            latency = self.latency or 0.0
+            target = self._level_for(queued, latency)
+            if target > self.level:
+                self._transition(target, now)
+            elif (
+                target < self.level
+                and now - self.changed_at >= self.min_hold
+                and self._recovered(queued, latency)
+            ):
+                self._transition(self.level - 1, now)
+            metrics.set_gauge("qos.queued", queued)
+            metrics.set_gauge("qos.latency", latency)
+            return self.mode
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "enabled": self.enabled,
+            "since": round(time.monotonic() - self.changed_at, 1),
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+            "queued": self.queue_depth(),
+        }
+
+    def _level_for(self, queued: int, latency: float) -> int:
+        level = 0
+        for index, (queue_limit, latency_limit) in enumerate(
+                zip(self.queue_thresholds, self.latency_thresholds), start=1):
+            if queued >= queue_limit or latency >= latency_limit:
+                level = index
+        return level
+
+    def _recovered(self, queued: int, latency: float) -> bool:
+        # Umbrales del modo actual, reducidos por QOS_RECOVERY_RATIO
+        queue_limit = self.queue_thresholds[self.level - 1] * QOS_RECOVERY_RATIO
+        latency_limit = self.latency_thresholds[self.level - 1] * QOS_RECOVERY_RATIO
+        return queued < queue_limit and latency < latency_limit
+
+    def _transition(self, level: int, now: float) -> None:
+        previous = self.mode
+        self.level = level
+        self.changed_at = now
+        metrics.inc(f"qos.transitions.{previous}.{self.mode}")
+        metrics.set_gauge("qos.level", level)
+
+
+_current: ContextVar[str] = ContextVar("request_mode", default=NORMAL)
+
+_controller: Optional[QosController] = None
+
+
+def get_qos() -> QosController:
+    """Obtiene el controlador compartido, inicializándolo si es necesario"""
+    global _controller
+    if _controller is None:
+        _controller = QosController()
+    return _controller
+
+
+def begin_request() -> str:
+    """Decide el modo de la petición actual y lo publica en el contexto."""
+    mode = get_qos().evaluate()
+    _current.set(mode)
+    metrics.inc(f"qos.requests.{mode}")
+    return mode
+
+
+def current_mode() -> str:
+    return _current.get()
+
+
+def current_policy() -> ModePolicy:
+    return POLICIES[_current.get()]
@@ -0,0 +1,226 @@
+"""
+Planificador de trabajo por clases (texto, audio, imagen y confirmación).
+
+Las etapas bloqueantes de cada mensaje (transcripción, visión, extracción,
+TTS) y el envío de pagos compiten por un número fijo de lugares
+(``SCHEDULER_SLOTS``). Cada clase tiene su propia cola:
+
+- Las clases urgentes (confirmación de pagos) pasan antes que las demás.
+- Entre las demás, los lugares libres se reparten por peso (stride
+  scheduling): con pesos 4/2/1, por cada foto de ticket que entra pasan hasta
+  cuatro extracciones de texto, aunque haya cientos de fotos en cola.
+- Cada clase tiene además un máximo de trabajos simultáneos; el de audio e
+  imagen deja lugares libres para texto y pagos aun en una ráfaga de medios.
+
+El tiempo de espera en cola por clase se registra como
+``scheduler.wait.<clase>`` en /metrics.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Optional, TypeVar
+
+from . import metrics
+
+T = TypeVar("T")
+
+TEXT = "text"
+AUDIO = "audio"
+IMAGE = "image"
+CONFIRMATION = "confirmation"
+
+# Trabajos en ejecución a la vez entre todas las clases
+SCHEDULER_SLOTS = int(os.getenv("SCHEDULER_SLOTS", "16"))
+# Avance de una clase por cada trabajo despachado (se divide entre su peso)
+_STRIDE = 1000.0
+
+
+@dataclass(frozen=True)
+class WorkClass:
+    """Configuración de una clase de trabajo."""
+    weight: int  # parte de los lugares libres frente a las demás clases
+    limit: int  # máximo de trabajos simultáneos de la clase
+    urgent: bool = False  # pasa antes que cualquier clase no urgente
+
+
+def _work_class(name: str, weight: int, limit: int, urgent: bool = False) -> WorkClass:
+    prefix = f"SCHEDULER_{name.upper()}"
+    return WorkClass(
+        weight=max(1, int(os.getenv(f"{prefix}_WEIGHT", str(weight)))),
+        limit=max(1, int(os.getenv(f"{prefix}_LIMIT", str(limit)))),
+        urgent=urgent,
+    )
+
+
+DEFAULT_CLASSES: Dict[str, WorkClass] = {
+    CONFIRMATION: _work_class(CONFIRMATION, weight=1, limit=8, urgent=True),
+    TEXT: _work_class(TEXT, weight=4, limit=16),
+    AUDIO: _work_class(AUDIO, weight=2, limit=12),
+    IMAGE: _work_class(IMAGE, weight=1, limit=12),
+}
+
+
+@dataclass
+class _ClassState:
+    config: WorkClass
+    waiters: Deque[asyncio.Future] = field(default_factory=deque)
+    running: int = 0
+    pass_value: float = 0.0
+
+
+class WorkScheduler:
+    """Colas por clase con prioridad, reparto por peso y límites por clase."""
+
+    def __init__(
+        self,
+        slots: int = SCHEDULER_SLOTS,
+        classes: Optional[Dict[str, WorkClass]] = None,
+    ):
+        self.slots = max(1, slots)
+        self._classes = {
+            name: _ClassState(config)
+            for name, config in (classes or DEFAULT_CLASSES).items()
+        }
+        self._running = 0
+        # Un hilo por lugar: el pool por defecto de asyncio queda para lo demás
+        self._executor = ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix="work")
+        # Pass de la última clase despachada: una clase que vuelve de estar
+        # inactiva arranca desde aquí y no acumula crédito mientras no tuvo trabajo
+        self._virtual_time = 0.0
+
+    @asynccontextmanager
+    async def slot(self, work_class: str) -> AsyncIterator[None]:
+        """Espera un lugar para la clase y lo ocupa durante el bloque."""
+        await self._acquire(work_class)
+        try:
+            yield
+        finally:
+            self._release(work_class)
+
+    async def run(self, work_class: str, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        Ejecuta una función bloqueante en un hilo cuando la clase obtiene lugar.
+
+        Como ``asyncio.to_thread``, la función ve el contexto (deadline) de la
+        petición. Si la petición se cancela, el lugar se libera hasta que el
+        hilo termina de verdad, para no pasar de ``slots`` hilos ocupados.
+        """
+        await self._acquire(work_class)
+        loop = asyncio.get_running_loop()
+        call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+        try:
+            future = loop.run_in_executor(self._executor, call)
+        except BaseException:
+            self._release(work_class)
+            raise
+        future.add_done_callback(lambda _: self._release(work_class))
+        return await asyncio.shield(future)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "slots": self.slots,
+            "running": self._running,
+            "classes": {
+                name: {
+                    "weight": state.config.weight,
+                    "limit": state.config.limit,
+                    "urgent": state.config.urgent,
+                    "queued": len(state.waiters),
+                    "running": state.running,
+                    "wait_p50": metrics.percentile(f"scheduler.wait.{name}", 0.5),
+                    "wait_p95": metrics.percentile(f"scheduler.wait.{name}", 0.95),
+                }
+                for name, state in self._classes.items()
+            },
+        }
+
+    async def _acquire(self, work_class: str) -> None:
+        state = self._classes.get(work_class)
+        if state is None:
+            raise ValueError(f"Clase de trabajo desconocida: {work_class}")
+        start = time.monotonic()
+        if not state.waiters and self._has_room(state):
+            # Camino rápido: hay lugar y nadie de la clase está esperando
+            self._start(work_class, state)
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            if not state.waiters:
+                state.pass_value = max(state.pass_value, self._virtual_time)
+            state.waiters.append(waiter)
+            self._update_gauges(work_class, state)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Se le asignó lugar justo antes de cancelarse: devolverlo
+                    self._release(work_class)
+                else:
+                    try:
+                        state.waiters.remove(waiter)
+                    except ValueError:
+                        pass
+                    self._update_gauges(work_class, state)
+                raise
+        metrics.observe(f"scheduler.wait.{work_class}", time.monotonic() - start)
+
+    def _release(self, work_class: str) -> None:
+        state = self._classes[work_class]
+        state.running -= 1
+        self._running -= 1
+        metrics.inc(f"scheduler.completed.{work_class}")
+        self._dispatch()
+        self._update_gauges(work_class, state)
+
+    def _has_room(self, state: _ClassState) -> bool:
+        return self._running < self.slots and state.running < state.config.limit
+
+    def _start(self, name: str, state: _ClassState) -> None:
+        state.running += 1
+        self._running += 1
+        state.pass_value += _STRIDE / state.config.weight
+        self._update_gauges(name, state)
+
+    def _dispatch(self) -> None:
+        """Asigna los lugares libres a las colas, urgentes primero y luego por peso."""
+        while self._running < self.slots:
+            candidates = [
+                (name, state) for name, state in self._classes.items()
+                if state.waiters and state.running < state.config.limit
+            ]
+            if not candidates:
+                return
+            name, state = min(
+                candidates,
+                key=lambda item: (not item[1].config.urgent, item[1].pass_value),
+            )
+            waiter = state.waiters.popleft()
+            if waiter.done():
+                # Cancelado mientras esperaba
+                continue
+            self._virtual_time = state.pass_value
+            self._start(name, state)
+            waiter.set_result(None)
+
+    def _update_gauges(self, name: str, state: _ClassState) -> None:
+        metrics.set_gauge(f"scheduler.queued.{name}", len(state.waiters))
+        metrics.set_gauge(f"scheduler.running.{name}", state.running)
+
+
+_scheduler: Optional[WorkScheduler] = None
+
+
+def get_scheduler() -> WorkScheduler:
+    """Obtiene el planificador compartido, inicializándolo si es necesario"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = WorkScheduler()
+    return _scheduler
@@ -0,0 +1,291 @@
+"""
+Estado de la conversación por usuario (wa_id) entre mensajes.
+
+Cada mensaje se extraía sin memoria: si el usuario decía "manda 200" y luego
+"a 5512345678", el monto se perdía, y el idioma que eligió en ws_bot no
+llegaba al backend. Una ``Session`` guarda:
+
+- los datos parciales del pago (monto y destinatario) hasta completarlo,
+- el idioma elegido en ws_bot (``PUT /sessions/{wa_id}/language``),
+- los últimos ``SESSION_MAX_TURNS`` turnos y un resumen de los anteriores,
+- los pagos cuyo destinatario se resolvió por aproximación y esperan que el
+  usuario confirme el nombre (se descartan en el turno siguiente).
+
+Los turnos viejos se compactan en el resumen, que se recorta a
+``SESSION_SUMMARY_CHARS``: el contexto que se agrega al prompt tiene un
+tamaño acotado sin importar qué tan larga sea la conversación.
+
+Las sesiones se guardan en SQLite (WAL) en ``SESSION_DB_PATH``, compartido
+por todos los workers, con una LRU en memoria de ``SESSION_CACHE_SIZE``
+sesiones delante. Cada lectura compara la versión de la fila (una consulta
+por llave primaria) antes de usar la copia en memoria, así que el siguiente
+turno puede atenderlo cualquier worker. Tras ``SESSION_TTL_SECONDS`` sin
+mensajes la conversación se olvida, pero el idioma se conserva.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from . import metrics
+
+SESSION_DB_PATH = os.getenv(
+    "SESSION_DB_PATH",
+    str(Path(__file__).resolve().parent / "sessions.db"),
+)
+# Sesiones que se conservan en memoria en cada worker
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+# Inactividad tras la cual se olvidan los datos parciales y los turnos
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "900"))
+# Inactividad tras la cual se borra la sesión completa (incluido el idioma)
+SESSION_RETENTION_SECONDS = float(os.getenv("SESSION_RETENTION_SECONDS", str(30 * 24 * 3600)))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "4"))
+SESSION_SUMMARY_CHARS = int(os.getenv("SESSION_SUMMARY_CHARS", "400"))
+# Caracteres de cada mensaje que se conservan en los turnos recientes y al
+# compactarlo en el resumen
+TURN_CONTEXT_CHARS = 300
+TURN_SUMMARY_CHARS = 120
+PRUNE_INTERVAL_SECONDS = 3600
+
+# Idiomas que ofrece ws_bot; los demás códigos se pasan tal cual al prompt
+LANGUAGE_NAMES = {
+    "en": "inglés",
+    "es": "español",
+    "fr": "francés",
+    "ar": "árabe",
+    "ru": "ruso",
+    "it": "italiano",
+    "pt": "portugués",
+    "ja": "japonés",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    wa_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated_at);
+"""
+
+
+@dataclass
+class Session:
+    """Estado de la conversación de un usuario."""
+    wa_id: str
+    language: Optional[str] = None
+    monto: Optional[float] = None
+    destinatario: Optional[str] = None
+    summary: str = ""
+    turns: List[List[str]] = field(default_factory=list)  # [usuario, respuesta]
+    unconfirmed: List[List[Any]] = field(default_factory=list)  # [monto, nombre]
+    updated_at: float = 0.0
+    version: int = 0
+
+    def add_turn(self, user: str, reply: str) -> None:
+        """Agrega un turno y compacta en el resumen los que excedan SESSION_MAX_TURNS."""
+        self.turns.append([user, reply])
+        while len(self.turns) > SESSION_MAX_TURNS:
+            old_user, old_reply = self.turns.pop(0)
+            line = f"Usuario: {_clip(old_user, TURN_SUMMARY_CHARS)} / Paguito: {_clip(old_reply, TURN_SUMMARY_CHARS)}"
+            summary = f"{self.summary}\n{line}" if self.summary else line
+            # Se conservan las líneas más recientes que quepan
+            while len(summary) > SESSION_SUMMARY_CHARS and "\n" in summary:
+                summary = summary.split("\n", 1)[1]
+            self.summary = summary[-SESSION_SUMMARY_CHARS:]
+
+    def remember_payment(self, monto: Optional[float], destinatario: Optional[str]) -> None:
+        """Guarda los datos parciales; al completarse el pago se limpian."""
+        if monto is not None and destinatario:
+            self.monto, self.destinatario = None, None
+        else:
+            self.monto, self.destinatario = monto, destinatario
+
+    def forget_conversation(self) -> None:
+        self.monto = None
+        self.destinatario = None
+        self.summary = ""
+        self.turns = []
+        self.unconfirmed = []
+
+    def context(self) -> str:
+        """Bloque de contexto para el prompt de extracción (vacío si no hay nada)."""
+        lines = []
+        if self.language:
+            lines.append(f"Responde en {LANGUAGE_NAMES.get(self.language, self.language)}.")
+        pending = []
+        if self.monto is not None:
+            pending.append(f"monto {self.monto:g}")
+        if self.destinatario:
+            pending.append(f"destinatario {self.destinatario}")
+        if pending:
+            lines.append(
+                f"Datos de un pago pendiente dichos antes: {', '.join(pending)}. "
+                "Úsalos si el mensaje actual los completa."
+            )
+        if self.unconfirmed:
+            pagos = ", ".join(f"{monto:g} a {nombre}" for monto, nombre in self.unconfirmed)
+            lines.append(
+                f"Se preguntó al usuario si quiso decir: {pagos}. Si lo confirma, "
+                "extrae exactamente esos montos y destinatarios; si no, ignóralos."
+            )
+        if self.summary:
+            lines.append(f"Resumen de la conversación anterior:\n{self.summary}")
+        if self.turns:
+            recent = "\n".join(
+                f"Usuario: {_clip(user, TURN_CONTEXT_CHARS)}\nPaguito: {_clip(reply, TURN_CONTEXT_CHARS)}"
+                for user, reply in self.turns
+            )
+            lines.append(f"Últimos mensajes:\n{recent}")
+        return "\n\n".join(lines)
+
+
+def _clip(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+class SessionStore:
+    """Sesiones en SQLite compartido con una LRU en memoria delante."""
+
+    def __init__(
+        self,
+        path: str = SESSION_DB_PATH,
+        capacity: int = SESSION_CACHE_SIZE,
+        ttl: float = SESSION_TTL_SECONDS,
+    ):
+        self.path = path
+        self.capacity = max(1, capacity)
+        self.ttl = ttl
+        self._cache: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=2000")
+        self._conn.executescript(_SCHEMA)
+
+    def get(self, wa_id: str) -> Session:
+        """Sesión del usuario; una nueva si no existe o si la conversación venció."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version FROM sessions WHERE wa_id = ?", (wa_id,)).fetchone()
+            cached = self._cache.get(wa_id)
+            if cached is not None and row is not None and cached.version == row[0]:
+                self._cache.move_to_end(wa_id)
+                metrics.inc("sessions.cache_hits")
+                session = _copy(cached)
+            elif row is None:
+                session = Session(wa_id)
+            else:
+                metrics.inc("sessions.cache_misses")
+                data = self._conn.execute(
+                    "SELECT data FROM sessions WHERE wa_id = ?", (wa_id,)).fetchone()
+                session = Session(**json.loads(data[0])) if data else Session(wa_id)
+                self._remember(session)
+                session = _copy(session)
+        if session.updated_at and time.time() - session.updated_at > self.ttl:
+            metrics.inc("sessions.expired")
+            session.forget_conversation()
+        return session
+
+    def save(self, session: Session) -> None:
+        """Guarda la sesión (última escritura gana entre workers)."""
+        session.updated_at = time.time()
+        # Versión única entre workers: dos que guardan a partir de la misma
+        # versión no dejan la misma, y la LRU del que perdió no queda vigente
+        session.version = time.time_ns()
+        with self._lock:
+            try:
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT INTO sessions (wa_id, version, updated_at, data) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(wa_id) DO UPDATE SET version = excluded.version, "
+                        "updated_at = excluded.updated_at, data = excluded.data",
+                        (session.wa_id, session.version, session.updated_at,
+                         json.dumps(asdict(session), ensure_ascii=False)),
+                    )
+            except sqlite3.Error as exc:
+                metrics.inc("sessions.write_errors")
+                print(f"No se pudo guardar la sesión de {session.wa_id}: {exc}")
+                return
+            self._remember(_copy(session))
+            if session.updated_at - self._last_prune > PRUNE_INTERVAL_SECONDS:
+                self._prune(session.updated_at)
+
+    def set_language(self, wa_id: str, language: str) -> Session:
+        session = self.get(wa_id)
+        session.language = language
+        self.save(session)
+        return session
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            cached = len(self._cache)
+        return {"cached": cached, "capacity": self.capacity, "ttl": self.ttl}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _remember(self, session: Session) -> None:
+        self._cache[session.wa_id] = session
+        self._cache.move_to_end(session.wa_id)
+        while len(self._cache) > self.capacity:
+            self._cache.popitem(last=False)
+            metrics.inc("sessions.evicted")
+        metrics.set_gauge("sessions.cached", len(self._cache))
+
+    def _prune(self, now: float) -> None:
+        self._last_prune = now
+        try:
+            with self._conn:
+                deleted = self._conn.execute(
+                    "DELETE FROM sessions WHERE updated_at < ?",
+                    (now - SESSION_RETENTION_SECONDS,),
+                ).rowcount
+        except sqlite3.Error as exc:
+            print(f"No se pudieron depurar las sesiones: {exc}")
+            return
+        if deleted:
+            metrics.inc("sessions.pruned", deleted)
+
+
+def _copy(session: Session) -> Session:
+    # Cada petición trabaja sobre su copia; la de la LRU solo cambia al guardar
+    return Session(**{
+        **asdict(session),
+        "turns": [list(turn) for turn in session.turns],
+        "unconfirmed": [list(pago) for pago in session.unconfirmed],
+    })
+
+
+_store: Optional[SessionStore] = None
+_store_lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    """Obtiene el almacén de sesiones compartido, inicializándolo si es necesario"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = SessionStore()
+    return _store
+
+
+def close_session_store() -> None:
+    """Cierra el almacén de sesiones si llegó a crearse."""
+    if _store is not None:
+        _store.close()
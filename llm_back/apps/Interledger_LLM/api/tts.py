@@ -0,0 +1,194 @@
+"""
+Síntesis de voz por oraciones, en streaming y con caché.
+
+En lugar de esperar el MP3 completo de toda la respuesta, el texto se parte
+en oraciones: la primera se escribe al archivo conforme llegan sus bytes
+(streaming del SDK) mientras las siguientes se sintetizan en paralelo, y
+cada una se agrega en orden en cuanto termina. ``tts.first_byte`` mide
+cuándo llega al archivo el primer byte de audio. Cada oración se guarda en
+una caché en disco, así frases repetidas (p. ej. las confirmaciones
+"Confirmo monto ...") no se vuelven a sintetizar.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterator, List, Optional
+
+from . import metrics
+from .breaker import openai_breaker
+
+TTS_MODEL = os.getenv("TTS_MODEL", "gpt-4o-mini-tts")
+TTS_VOICE = os.getenv("TTS_VOICE", "coral")
+TTS_MAX_PARALLEL = int(os.getenv("TTS_MAX_PARALLEL", "4"))
+TTS_CACHE_DIR = Path(os.getenv(
+    "TTS_CACHE_DIR", Path(__file__).resolve().parent / "tts_cache"))
+# Las oraciones sin usar durante este tiempo se eliminan de la caché
+TTS_CACHE_RETENTION_SECONDS = int(os.getenv("TTS_CACHE_RETENTION_SECONDS", str(7 * 24 * 3600)))
+CACHE_PRUNE_INTERVAL_SECONDS = 3600
+# Oraciones más cortas que esto se unen a la siguiente
+MIN_SENTENCE_CHARS = 24
+STREAM_CHUNK_BYTES = 16 * 1024
+
+# Recibe una oración y produce los bytes MP3 conforme llegan
+SpeechStream = Callable[[str], Iterator[bytes]]
+
+_SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+_last_prune = 0.0
+
+
+@dataclass
+class TTSResult:
+    sentences: int
+    cache_hits: int
+    first_byte_seconds: Optional[float]
+    total_seconds: float
+
+
+def split_sentences(text: str) -> List[str]:
+    """Parte el texto en oraciones, uniendo las demasiado cortas."""
+    sentences: List[str] = []
+    pending = ""
+    for part in _SENTENCE_END.split(text.strip()):
+        pending = f"{pending} {part}".strip() if pending else part.strip()
+        if len(pending) >= MIN_SENTENCE_CHARS:
+            sentences.append(pending)
+            pending = ""
+    if pending:
+        if sentences:
+            sentences[-1] = f"{sentences[-1]} {pending}"
+        else:
+            sentences.append(pending)
+    return sentences
+
+
+def openai_speech_stream(get_client: Callable[[], Any], timeout: float) -> SpeechStream:
+    """
+    SpeechStream respaldado por el endpoint de TTS de OpenAI en streaming.
+
+    ``get_client`` se llama por oración, así cada una usa la key del pool con
+    más margen.
+    """
+
+    def stream(sentence: str) -> Iterator[bytes]:
+        speech = get_client().with_options(timeout=timeout).audio.speech
+        with openai_breaker.guard():
+            with speech.with_streaming_response.create(
+                model=TTS_MODEL,
+                voice=TTS_VOICE,
+                input=sentence,
+                response_format="mp3",
+            ) as response:
+                yield from response.iter_bytes(STREAM_CHUNK_BYTES)
+
+    return stream
+
+
+def synthesize_to_file(
+    text: str,
+    output_path: Path,
+    stream: SpeechStream,
+    max_workers: int = TTS_MAX_PARALLEL,
+) -> TTSResult:
+    """
+    Sintetiza text en output_path oración por oración.
+
+    La primera oración se escribe en streaming; las demás se sintetizan en
+    paralelo (o se leen de la caché) y se agregan en orden en cuanto termina
+    cada una, sin esperar a las siguientes.
+    """
+    start = time.perf_counter()
+    sentences = split_sentences(text)
+    first_byte: Optional[float] = None
+    cache_hits = sum(1 for sentence in sentences if _cache_path(sentence).exists())
+
+    with open(output_path, "wb") as output, ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(sentences) - 1))) as executor:
+        rest = [executor.submit(_synthesize_cached, sentence, stream)
+                for sentence in sentences[1:]]
+
+        if sentences:
+            for chunk in _stream_cached(sentences[0], stream):
+                if first_byte is None:
+                    first_byte = time.perf_counter() - start
+                output.write(chunk)
+                output.flush()
+
+        for future in rest:
+            content = future.result()
+            if first_byte is None and content:
+                first_byte = time.perf_counter() - start
+            output.write(content)
+            output.flush()
+
+    total = time.perf_counter() - start
+    metrics.inc("tts.sentences", len(sentences))
+    metrics.inc("tts.cache_hits", cache_hits)
+    if first_byte is not None:
+        metrics.observe("tts.first_byte", first_byte)
+    metrics.observe("tts.total", total)
+    prune_cache()
+    return TTSResult(len(sentences), cache_hits, first_byte, total)
+
+
+def prune_cache(force: bool = False) -> int:
+    """Elimina de la caché las oraciones que no se han usado recientemente."""
+    global _last_prune
+    now = time.time()
+    if not force and now - _last_prune < CACHE_PRUNE_INTERVAL_SECONDS:
+        return 0
+    _last_prune = now
+    removed = 0
+    if not TTS_CACHE_DIR.exists():
+        return 0
+    for path in TTS_CACHE_DIR.iterdir():
+        try:
+            if now - path.stat().st_mtime > TTS_CACHE_RETENTION_SECONDS:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            continue
+    return removed
+
+
+def _cache_path(sentence: str) -> Path:
+    key = hashlib.sha256(
+        f"{TTS_MODEL}|{TTS_VOICE}|{sentence}".encode("utf-8")).hexdigest()
+    return TTS_CACHE_DIR / f"{key}.mp3"
+
+
+def _stream_cached(sentence: str, stream: SpeechStream) -> Iterator[bytes]:
+    """Emite los bytes de una oración desde la caché o desde el stream, guardándolos."""
+    path = _cache_path(sentence)
+    try:
+        content = path.read_bytes()
+        os.utime(path)  # mantenerla viva para la retención
+    except FileNotFoundError:
+        pass
+    else:
+        yield content
+        return
+
+    TTS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=TTS_CACHE_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as cache_file:
+            for chunk in stream(sentence):
+                cache_file.write(chunk)
+                yield chunk
+        os.replace(temp_path, path)
+        temp_path = None
+    finally:
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _synthesize_cached(sentence: str, stream: SpeechStream) -> bytes:
+    return b"".join(_stream_cached(sentence, stream))
@@ -0,0 +1,214 @@
+"""
+Contabilidad de tokens de las llamadas a OpenAI.
+
+- ``record_usage`` guarda el ``usage`` que devuelve cada respuesta (chat
+  completions o responses) en una base SQLite local (``LLM_USAGE_DB_PATH``),
+  junto con la etapa, el modelo y la latencia. Se llama desde los hilos del
+  router, fuera del event loop.
+- ``usage_report`` agrega tokens y costo estimado por etapa y modelo
+  (GET /usage).
+- ``count_tokens`` y ``count_message_tokens`` tokenizan prompts sin llamar a
+  la API, con el tokenizador de OpenAI (``tiktoken``).
+
+Uso sin servidor:
+    uv run python -m apps.Interledger_LLM.api.usage prompts
+    uv run python -m apps.Interledger_LLM.api.usage report --hours 24
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+import tiktoken
+
+from . import metrics
+
+LLM_USAGE_DB_PATH = os.getenv(
+    "LLM_USAGE_DB_PATH",
+    str(Path(__file__).resolve().parent / "llm_usage.db"),
+)
+# Tokens extra por mensaje del chat y para preparar la respuesta (formato de OpenAI)
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# USD por millón de tokens: (entrada, entrada en caché, salida)
+MODEL_PRICES: Dict[str, tuple] = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_usage (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    stage TEXT NOT NULL,
+    model TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    cached_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    latency REAL
+);
+CREATE INDEX IF NOT EXISTS idx_llm_usage_created ON llm_usage (created_at);
+"""
+
+_lock = threading.Lock()
+_conn: Optional[sqlite3.Connection] = None
+_encodings: Dict[str, Any] = {}
+
+
+def _connection() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        Path(LLM_USAGE_DB_PATH).parent.mkdir(parents=True, exist_ok=True)
+        _conn = sqlite3.connect(LLM_USAGE_DB_PATH, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn.executescript(_SCHEMA)
+    return _conn
+
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    """Tokens de un texto para el modelo dado."""
+    encoding = _encodings.get(model)
+    if encoding is None:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+        _encodings[model] = encoding
+    return len(encoding.encode(text))
+
+
+def count_message_tokens(messages: Sequence[Dict[str, str]], model: str = "gpt-4o-mini") -> int:
+    """Tokens de entrada de una lista de mensajes de chat completions."""
+    return TOKENS_PER_REPLY + sum(
+        TOKENS_PER_MESSAGE + count_tokens(message.get("content") or "", model)
+        for message in messages
+    )
+
+
+def tokenizer_name() -> str:
+    return f"tiktoken {tiktoken.__version__}"
+
+
+def record_usage(stage: str, model: str, response: Any, latency: Optional[float] = None) -> None:
+    """
+    Guarda el usage de una respuesta de OpenAI.
+
+    Acepta el formato de chat completions (prompt_tokens/completion_tokens)
+    y el de responses (input_tokens/output_tokens). Si la respuesta no trae
+    usage no se guarda nada.
+    """
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    prompt = getattr(usage, "prompt_tokens", None)
+    if prompt is None:
+        prompt = getattr(usage, "input_tokens", 0)
+    completion = getattr(usage, "completion_tokens", None)
+    if completion is None:
+        completion = getattr(usage, "output_tokens", 0)
+    details = getattr(usage, "prompt_tokens_details", None) or getattr(usage, "input_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+
+    metrics.inc(f"usage.{stage}.prompt_tokens", prompt or 0)
+    metrics.inc(f"usage.{stage}.completion_tokens", completion or 0)
+    try:
+        with _lock:
+            conn = _connection()
+            with conn:
+                conn.execute(
+                    "INSERT INTO llm_usage (created_at, stage, model, prompt_tokens, cached_tokens, "
+                    "completion_tokens, latency) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (time.time(), stage, model, prompt or 0, cached, completion or 0, latency),
+                )
+    except sqlite3.Error as exc:
+        print(f"No se pudo guardar el usage de {stage}/{model}: {exc}")
+
+
+def estimate_cost(model: str, prompt: int, cached: int, completion: int) -> Optional[float]:
+    """Costo en USD; None si el modelo no está en MODEL_PRICES."""
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        # Versiones fechadas (gpt-4o-mini-2024-07-18) usan el precio de su familia
+        family = max((name for name in MODEL_PRICES if model.startswith(name)), key=len, default=None)
+        prices = MODEL_PRICES.get(family) if family else None
+    if prices is None:
+        return None
+    input_price, cached_price, output_price = prices
+    return ((prompt - cached) * input_price + cached * cached_price + completion * output_price) / 1_000_000
+
+
+def usage_report(since: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    Tokens y costo estimado por etapa y modelo.
+
+    Args:
+        since: Timestamp desde el cual sumar (todo el historial si es None)
+    """
+    with _lock:
+        rows = _connection().execute(
+            "SELECT stage, model, COUNT(*), SUM(prompt_tokens), SUM(cached_tokens), "
+            "SUM(completion_tokens), AVG(latency) FROM llm_usage WHERE created_at >= ? "
+            "GROUP BY stage, model ORDER BY stage, model",
+            (since or 0,),
+        ).fetchall()
+    report = []
+    for stage, model, calls, prompt, cached, completion, latency in rows:
+        cost = estimate_cost(model, prompt, cached, completion)
+        report.append({
+            "stage": stage,
+            "model": model,
+            "calls": calls,
+            "prompt_tokens": prompt,
+            "cached_tokens": cached,
+            "completion_tokens": completion,
+            "avg_prompt_tokens": round(prompt / calls, 1),
+            "avg_latency": round(latency, 3) if latency is not None else None,
+            "cost_usd": round(cost, 6) if cost is not None else None,
+        })
+    return report
+
+
+def _print_prompts() -> None:
+    from .agent.prompts import VISION_PROMPT, extraction_prompt, prompt_sections
+
+    print(f"Tokens por sección del prompt de extracción ({tokenizer_name()})")
+    for name, text in prompt_sections():
+        print(f"{name:>32} | {count_tokens(text):>5}")
+    system = count_message_tokens([{"role": "system", "content": extraction_prompt()}])
+    print(f"{'mensaje de sistema (con formato)':>32} | {system:>5}")
+    print(f"{'prompt de visión':>32} | {count_tokens(VISION_PROMPT):>5}")
+
+
+def _print_report(hours: float) -> None:
+    report = usage_report(time.time() - hours * 3600)
+    if not report:
+        print("Sin llamadas registradas")
+        return
+    print(f"{'etapa':>10} | {'modelo':>12} | {'llamadas':>8} | {'entrada':>8} | {'caché':>7} | {'salida':>7} | {'USD':>9}")
+    for row in report:
+        cost = f"{row['cost_usd']:.4f}" if row["cost_usd"] is not None else "?"
+        print(
+            f"{row['stage']:>10} | {row['model']:>12} | {row['calls']:>8} | {row['prompt_tokens']:>8} | "
+            f"{row['cached_tokens']:>7} | {row['completion_tokens']:>7} | {cost:>9}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Contabilidad de tokens de las llamadas a OpenAI")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser("prompts", help="Tokeniza las secciones del prompt de extracción")
+    report_parser = subcommands.add_parser("report", help="Tokens y costo por etapa y modelo")
+    report_parser.add_argument("--hours", type=float, default=24.0)
+    args = parser.parse_args()
+    if args.command == "prompts":
+        _print_prompts()
+    else:
+        _print_report(args.hours)
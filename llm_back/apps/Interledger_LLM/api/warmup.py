@@ -0,0 +1,216 @@
+"""
+Calentamiento al arrancar y readiness del servicio (GET /ready).
+
+Al iniciar, ``Readiness.run`` prepara en segundo plano todo lo que antes se
+pagaba en las primeras peticiones: construye los clientes del pool de keys de
+OpenAI, abre las conexiones (TLS) hacia OpenAI y el servicio de pagos, carga
+el prompt de extracción, el directorio de destinatarios, la bitácora, las
+sesiones y el planificador.
+
+Las keys de OpenAI se sondean solo durante el calentamiento
+(``WARMUP_ONLY_PROBES``): repetir ``models.retrieve`` con cada key no aporta
+nada que las llamadas reales no detecten ya (el pool enfría las keys que
+fallan y el breaker corta si OpenAI cae). Después solo se repite el sondeo
+del servicio de pagos cada ``KEEP_WARM_INTERVAL`` segundos para que su
+conexión no expire.
+
+``/ready`` responde 503 hasta que termina el calentamiento y mientras falla
+alguna dependencia que se sigue sondeando; el resultado de OpenAI del
+calentamiento se reporta como informativo. El resultado de cada sondeo se
+guarda ``READY_CACHE_SECONDS`` y consultas simultáneas comparten el mismo
+sondeo en curso.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, List, Optional
+
+import openai
+
+from . import metrics
+from .agent.key_pool import get_key_pool
+from .agent.prompts import extraction_prompt
+from .directory import get_directory
+from .ledger import get_ledger
+from .payment import PAYMENT_HEALTH_URL, get_payment_client
+from .scheduler import get_scheduler
+from .sessions import get_session_store
+
+# Vigencia del resultado de un sondeo
+READY_CACHE_SECONDS = float(os.getenv("READY_CACHE_SECONDS", "10"))
+# Cada cuánto se repite el sondeo de pagos para mantener su conexión abierta;
+# debe ser menor que PAYMENT_KEEPALIVE_SECONDS
+KEEP_WARM_INTERVAL = float(os.getenv("KEEP_WARM_INTERVAL", "30"))
+READY_PROBE_TIMEOUT = float(os.getenv("READY_PROBE_TIMEOUT", "5"))
+# Modelo que se consulta para sondear OpenAI (GET /models/{id}, sin costo)
+OPENAI_PROBE_MODEL = os.getenv("OPENAI_PROBE_MODEL", "gpt-4o-mini")
+# Sondeos que solo corren al calentar; no se repiten ni deciden /ready
+WARMUP_ONLY_PROBES = frozenset({"openai"})
+
+
+@dataclass
+class ProbeResult:
+    ok: bool
+    detail: Optional[str]
+    latency: float
+    checked_at: float
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "ok": self.ok,
+            "detail": self.detail,
+            "latency": round(self.latency, 3),
+            "age": round(time.monotonic() - self.checked_at, 1),
+        }
+
+
+def _probe_openai() -> Optional[str]:
+    """
+    Consulta un modelo con cada key, lo que además abre su conexión.
+
+    Falla solo si ninguna key responde; las que fallan van en el detalle.
+    """
+    keys = get_key_pool().keys
+    errors = []
+    for key in keys:
+        client = key.client.with_options(timeout=READY_PROBE_TIMEOUT, max_retries=0)
+        try:
+            client.models.retrieve(OPENAI_PROBE_MODEL)
+        except openai.RateLimitError:
+            # La key es válida y la conexión quedó abierta; el pool ya la enfrió
+            pass
+        except openai.OpenAIError as exc:
+            errors.append(f"{key.name}: {exc}")
+    if len(errors) == len(keys):
+        raise RuntimeError("; ".join(errors))
+    return "; ".join(errors) or None
+
+
+async def _probe_payments() -> Optional[str]:
+    response = await get_payment_client().get(PAYMENT_HEALTH_URL, timeout=READY_PROBE_TIMEOUT)
+    if response.status_code >= 500:
+        raise RuntimeError(f"{PAYMENT_HEALTH_URL} respondió {response.status_code}")
+    return None
+
+
+async def _in_thread(fn: Callable[[], Any]) -> Optional[str]:
+    await asyncio.to_thread(fn)
+    return None
+
+
+def _load_local_state() -> None:
+    extraction_prompt()
+    get_directory()
+    get_ledger()
+    get_session_store()
+
+
+DEFAULT_PROBES: Dict[str, Callable[[], Awaitable[Optional[str]]]] = {
+    "openai": lambda: _in_thread(_probe_openai),
+    "payments": _probe_payments,
+}
+
+
+class Readiness:
+    """Calentamiento inicial y sondeos de dependencias con caché."""
+
+    def __init__(
+        self,
+        probes: Optional[Dict[str, Callable[[], Awaitable[Optional[str]]]]] = None,
+        cache_seconds: float = READY_CACHE_SECONDS,
+        warmup_only: FrozenSet[str] = WARMUP_ONLY_PROBES,
+    ):
+        self.probes = probes if probes is not None else DEFAULT_PROBES
+        self.warmup_only = warmup_only
+        self.cache_seconds = cache_seconds
+        self.warmed = False
+        self.warmup_seconds: Optional[float] = None
+        self._results: Dict[str, ProbeResult] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def warm_up(self) -> None:
+        """Carga el estado local y corre todos los sondeos por primera vez."""
+        start = time.monotonic()
+        get_scheduler()
+        try:
+            await asyncio.to_thread(_load_local_state)
+        except Exception as exc:
+            print(f"Error al cargar el estado local durante el calentamiento: {exc}")
+        await asyncio.gather(*(self.check(name, force=True) for name in self.probes))
+        self.warmup_seconds = time.monotonic() - start
+        metrics.observe("warmup.total", self.warmup_seconds)
+        self.warmed = True
+
+    async def run(self) -> None:
+        """Calienta el servicio y luego mantiene abiertas las conexiones que se siguen sondeando."""
+        await self.warm_up()
+        recurring = self._recurring()
+        if not recurring:
+            return
+        while True:
+            await asyncio.sleep(KEEP_WARM_INTERVAL)
+            await asyncio.gather(*(self.check(name, force=True) for name in recurring))
+
+    async def check(self, name: str, force: bool = False) -> ProbeResult:
+        """Resultado del sondeo; se reutiliza mientras esté vigente."""
+        cached = self._results.get(name)
+        if not force and cached is not None and time.monotonic() - cached.checked_at < self.cache_seconds:
+            return cached
+        task = self._inflight.get(name)
+        if task is None:
+            task = asyncio.create_task(self._run_probe(name))
+            self._inflight[name] = task
+            task.add_done_callback(lambda _: self._inflight.pop(name, None))
+        return await asyncio.shield(task)
+
+    async def report(self) -> Dict[str, Any]:
+        """Estado de readiness: listo si terminó el calentamiento y responden los sondeos recurrentes."""
+        if not self.warmed:
+            return {"ready": False, "warming_up": True, "checks": {}}
+        recurring = self._recurring()
+        results = await asyncio.gather(*(self.check(name) for name in recurring))
+        checks = {name: result.as_dict() for name, result in zip(recurring, results)}
+        for name in self.probes:
+            # Resultado del calentamiento, sin volver a llamar al servicio externo
+            if name not in checks and name in self._results:
+                checks[name] = dict(self._results[name].as_dict(), warmup_only=True)
+        return {
+            "ready": all(result.ok for result in results),
+            "warmup_seconds": round(self.warmup_seconds or 0.0, 3),
+            "checks": checks,
+        }
+
+    def _recurring(self) -> List[str]:
+        return [name for name in self.probes if name not in self.warmup_only]
+
+    async def _run_probe(self, name: str) -> ProbeResult:
+        start = time.monotonic()
+        try:
+            detail = await asyncio.wait_for(self.probes[name](), timeout=READY_PROBE_TIMEOUT * 2)
+            ok = True
+        except Exception as exc:
+            detail = str(exc) or type(exc).__name__
+            ok = False
+        latency = time.monotonic() - start
+        result = ProbeResult(ok, detail, latency, time.monotonic())
+        self._results[name] = result
+        metrics.observe(f"ready.{name}", latency)
+        metrics.set_gauge(f"ready.{name}", 1.0 if ok else 0.0)
+        if not ok:
+            metrics.inc(f"ready.{name}.failures")
+        return result
+
+
+_readiness: Optional[Readiness] = None
+
+
+def get_readiness() -> Readiness:
+    """Obtiene el estado de readiness compartido, inicializándolo si es necesario"""
+    global _readiness
+    if _readiness is None:
+        _readiness = Readiness()
+    return _readiness
@@ -0,0 +1,853 @@
+"""
+Benchmarks locales del backend LLM.
+
+No llaman a OpenAI: las llamadas remotas se simulan con latencias
+proporcionales al trabajo enviado, para comparar las optimizaciones entre sí.
+
+Uso:
+    uv run python benchmark.py audio tts directory ledger payments outbox prompt keys scheduler warmup qos sessions json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import wave
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from pathlib import Path
+
+import httpx
+import openai
+
+from apps.Interledger_LLM.api import ledger, metrics, outbox, payment, qos, scheduler, sessions, tts, usage
+from apps.Interledger_LLM.api.agent import prompts, schemas
+from apps.Interledger_LLM.api.agent.key_pool import KeyPool
+from apps.Interledger_LLM.api.breaker import CircuitBreaker, CircuitOpenError, _is_openai_failure
+from apps.Interledger_LLM.api.directory import Recipient, RecipientIndex
+from apps.Interledger_LLM.api.audio import (
+    SAMPLE_RATE,
+    prepare_audio,
+    transcribe_chunks,
+)
+
+# Latencia simulada de transcripción: fija + proporcional a los segundos subidos
+TRANSCRIBE_BASE_LATENCY = 0.3
+TRANSCRIBE_SECONDS_FACTOR = 0.01
+# Latencia simulada del servicio de pagos (Open Payments) por petición
+PAYMENT_LATENCY = 0.2
+# Latencia simulada de TTS: fija + proporcional a los caracteres sintetizados
+TTS_BASE_LATENCY = 0.25
+TTS_CHAR_FACTOR = 0.004
+# Latencia simulada de la extracción: fija + proporcional a los tokens de entrada
+EXTRACTION_BASE_LATENCY = 0.35
+EXTRACTION_TOKEN_FACTOR = 0.0004
+
+TTS_REPLY = (
+    "Perfecto, Yorch. Voy a enviar 250 pesos a la cuenta 5512345678 por la cena del viernes. "
+    "Revisa los datos antes de confirmar, por favor. "
+    "Confirmo monto $250.00. Confirmo cuenta 5512345678."
+)
+
+
+def _synthetic_voice_note(seconds: float, seed: int = 7) -> array:
+    """Ráfagas tipo voz separadas por pausas, con silencio al inicio y al final."""
+    rng = random.Random(seed)
+    voice = array("h", (
+        int(6000 * math.sin(2 * math.pi * 180 * i / SAMPLE_RATE)
+            * (0.6 + 0.4 * math.sin(2 * math.pi * 3 * i / SAMPLE_RATE)))
+        + rng.randint(-200, 200)
+        for i in range(SAMPLE_RATE)
+    ))
+    silence = array("h", (rng.randint(-60, 60) for _ in range(SAMPLE_RATE)))
+
+    def take(source: array, duration: float) -> array:
+        out = array("h")
+        remaining = int(duration * SAMPLE_RATE)
+        while remaining > 0:
+            part = source[:min(remaining, len(source))]
+            out.extend(part)
+            remaining -= len(part)
+        return out
+
+    samples = take(silence, 3.0)
+    body = seconds - 8.0
+    while body > 0:
+        burst = min(body, rng.uniform(1.0, 4.0))
+        samples.extend(take(voice, burst))
+        gap = min(max(body - burst, 0.0), rng.uniform(0.3, 1.5))
+        samples.extend(take(silence, gap))
+        body -= burst + gap
+    samples.extend(take(silence, 5.0))
+    return samples
+
+
+def _write_wav(samples: array) -> str:
+    fd, path = tempfile.mkstemp(suffix=".wav")
+    os.close(fd)
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(samples.tobytes())
+    return path
+
+
+def _fake_transcribe(duration: float) -> str:
+    time.sleep(TRANSCRIBE_BASE_LATENCY + TRANSCRIBE_SECONDS_FACTOR * duration)
+    return "texto"
+
+
+def bench_audio() -> None:
+    print("Pre-procesamiento de notas de voz (transcripción simulada)")
+    print(f"{'nota':>6} | {'sin pre-proc':>12} | {'pre-proc':>9} | {'trozos':>6} | {'subido':>8} | {'prep':>7}")
+    for seconds in (30, 120, 300):
+        path = _write_wav(_synthetic_voice_note(seconds))
+        try:
+            start = time.perf_counter()
+            _fake_transcribe(seconds)
+            baseline = time.perf_counter() - start
+
+            start = time.perf_counter()
+            prepared = prepare_audio(path)
+            prep = time.perf_counter() - start
+            transcribe_chunks(
+                prepared.chunks,
+                lambda chunk: _fake_transcribe(chunk.end - chunk.start),
+            )
+            total = time.perf_counter() - start
+        finally:
+            os.remove(path)
+        print(
+            f"{seconds:>5}s | {baseline:>11.2f}s | {total:>8.2f}s | "
+            f"{len(prepared.chunks):>6} | {prepared.trimmed_seconds:>7.1f}s | {prep:>6.2f}s"
+        )
+
+
+def _fake_speech_stream(sentence: str):
+    """Simula el streaming de TTS: espera inicial y luego bytes a ritmo constante."""
+    latency = TTS_BASE_LATENCY + TTS_CHAR_FACTOR * len(sentence)
+    time.sleep(latency * 0.4)
+    for _ in range(4):
+        time.sleep(latency * 0.15)
+        yield b"\x00" * 4096
+
+
+def bench_tts() -> None:
+    print("TTS: respuesta completa vs. oraciones en streaming (síntesis simulada)")
+    start = time.perf_counter()
+    b"".join(_fake_speech_stream(TTS_REPLY))
+    baseline = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        tts.TTS_CACHE_DIR = Path(cache_dir)
+        output = Path(cache_dir) / "respuesta.mp3"
+        cold = tts.synthesize_to_file(TTS_REPLY, output, _fake_speech_stream)
+        warm = tts.synthesize_to_file(TTS_REPLY, output, _fake_speech_stream)
+
+    print(f"{'modo':>22} | {'1er byte':>8} | {'total':>7} | {'oraciones':>9} | {'caché':>5}")
+    # Antes el archivo se escribía con response.content: el primer byte llegaba al final
+    print(f"{'completo (antes)':>22} | {baseline:>7.2f}s | {baseline:>6.2f}s | {1:>9} | {0:>5}")
+    for label, result in (("oraciones, frío", cold), ("oraciones, caché", warm)):
+        print(
+            f"{label:>22} | {result.first_byte_seconds:>7.2f}s | {result.total_seconds:>6.2f}s | "
+            f"{result.sentences:>9} | {result.cache_hits:>5}"
+        )
+
+
+_FIRST_NAMES = ["santiago", "valeria", "jose", "ximena", "guillermo", "cecilia", "rodrigo",
+                "yolanda", "joaquin", "beatriz", "hector", "lucia", "vicente", "zoe", "quetzal"]
+_SYLLABLES = ["ba", "ce", "ro", "llo", "que", "za", "vi", "go", "ner", "tal", "mon", "gui", "jar", "ches"]
+
+
+def _synthetic_recipients(count: int, seed: int = 11):
+    rng = random.Random(seed)
+    for i in range(count):
+        surname = "".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 4)))
+        yield Recipient(
+            name=f"{rng.choice(_FIRST_NAMES)} {surname} {rng.choice(_SYLLABLES)}{rng.choice(_SYLLABLES)}",
+            account=f"55{i:08d}",
+            wallet_url=f"https://ilp.interledger-test.dev/user-{i}",
+        )
+
+
+def _median_lookup_us(index: RecipientIndex, queries) -> str:
+    """Mediana en µs y porcentaje de búsquedas que regresan al destinatario esperado."""
+    timings = []
+    hits = 0
+    for query, expected in queries:
+        start = time.perf_counter()
+        match = index.lookup(query)
+        timings.append((time.perf_counter() - start) * 1e6)
+        hits += bool(match and match.recipient.name == expected)
+    timings.sort()
+    return f"{timings[len(timings) // 2]:.0f} ({100 * hits // len(queries)}%)"
+
+
+def bench_directory() -> None:
+    print("Directorio de destinatarios: mediana por búsqueda en µs (% resuelto al destinatario correcto)")
+    print(f"{'entradas':>8} | {'índice':>7} | {'cuenta':>10} | {'nombre':>10} | {'fonética':>10} | {'difusa':>10}")
+    for size in (1_000, 10_000, 100_000):
+        recipients = list(_synthetic_recipients(size))
+        start = time.perf_counter()
+        index = RecipientIndex(recipients)
+        build = time.perf_counter() - start
+        sample = random.Random(3).sample(recipients, 200)
+        accounts = [(r.account, r.name) for r in sample]
+        names = [(r.name.upper(), r.name) for r in sample]
+        phonetic = [(r.name.replace("v", "b").replace("ll", "y").replace("z", "s"), r.name) for r in sample]
+        typos = [(r.name[:3] + r.name[4:], r.name) for r in sample]
+        print(
+            f"{size:>8} | {build:>6.2f}s | {_median_lookup_us(index, accounts):>10} | "
+            f"{_median_lookup_us(index, names):>10} | {_median_lookup_us(index, phonetic):>10} | "
+            f"{_median_lookup_us(index, typos):>10}"
+        )
+
+
+def _ledger_row(wa_id: str, created_at: float, i: int):
+    return (wa_id, created_at, str(i * 100), "MX", 2, f"https://ilp.interledger-test.dev/user-{i}",
+            str(i), "success", f"payment-{i}", "https://example.test/confirm", None)
+
+
+def _median_ms(fn, repeat: int = 200) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def bench_ledger() -> None:
+    print("Bitácora de transacciones (SQLite WAL)")
+    with tempfile.TemporaryDirectory() as db_dir:
+        rows = 2000
+        path = os.path.join(db_dir, "fila.db")
+        txs = ledger.TransactionLedger(path)
+        conn = txs._connect()
+        start = time.perf_counter()
+        for i in range(rows):
+            with conn:
+                conn.execute(ledger._INSERT, _ledger_row("521", time.time(), i))
+        per_row = time.perf_counter() - start
+        conn.close()
+        txs.close()
+
+        txs = ledger.TransactionLedger(os.path.join(db_dir, "lotes.db"))
+        start = time.perf_counter()
+        for i in range(rows):
+            txs.record(_ledger_row("521", time.time(), i))
+        enqueue = time.perf_counter() - start
+        txs.flush(timeout=60)
+        batched = time.perf_counter() - start
+        txs.close()
+        print(f"{rows} escrituras: commit por fila {per_row:.2f}s | por lotes {batched:.2f}s "
+              f"(encolar en el request: {enqueue * 1e6 / rows:.1f} µs/fila)")
+
+        print("Mediana por página de 10: usuario al azar (1a página) y usuario frecuente (páginas 20 y 500)")
+        print(f"{'filas':>9} | {'carga':>6} | {'al azar':>9} | {'pág. 20':>9} | {'pág. 500':>9}")
+        path = os.path.join(db_dir, "ledger.db")
+        txs = ledger.TransactionLedger(path)
+        conn = txs._connect()
+        rng = random.Random(5)
+        loaded = 0
+        base = time.time() - 365 * 24 * 3600
+        for target in (100_000, 1_000_000, 2_000_000):
+            start = time.perf_counter()
+            with conn:
+                conn.executemany(ledger._INSERT, (
+                    _ledger_row("heavy" if i % 40 == 0 else f"52155{rng.randrange(20_000):06d}",
+                                base + i, i)
+                    for i in range(loaded, target)
+                ))
+            load = time.perf_counter() - start
+            loaded = target
+            user = f"52155{rng.randrange(20_000):06d}"
+
+            first = _median_ms(lambda: txs.recent(user, 10))
+            cursor = None
+            for _ in range(19):
+                cursor = txs.recent("heavy", 10, cursor).next_cursor
+            page_20 = _median_ms(lambda: txs.recent("heavy", 10, cursor))
+            deep = cursor
+            for _ in range(480):
+                deep = txs.recent("heavy", 10, deep).next_cursor
+            page_500 = _median_ms(lambda: txs.recent("heavy", 10, deep))
+            print(f"{target:>9} | {load:>5.1f}s | {first:>7.2f}ms | {page_20:>7.2f}ms | {page_500:>7.2f}ms")
+        conn.close()
+        txs.close()
+
+
+async def _payments_round(count: int, concurrency: int):
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(PAYMENT_LATENCY)
+        key = request.headers["Idempotency-Key"]
+        return httpx.Response(200, json={"paymentId": key, "confirmationUrl": f"https://example.test/{key}"})
+
+    payment._client = (asyncio.get_running_loop(), httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    payloads = [{"receiverWalletUrl": f"55{i:08d}", "amount": "10000"} for i in range(count)]
+    try:
+        start = time.perf_counter()
+        for i, payload in enumerate(payloads):
+            await payment.send_payment_async(payload, idempotency_key=f"serial-{i}")
+        serial = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = await payment.send_payments_batch(payloads, max_concurrency=concurrency)
+        batched = time.perf_counter() - start
+    finally:
+        await payment.close_payment_client()
+    ordered = all(r["payload"] is p for r, p in zip(results, payloads))
+    return serial, batched, ordered
+
+
+def bench_payments() -> None:
+    print(f"Pagos a varios destinatarios (servicio simulado, {PAYMENT_LATENCY * 1000:.0f} ms por pago)")
+    print(f"{'pagos':>5} | {'uno por uno':>11} | {'lote (8)':>8} | {'orden':>5}")
+    for count in (3, 10, 50):
+        serial, batched, ordered = asyncio.run(_payments_round(count, 8))
+        print(f"{count:>5} | {serial:>10.2f}s | {batched:>7.2f}s | {'ok' if ordered else 'MAL':>5}")
+
+
+async def _outbox_round(path: str, count: int):
+    async def pay(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(PAYMENT_LATENCY)
+        key = request.headers["Idempotency-Key"]
+        return httpx.Response(200, json={"paymentId": key, "confirmationUrl": f"https://example.test/{key}"})
+
+    payment._client = (asyncio.get_running_loop(), httpx.AsyncClient(transport=httpx.MockTransport(pay)))
+    box = outbox.PaymentOutbox(path)
+    payload = {"receiverWalletUrl": "5512345678", "amount": "10000"}
+
+    enqueue_ms = []
+    for i in range(count):
+        start = time.perf_counter()
+        await asyncio.to_thread(box.enqueue, f"5215{i % 50:06d}", [("5512345678", payload)])
+        enqueue_ms.append((time.perf_counter() - start) * 1000)
+    enqueue_ms.sort()
+
+    start = time.perf_counter()
+    async with httpx.AsyncClient(transport=httpx.MockTransport(lambda _: httpx.Response(202))) as notify:
+        while sum(box.depth().values()):
+            await box.dispatch_once(notify)
+    drain = time.perf_counter() - start
+    await payment.close_payment_client()
+    return enqueue_ms[len(enqueue_ms) // 2], enqueue_ms[int(len(enqueue_ms) * 0.99)], drain
+
+
+def bench_outbox() -> None:
+    print(f"Outbox de pagos (servicio simulado, {PAYMENT_LATENCY * 1000:.0f} ms por pago)")
+    count = 200
+    with tempfile.TemporaryDirectory() as db_dir:
+        ledger._ledger = ledger.TransactionLedger(os.path.join(db_dir, "ledger.db"))
+        p50, p99, drain = asyncio.run(_outbox_round(os.path.join(db_dir, "outbox.db"), count))
+        ledger.close_ledger()
+    print(f"espera del webhook: pago en línea ~{PAYMENT_LATENCY * 1000:.0f} ms | outbox p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+    print(f"drenado de {count} pagos en lotes de {outbox.OUTBOX_BATCH_SIZE}: {drain:.2f}s ({count / drain:.0f} pagos/s)")
+
+
+# Keys simuladas: (peticiones por ventana) con límites distintos, como keys de
+# organizaciones con distinto tier
+KEY_LIMITS = {"sk-a": 4, "sk-b": 16, "sk-c": 8}
+KEY_WINDOW = 1.0
+KEY_CALL_LATENCY = 0.05
+
+
+class _RateLimitedOpenAI(httpx.BaseTransport):
+    """Servidor simulado con límite de peticiones por key y headers x-ratelimit-*."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._windows = {}
+        self.rate_limited = 0
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        api_key = request.headers["Authorization"].removeprefix("Bearer ")
+        limit = KEY_LIMITS[api_key]
+        now = time.monotonic()
+        with self._lock:
+            started, used = self._windows.get(api_key, (now, 0))
+            if now - started >= KEY_WINDOW:
+                started, used = now, 0
+            reset = f"{int((KEY_WINDOW - (now - started)) * 1000)}ms"
+            headers = {"x-ratelimit-limit-requests": str(limit), "x-ratelimit-reset-requests": reset}
+            if used >= limit:
+                self.rate_limited += 1
+                headers["x-ratelimit-remaining-requests"] = "0"
+                return httpx.Response(429, headers=headers, json={"error": {"message": "Rate limit"}})
+            used += 1
+            self._windows[api_key] = (started, used)
+            headers["x-ratelimit-remaining-requests"] = str(limit - used)
+        time.sleep(KEY_CALL_LATENCY)
+        return httpx.Response(200, headers=headers, json={
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": 0, "model": "gpt-4o-mini",
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "{}"}}],
+        })
+
+
+def _keys_round(pick_client, calls: int, workers: int, guard: CircuitBreaker) -> float:
+    def call(_):
+        while True:
+            try:
+                with guard.guard():
+                    return pick_client().with_options(max_retries=0).chat.completions.create(
+                        model="gpt-4o-mini", messages=[{"role": "user", "content": "hola"}])
+            except (openai.RateLimitError, CircuitOpenError):
+                time.sleep(0.02)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(call, range(calls)))
+    return time.perf_counter() - start
+
+
+def bench_keys() -> None:
+    calls = 120
+    capacity = sum(KEY_LIMITS.values()) / KEY_WINDOW
+    print(f"Pool de keys de OpenAI ({calls} llamadas, 8 hilos, límites {list(KEY_LIMITS.values())} por segundo)")
+    # Un breaker como el de OpenAI por escenario: los 429 de una key no deben abrirlo
+    print(f"{'reparto':>24} | {'tiempo':>7} | {'429':>5} | {'breaker abierto':>15}")
+    scenarios = [
+        ("una key", lambda pool: itertools.repeat(pool.keys[0].client).__next__),
+        ("round robin", lambda pool: itertools.cycle([key.client for key in pool.keys]).__next__),
+        ("margen de rate limit", lambda pool: lambda: pool.acquire().client),
+    ]
+    for index, (label, picker) in enumerate(scenarios):
+        server = _RateLimitedOpenAI()
+        keys = [(name, None) for name in KEY_LIMITS]
+        pool = KeyPool(keys[1:2] if label == "una key" else keys, transport=server)
+        guard = CircuitBreaker(f"openai_bench{index}", is_failure=_is_openai_failure)
+        elapsed = _keys_round(picker(pool), calls, 8, guard)
+        pool.close()
+        print(f"{label:>24} | {elapsed:>6.2f}s | {server.rate_limited:>5} | {metrics.counter(f'breaker.{guard.name}.opened'):>15.0f}")
+    print(f"mínimo teórico con las tres keys: {calls / capacity:.2f}s")
+
+
+# Trabajo simulado por clase: visión de un ticket frente a una extracción de texto
+IMAGE_JOB_SECONDS = 0.4
+TEXT_JOB_SECONDS = 0.05
+
+
+async def _scheduler_round(run, images: int, texts: int):
+    """Ráfaga de fotos seguida de mensajes de texto que llegan cada 20 ms."""
+    async def job(work_class: str, seconds: float):
+        start = time.perf_counter()
+        await run(work_class, time.sleep, seconds)
+        return work_class, time.perf_counter() - start
+
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(job(scheduler.IMAGE, IMAGE_JOB_SECONDS)) for _ in range(images)]
+    for _ in range(texts):
+        await asyncio.sleep(0.02)
+        tasks.append(asyncio.create_task(job(scheduler.TEXT, TEXT_JOB_SECONDS)))
+    results = await asyncio.gather(*tasks)
+    total = time.perf_counter() - start
+    text_latencies = sorted(latency for work_class, latency in results if work_class == scheduler.TEXT)
+    return (
+        text_latencies[len(text_latencies) // 2],
+        text_latencies[int(len(text_latencies) * 0.95)],
+        total,
+    )
+
+
+def bench_scheduler() -> None:
+    slots, images, texts = 8, 80, 40
+    print(f"Planificador por clases ({images} fotos de {IMAGE_JOB_SECONDS}s y {texts} textos de {TEXT_JOB_SECONDS}s, {slots} lugares)")
+    print(f"{'cola':>14} | {'texto p50':>9} | {'texto p95':>9} | {'total':>6}")
+
+    async def fifo():
+        executor = ThreadPoolExecutor(max_workers=slots)
+        loop = asyncio.get_running_loop()
+        try:
+            return await _scheduler_round(
+                lambda _, fn, *args: loop.run_in_executor(executor, fn, *args), images, texts)
+        finally:
+            executor.shutdown()
+
+    async def by_class():
+        # Como en producción (16 lugares, 12 para imágenes), a escala
+        classes = dict(scheduler.DEFAULT_CLASSES, image=scheduler.WorkClass(weight=1, limit=slots * 3 // 4))
+        return await _scheduler_round(scheduler.WorkScheduler(slots, classes).run, images, texts)
+
+    for label, scenario in (("una sola cola", fifo), ("por clase", by_class)):
+        p50, p95, total = asyncio.run(scenario())
+        print(f"{label:>14} | {p50:>8.2f}s | {p95:>8.2f}s | {total:>5.2f}s")
+
+
+# Costo simulado de abrir una conexión nueva (DNS + TCP + TLS)
+HANDSHAKE_LATENCY = 0.15
+EXTRACTION_CALL_LATENCY = 0.3
+
+
+class _HandshakeTransport:
+    """Transporte simulado: la primera petición paga el handshake de la conexión."""
+
+    def __init__(self, handler):
+        self._handler = handler
+        self._connected = False
+
+    def _connect(self):
+        if not self._connected:
+            self._connected = True
+            return HANDSHAKE_LATENCY
+        return 0.0
+
+    def handle_request(self, request):
+        time.sleep(self._connect())
+        return self._handler(request)
+
+    async def handle_async_request(self, request):
+        await asyncio.sleep(self._connect())
+        return self._handler(request)
+
+
+def _fake_openai(request: httpx.Request) -> httpx.Response:
+    if request.url.path.endswith("/chat/completions"):
+        time.sleep(EXTRACTION_CALL_LATENCY)
+        content = '{"monto": 250, "destinatario": "5512345678", "response": "Listo"}'
+        return httpx.Response(200, json={
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": 0, "model": "gpt-4o-mini",
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+        })
+    return httpx.Response(200, json={"id": "gpt-4o-mini", "object": "model", "created": 0, "owned_by": "bench"})
+
+
+def _first_request(warm: bool) -> tuple:
+    """Corre en un proceso nuevo: opcionalmente calienta y mide la primera petición."""
+    os.environ.setdefault("OPENAI_API_KEYS", "sk-bench")
+    from apps.Interledger_LLM.api import warmup
+    from apps.Interledger_LLM.api.agent import key_pool
+    from apps.Interledger_LLM.api.agent.main import process_message_with_extraction
+    from apps.Interledger_LLM.api.directory import get_directory
+
+    pool_class = key_pool.KeyPool
+    key_pool.KeyPool = lambda keys: pool_class(
+        keys, transport=httpx.MockTransport(_HandshakeTransport(_fake_openai).handle_request))
+
+    async def run() -> tuple:
+        payment_transport = _HandshakeTransport(lambda _: httpx.Response(200, json={"paymentId": "p-1"}))
+        payment._client = (asyncio.get_running_loop(), httpx.AsyncClient(
+            transport=httpx.MockTransport(payment_transport.handle_async_request)))
+        ledger._ledger = ledger.TransactionLedger(os.path.join(db_dir, "ledger.db"))
+        warmup_seconds = 0.0
+        if warm:
+            readiness = warmup.Readiness()
+            await readiness.warm_up()
+            warmup_seconds = readiness.warmup_seconds
+        start = time.perf_counter()
+        result = await asyncio.to_thread(process_message_with_extraction, "mándale 250 a 5512345678")
+        get_directory().resolve(result["destinatario"])
+        await payment.send_payment_async({"amount": "25000"})
+        elapsed = time.perf_counter() - start
+        await payment.close_payment_client()
+        ledger.close_ledger()
+        return elapsed, warmup_seconds
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        return asyncio.run(run())
+
+
+def bench_warmup() -> None:
+    print(f"Primera petición tras arrancar (handshake simulado {HANDSHAKE_LATENCY * 1000:.0f} ms, "
+          f"extracción {EXTRACTION_CALL_LATENCY * 1000:.0f} ms)")
+    print(f"{'':>15} | {'primera petición':>16} | {'calentamiento':>13}")
+    # Cada caso en un proceso nuevo, como un despliegue recién arrancado
+    context = multiprocessing.get_context("spawn")
+    for label, warm in (("sin calentar", False), ("con warm-up", True)):
+        with context.Pool(1) as pool:
+            elapsed, warmup_seconds = pool.apply(_first_request, (warm,))
+        print(f"{label:>15} | {elapsed * 1000:>13.0f} ms | {warmup_seconds * 1000:>10.0f} ms")
+
+
+# Prompt de extracción anterior: system_prompt.md seguido del prompt fijo de
+# process_message_with_extraction, leído del disco en cada mensaje
+OLD_SYSTEM_PROMPT = """Eres un asistente útil que procesa transacciones de dinero desde mensajes de WhatsApp.
+
+Tu tarea es:
+1. Extraer el MONTO de la transacción (puede venir como "$50", "50 pesos", "50", etc.)
+2. Extraer el DESTINATARIO (número de cuenta, número de teléfono, o identificador)
+3. Generar una respuesta amigable confirmando la transacción
+
+IMPORTANTE: 
+- Debes responder SOLO con un JSON válido
+- El formato debe ser: {"monto": número, "destinatario": "string", "response": "tu respuesta"}
+- Si el mensaje pide varios pagos, agrega "pagos": [{"monto": número, "destinatario": "string"}, ...] con uno por destinatario
+- Si no encuentras monto o destinatario, usa null
+- La respuesta (response) debe ser clara y amigable confirmando la transacción
+
+Da la respuesta en ingles"""
+OLD_EXTRACTION_PROMPT = """Eres un asistente que extrae información de transacciones de mensajes de WhatsApp.
+
+Tu tarea es:
+1. Extraer el MONTO (número, puede tener $, pesos, etc.)
+2. Extraer el DESTINATARIO (número de cuenta, teléfono, o identificador)
+3. Generar una respuesta amigable confirmando la transacción
+
+IMPORTANTE: Debes responder SOLO con un JSON válido en este formato exacto:
+{
+  "monto": <número sin comillas>,
+  "destinatario": "<string>",
+  "pagos": [{"monto": <número>, "destinatario": "<string>"}],
+  "response": "<tu respuesta al usuario>"
+}
+
+Si no encuentras monto o destinatario, usa null para esos campos.
+Si el mensaje pide varios pagos (por ejemplo "100 a cada una de estas tres cuentas"),
+incluye en "pagos" uno por destinatario, en el orden del mensaje; "monto" y
+"destinatario" son los del primero. Si es un solo pago, "pagos" puede omitirse.
+"""
+
+
+def _old_prompt(path: str) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().strip() + "\n\n" + OLD_EXTRACTION_PROMPT
+
+
+def bench_prompt() -> None:
+    message = "mándale 250 pesos a Yorch por la cena del viernes"
+    print(f"Prompt de extracción ({usage.tokenizer_name()})")
+    with tempfile.TemporaryDirectory() as prompt_dir:
+        path = os.path.join(prompt_dir, "system_prompt.md")
+        Path(path).write_text(OLD_SYSTEM_PROMPT, encoding="utf-8")
+        rows = [
+            ("antes", lambda: _old_prompt(path)),
+            ("ahora", prompts.extraction_prompt),
+        ]
+        print(f"{'':>5} | {'tokens':>6} | {'armado':>9} | {'latencia simulada':>17} | {'USD por 1M mensajes':>19}")
+        for label, build in rows:
+            messages = [
+                {"role": "system", "content": build()},
+                {"role": "user", "content": message},
+            ]
+            tokens = usage.count_message_tokens(messages)
+            build_us = _median_ms(build, repeat=2000) * 1000
+            latency = EXTRACTION_BASE_LATENCY + tokens * EXTRACTION_TOKEN_FACTOR
+            cost = usage.estimate_cost("gpt-4o-mini", tokens, 0, 0) * 1_000_000
+            print(f"{label:>5} | {tokens:>6} | {build_us:>6.1f} us | {latency * 1000:>14.0f} ms | {cost:>19.2f}")
+
+
+# Notas de voz simuladas durante un pico: transcripción, extracción y TTS
+QOS_TRANSCRIBE_SECONDS = 0.08
+QOS_EXTRACTION_SECONDS = 0.12
+QOS_TTS_SECONDS = 0.25
+
+
+async def _qos_round(controller, messages: int, interval: float, slots: int):
+    """Pico de notas de voz seguido de mensajes sueltos; el modo se decide por mensaje."""
+    work = scheduler.WorkScheduler(slots)
+    if controller is not None:
+        controller.queue_depth = lambda: sum(
+            state["queued"] for state in work.stats()["classes"].values() if not state["urgent"])
+    modes = []
+    shed = 0
+
+    async def message():
+        nonlocal shed
+        start = time.perf_counter()
+        mode = controller.evaluate() if controller is not None else qos.NORMAL
+        modes.append(mode)
+        await work.run(scheduler.AUDIO, time.sleep, QOS_TRANSCRIBE_SECONDS)
+        extraction_start = time.perf_counter()
+        await work.run(scheduler.AUDIO, time.sleep, QOS_EXTRACTION_SECONDS)
+        if controller is not None:
+            controller.observe_latency(time.perf_counter() - extraction_start)
+        reply = time.perf_counter() - start
+        if qos.POLICIES[mode].skip_tts:
+            shed += 1
+        else:
+            await work.run(scheduler.AUDIO, time.sleep, QOS_TTS_SECONDS)
+        return reply, time.perf_counter() - start
+
+    tasks = []
+    for i in range(messages):
+        # Tras el pico llegan mensajes espaciados, para ver la vuelta a normal
+        await asyncio.sleep(interval if i < messages * 3 // 4 else interval * 20)
+        tasks.append(asyncio.create_task(message()))
+    results = await asyncio.gather(*tasks)
+    replies = sorted(reply for reply, _ in results)
+    return replies[len(replies) // 2], replies[int(len(replies) * 0.95)], shed, modes
+
+
+def bench_qos() -> None:
+    slots, messages, interval = 8, 120, 0.01
+    print(f"Modo degradado ({messages} notas de voz, una cada {interval * 1000:.0f} ms al inicio, {slots} lugares)")
+    print(f"{'':>10} | {'texto p50':>9} | {'texto p95':>9} | {'sin TTS':>7} | {'TTS ahorrado':>12} | modos")
+    for label, controller in (
+        ("sin qos", None),
+        ("con qos", qos.QosController(
+            queue_thresholds=[8, 24], latency_thresholds=[0.5, 1.0], min_hold=0.3)),
+    ):
+        p50, p95, shed, modes = asyncio.run(_qos_round(controller, messages, interval, slots))
+        # Secuencia de modos sin repeticiones consecutivas
+        sequence = " > ".join(mode for mode, _ in itertools.groupby(modes))
+        print(f"{label:>10} | {p50:>8.2f}s | {p95:>8.2f}s | {shed:>7} | {shed * QOS_TTS_SECONDS:>11.1f}s | {sequence}")
+
+
+def bench_sessions() -> None:
+    turns = 50
+    print(f"Contexto de la conversación ({turns} turnos, {usage.tokenizer_name()})")
+    print(f"{'turno':>5} | {'historial completo':>18} | {'sesión':>6}")
+    with tempfile.TemporaryDirectory() as db_dir:
+        store = sessions.SessionStore(os.path.join(db_dir, "sessions.db"))
+        session = store.get("5215513076942")
+        session.language = "es"
+        history = []
+        for turn in range(1, turns + 1):
+            user = f"mándale {turn * 10} pesos a la cuenta 55123456{turn:02d} por la cena"
+            reply = f"Perfecto, enviaré {turn * 10} pesos a la cuenta 55123456{turn:02d}. Confirmo monto ${turn * 10:.2f}."
+            history.append({"role": "user", "content": user})
+            history.append({"role": "assistant", "content": reply})
+            session.add_turn(user, reply)
+            if turn in (1, 5, 10, 25, 50):
+                full = usage.count_message_tokens(history)
+                compact = usage.count_message_tokens([{"role": "system", "content": session.context()}])
+                print(f"{turn:>5} | {full:>18} | {compact:>6}")
+        store.save(session)
+        hit = _median_ms(lambda: store.get(session.wa_id), repeat=500)
+        store.save(sessions.Session("otro"))
+        other = sessions.SessionStore(store.path, capacity=1)
+
+        def miss():
+            # Otro worker con LRU de un lugar: cada lectura decodifica la fila de SQLite
+            other.get("otro")
+            other.get(session.wa_id)
+
+        miss_ms = _median_ms(miss, repeat=500) / 2
+        print(f"lectura de la sesión: en la LRU {hit * 1000:.0f} us, desde SQLite {miss_ms * 1000:.0f} us")
+        store.close()
+        other.close()
+
+
+# Respuestas simuladas de OpenAI para medir el parseo, como llegaban antes
+# (json_object y texto libre con bloque de código) y como llegan ahora
+EXTRACTION_CONTENT = (
+    '{"monto": 250, "destinatario": "cinco cinco uno dos tres cuatro cinco seis siete ocho", '
+    '"pagos": [], "response": "Perfecto, enviaré 250 pesos a la cuenta 5512345678."}'
+)
+VISION_TEXT_FENCED = '```json\n{"monto": "$1,250.50", "destinatario": "55 1234 5678"}\n```'
+VISION_TEXT = '{"monto": 1250.5, "destinatario": "55 1234 5678"}'
+
+
+def _old_clean_monto(monto):
+    if monto is None:
+        return None
+    try:
+        if isinstance(monto, str):
+            monto = re.sub(r'[^\d.]', '', monto)
+        return float(monto) if monto else None
+    except (ValueError, TypeError):
+        return None
+
+
+def _old_parse_extraction(content: str):
+    """Parseo anterior: json.loads, limpieza campo por campo y normalización aparte."""
+    result = json.loads(content)
+    monto = _old_clean_monto(result.get("monto"))
+    destinatario = result.get("destinatario")
+    destinatario = str(destinatario).strip() or None if destinatario is not None else None
+    pagos = []
+    for pago in result.get("pagos") or []:
+        pago_monto = _old_clean_monto(pago.get("monto"))
+        pago_destinatario = pago.get("destinatario")
+        if pago_monto is not None and pago_destinatario:
+            pagos.append({"monto": pago_monto, "destinatario": pago_destinatario})
+    if not pagos and monto is not None and destinatario:
+        pagos = [{"monto": monto, "destinatario": destinatario}]
+    if isinstance(destinatario, str):
+        destinatario = schemas.normalize_account_text(destinatario) or None
+    pagos = [(pago["monto"], schemas.normalize_account_text(pago["destinatario"])) for pago in pagos]
+    return {"monto": monto, "destinatario": destinatario, "pagos": pagos, "response": result.get("response", "")}
+
+
+def _old_parse_vision(text: str):
+    """Parseo anterior de la visión: bloque de código, json.loads y limpieza aparte."""
+    candidate = text.strip()
+    if "```json" in candidate:
+        start = candidate.find("```json") + 7
+        candidate = candidate[start:candidate.find("```", start)].strip()
+    data = json.loads(candidate)
+    monto = data.get("monto")
+    if isinstance(monto, str):
+        monto = float(monto.replace("$", "").replace(",", "").strip())
+    destinatario = data.get("destinatario")
+    if isinstance(destinatario, str):
+        destinatario = schemas.normalize_account_text(destinatario) or None
+    return {"monto": monto, "destinatario": destinatario}
+
+
+def _stream_events(dumps):
+    """Líneas NDJSON de una petición típica y el "done" final."""
+    response = {
+        "monto": 250.0, "destinatario": "5512345678", "response": TTS_REPLY,
+        "image_analysis": None, "mode": "normal",
+    }
+    payload = {"senderWalletUrl": "5215513076942", "receiverWalletUrl": "https://wallet.example/yorch",
+               "amount": "25000", "assetCode": "MXN", "assetScale": 2}
+    status = {"status": "queued", "payload": payload, "idempotency_key": "f3a1c9e2"}
+    done = {**response, "wa_id": "5215513076942", "name": "Yorch Juárez", "audio_url": None,
+            "payment_payload": payload, "payment_status": status, "payment_confirmation": None, "payments": None}
+    events = [("response", response), ("payment_payload", payload), ("payment_status", status), ("done", done)]
+    return b"".join(dumps({"event": event, "data": data}) for event, data in events)
+
+
+def bench_json() -> None:
+    import orjson
+
+    print("Parseo y serialización por petición (mediana)")
+    print(f"{'':>28} | {'antes':>8} | {'ahora':>8}")
+    rows = [
+        ("extracción (parseo)",
+         lambda: _old_parse_extraction(EXTRACTION_CONTENT),
+         lambda: schemas.PaymentExtraction.model_validate_json(EXTRACTION_CONTENT).model_dump()),
+        ("visión (parseo)",
+         lambda: _old_parse_vision(VISION_TEXT_FENCED),
+         lambda: schemas.TicketData.model_validate_json(VISION_TEXT).model_dump()),
+        ("respuesta NDJSON (4 eventos)",
+         lambda: _stream_events(lambda line: (json.dumps(line, ensure_ascii=False) + "\n").encode("utf-8")),
+         lambda: _stream_events(lambda line: orjson.dumps(line, option=orjson.OPT_APPEND_NEWLINE))),
+    ]
+    for label, before, after in rows:
+        before_us = _median_ms(before, repeat=5000) * 1000
+        after_us = _median_ms(after, repeat=5000) * 1000
+        print(f"{label:>28} | {before_us:>5.1f} us | {after_us:>5.1f} us")
+
+
+BENCHMARKS = {
+    "audio": bench_audio,
+    "tts": bench_tts,
+    "directory": bench_directory,
+    "ledger": bench_ledger,
+    "payments": bench_payments,
+    "outbox": bench_outbox,
+    "prompt": bench_prompt,
+    "keys": bench_keys,
+    "scheduler": bench_scheduler,
+    "warmup": bench_warmup,
+    "qos": bench_qos,
+    "sessions": bench_sessions,
+    "json": bench_json,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("names", nargs="*", help=f"Benchmarks a ejecutar: {', '.join(BENCHMARKS)} (todos por defecto)")
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"Benchmark desconocido: {', '.join(unknown)}")
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
+        print()
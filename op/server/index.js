@@ -29,6 +29,11 @@ function getWalletAddressFromName(name) {
     return WALLET_MAPPING.default
   }
   
+  // Already resolved to a wallet address (llm_back's recipient directory)
+  if (/^https?:\/\//i.test(name.trim())) {
+    return name.trim()
+  }
+
   const normalizedName = name.toLowerCase().trim()
   
   // Check for exact matches first
@@ -49,8 +54,40 @@ function getWalletAddressFromName(name) {
   return WALLET_MAPPING.default
 }
 
+// Idempotency-Key -> { expiresAt, result } so retried payments are not initiated twice
+const IDEMPOTENCY_TTL_MS = 24 * 60 * 60 * 1000
+const idempotentPayments = new Map()
+
+function pruneIdempotentPayments() {
+  const now = Date.now()
+  for (const [key, entry] of idempotentPayments) {
+    if (entry.expiresAt <= now) {
+      idempotentPayments.delete(key)
+    }
+  }
+}
+
 // Step 1: Initiate payment and get confirmation URL
 app.post('/send-payment', async (req, res) => {
+  const idempotencyKey = req.get('Idempotency-Key')
+  if (idempotencyKey) {
+    pruneIdempotentPayments()
+    const previous = idempotentPayments.get(idempotencyKey)
+    if (previous) {
+      // Same key in flight or already initiated: reuse its result
+      const result = await previous.result
+      if (result) {
+        return res.json(result)
+      }
+    }
+  }
+
+  let resolveIdempotent = () => {}
+  if (idempotencyKey) {
+    const result = new Promise((resolve) => { resolveIdempotent = resolve })
+    idempotentPayments.set(idempotencyKey, { expiresAt: Date.now() + IDEMPOTENCY_TTL_MS, result })
+  }
+
   try {
     const { receiverWalletUrl, amount, assetCode, assetScale } = req.body
 
@@ -84,10 +121,12 @@ app.post('/send-payment', async (req, res) => {
 
     // If result has paymentId and confirmationUrl, it's successful
     if (result.paymentId && result.confirmationUrl) {
-      res.json({
+      const body = {
         paymentId: result.paymentId,
         confirmationUrl: result.confirmationUrl
-      })
+      }
+      resolveIdempotent(body)
+      res.json(body)
     } else {
       res.status(500).json({
         success: false,
@@ -100,6 +139,9 @@ app.post('/send-payment', async (req, res) => {
       success: false,
       error: error.message || 'Internal server error'
     })
+  } finally {
+    // No-op after a success; a failed attempt resolves to null so the key can be retried
+    resolveIdempotent(null)
   }
 })
 
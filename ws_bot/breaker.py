@@ -0,0 +1,110 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a backend whose breaker is open."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is unavailable (circuit breaker open)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker over a rolling window of call results."""
+
+    def __init__(self, name: str, failure_rate: float = 0.5, min_calls: int = 5,
+                 window: float = 30.0, open_seconds: float = 15.0):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.opened_count = 0
+        self.rejected_count = 0
+        self._results = deque()
+        self._opened_at = 0.0
+        self._probing = False
+
+    def allow(self):
+        if self.state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self.state = HALF_OPEN
+            self._probing = False
+        if self.state == OPEN or (self.state == HALF_OPEN and self._probing):
+            self.rejected_count += 1
+            raise CircuitOpenError(self.name, self.retry_after())
+        if self.state == HALF_OPEN:
+            self._probing = True
+
+    def record_success(self):
+        if self.state == HALF_OPEN:
+            self.state = CLOSED
+            self._results.clear()
+        self._record(True)
+
+    def record_failure(self):
+        if self.state == HALF_OPEN:
+            self._open()
+            return
+        self._record(False)
+        failures = sum(1 for _, ok in self._results if not ok)
+        if len(self._results) >= self.min_calls and failures / len(self._results) >= self.failure_rate:
+            self._open()
+
+    def retry_after(self) -> float:
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    @contextmanager
+    def guard(self, is_failure=lambda exc: True):
+        """Wrap one backend call; exceptions matching ``is_failure`` count against the breaker."""
+        self.allow()
+        try:
+            yield
+        except Exception as exc:
+            if is_failure(exc):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        except BaseException:
+            # Cancelled mid-call: free the half-open probe slot without judging the backend
+            self._probing = False
+            raise
+        else:
+            self.record_success()
+
+    def snapshot(self) -> dict:
+        self._prune(time.monotonic())
+        failures = sum(1 for _, ok in self._results if not ok)
+        return {
+            "state": self.state,
+            "calls_in_window": len(self._results),
+            "error_rate": failures / len(self._results) if self._results else 0.0,
+            "retry_after": self.retry_after(),
+            "opened": self.opened_count,
+            "rejected": self.rejected_count,
+        }
+
+    def _open(self):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._probing = False
+        self.opened_count += 1
+
+    def _record(self, ok: bool):
+        now = time.monotonic()
+        self._results.append((now, ok))
+        self._prune(now)
+
+    def _prune(self, now: float):
+        while self._results and now - self._results[0][0] > self.window:
+            self._results.popleft()
@@ -1,6 +1,14 @@
 import asyncio
+import hmac
+import json
 import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import aclosing
+from datetime import datetime
 from pathlib import Path
+from typing import Any
 
 import httpx
 from pywa_async import WhatsApp, filters
@@ -14,10 +22,14 @@ from pywa.types import (
     CallbackSelection,
     URLButton
 )
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException, Query, Request
 from dotenv import load_dotenv
+from pydantic import BaseModel, ValidationError
+from fastapi.responses import PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 
+from breaker import CircuitBreaker, CircuitOpenError
+from profiler import ProfilerBusy, SlowLog, sample_loop
 from config_env import fetch_and_write_env_and_key
 
 
@@ -26,11 +38,34 @@ load_dotenv()
 CALLBACK_URL = "https://a30d1016279e.ngrok-free.app"
 # LLM_BACKEND = "http://localhost:8000/webhook/whatsapp" # LLM backend URL in localhost
 LLM_BACKEND = "http://llm_backend:8000/webhook/whatsapp" # LLM backend URL in docker container environment
+LLM_STREAM_BACKEND = f"{LLM_BACKEND}/stream" # NDJSON streaming variant of the LLM webhook
+LLM_MEDIA_BACKEND = "http://llm_backend:8000/media" # Direct media upload to the LLM backend
+LLM_TRANSACTIONS_BACKEND = "http://llm_backend:8000/transactions" # Transaction ledger kept by the LLM backend
+LLM_SESSIONS_BACKEND = "http://llm_backend:8000/sessions" # Per-user conversation state (language, pending payment)
+TRANSACTIONS_PAGE_SIZE = 5
 OP_BACKEND = "http://open_payments_api:3000" # Open Payments API URL in docker container environment
+LLM_TIMEOUT = 60.0
+# Total time budget llm_back may spend on a message; kept below LLM_TIMEOUT so it gives up first
+LLM_REQUEST_BUDGET = LLM_TIMEOUT - 5.0
+DOWNLOADS_DIR = Path("downloads")
+DOWNLOADS_RETENTION_SECONDS = 6 * 3600
+DOWNLOADS_CLEANUP_INTERVAL = 300
+# /admin endpoints (event loop profiler and slow handler log) only exist when ADMIN_TOKEN is set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+SLOW_HANDLER_SECONDS = float(os.getenv("SLOW_HANDLER_SECONDS", "15"))
+# Shared with llm_back's payment outbox; /payments/notify only exists when it is set
+PAYMENT_NOTIFY_TOKEN = os.getenv("PAYMENT_NOTIFY_TOKEN", "")
 
 fastapi_app = FastAPI()
 fastapi_app.mount("/downloads", StaticFiles(directory="./downloads"), name="downloads")
 back_client = httpx.AsyncClient()
+llm_breaker = CircuitBreaker("llm_backend")
+op_breaker = CircuitBreaker("open_payments_api")
+# Outbox notifications already handled (by idempotency key) and confirmations in progress
+notified_payments: OrderedDict[str, None] = OrderedDict()
+NOTIFIED_PAYMENTS_LIMIT = 10000
+confirmation_tasks: set[asyncio.Task] = set()
+slow_handlers = SlowLog(SLOW_HANDLER_SECONDS)
 wa = WhatsApp(
     phone_id=os.getenv('META_PHONE_ID'),
     token=os.getenv('META_ACCESS_TOKEN'),
@@ -55,10 +90,50 @@ OTHER_LANGUAGES = {
 }
 
 
-async def confirm_payment_with_op_api(msg: Message, llm_response: str, payment_commit: dict, number_notify: str):
+def is_backend_failure(exc: Exception) -> bool:
+    """Only transport errors and 5xx responses mean the backend itself is unhealthy."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, httpx.HTTPError)
+
+
+@fastapi_app.get("/metrics")
+async def metrics():
+    return {"breakers": {b.name: b.snapshot() for b in (llm_breaker, op_breaker)}}
+
+
+def require_admin(token: str | None):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not token or not hmac.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+@fastapi_app.get("/admin/profile", response_class=PlainTextResponse)
+async def admin_profile(seconds: float = Query(10, gt=0, le=30), interval: float = Query(0.005, gt=0),
+                        x_admin_token: str | None = Header(None)):
+    """Sample the event loop for `seconds`; collapsed stacks plus CPU and wall time in headers."""
+    require_admin(x_admin_token)
+    try:
+        collapsed, summary = await asyncio.to_thread(sample_loop, threading.get_ident(), seconds, interval)
+    except ProfilerBusy as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    headers = {f"X-Profile-{name.replace('_', '-').title()}": str(value) for name, value in summary.items()}
+    return PlainTextResponse(collapsed + "\n", headers=headers)
+
+
+@fastapi_app.get("/admin/slow-handlers")
+async def admin_slow_handlers(limit: int = Query(20, ge=1), x_admin_token: str | None = Header(None)):
+    """LLM relays slower than SLOW_HANDLER_SECONDS, most recent first."""
+    require_admin(x_admin_token)
+    return {"threshold": slow_handlers.threshold, "items": slow_handlers.recent(limit)}
+
+
+async def confirm_payment_with_op_api(to: str, sender_name: str, llm_response: str, payment_commit: dict, number_notify: str | None):
     payment_url = payment_commit.get("confirmationUrl", "")
     payment_id = payment_commit.get("paymentId", "")
-    await msg.reply(
+    await wa.send_message(
+        to=to,
         text=llm_response,
         buttons=URLButton(
             title="Confirm Payment",
@@ -72,23 +147,345 @@ async def confirm_payment_with_op_api(msg: Message, llm_response: str, payment_c
     confirm_data = {}
     while not confirm_success:
         try:
-            confirm_response = await back_client.post(
-                url=f"{OP_BACKEND}/confirm-payment",
-                json=confirmation_payload,
-                timeout=60.0
-            )
+            with op_breaker.guard(is_backend_failure):
+                confirm_response = await back_client.post(
+                    url=f"{OP_BACKEND}/confirm-payment",
+                    json=confirmation_payload,
+                    timeout=60.0
+                )
             confirm_data = confirm_response.json()
             confirm_success = confirm_data.get("success") is True
             if not confirm_success:
                 await asyncio.sleep(1)
+        except CircuitOpenError as exc:
+            # Open Payments is down: wait for the breaker instead of hammering it
+            await asyncio.sleep(max(exc.retry_after, 1))
         except httpx.HTTPError as exc:
             print(f"Error confirming payment {payment_id}: {exc}")
             await asyncio.sleep(2)
-    await msg.reply_text("Payment confirmed ✅. Thank you for using Paguito! 🫰")
-    await wa.send_text(
-        to=number_notify,
-        text=f"Payment confirmed 💰\n*sender*: {msg.from_user.name}"
-    )
+    await wa.send_message(to=to, text="Payment confirmed ✅. Thank you for using Paguito! 🫰")
+    if number_notify:
+        await wa.send_text(
+            to=number_notify,
+            text=f"Payment confirmed 💰\n*sender*: {sender_name}"
+        )
+
+
+class PaymentNotification(BaseModel):
+    wa_id: str
+    idempotency_key: str | None = None
+    destinatario: str | None = None
+    status: str | None = None
+    service_response: Any = None
+    error: Any = None
+    reply_context: dict | None = None
+
+
+def require_notify_token(token: str | None):
+    if not PAYMENT_NOTIFY_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not token:
+        raise HTTPException(status_code=401, detail="Missing notify token")
+    if not hmac.compare_digest(token, PAYMENT_NOTIFY_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid notify token")
+
+
+@fastapi_app.post("/payments/notify", status_code=202)
+async def payment_notify(request: Request, x_notify_token: str | None = Header(None)):
+    """Payment results pushed by llm_back's outbox dispatcher once the payment is initiated."""
+    # This app is public (WhatsApp webhook): check the caller before reading anything it sent
+    require_notify_token(x_notify_token)
+    try:
+        notification = PaymentNotification.model_validate_json(await request.body())
+    except ValidationError as exc:
+        # A 4xx tells the dispatcher not to retry a body that will never be valid
+        raise HTTPException(status_code=400, detail=exc.errors(include_url=False, include_input=False))
+    key = notification.idempotency_key
+    if key in notified_payments:
+        # The dispatcher retries until it gets a 2xx, so the same result can arrive twice
+        return {"duplicate": True}
+    to = notification.wa_id
+    context = notification.reply_context or {}
+    recipient = notification.destinatario or "the recipient"
+    payment_commit = notification.service_response
+    # Remember the key before any await so a retry arriving meanwhile is a duplicate
+    remember_notification(key)
+    if notification.status == "success" and isinstance(payment_commit, dict) and payment_commit.get("paymentId"):
+        task = asyncio.create_task(confirm_payment_with_op_api(
+            to,
+            context.get("name", ""),
+            f"Your payment to {recipient} is ready. Tap the button below to confirm it 👇",
+            payment_commit,
+            context.get("number_notify")
+        ))
+        confirmation_tasks.add(task)
+        task.add_done_callback(confirmation_tasks.discard)
+    else:
+        try:
+            await wa.send_message(to=to, text=f"I couldn't start your payment to {recipient} ⚠️. Please try again later.")
+        except Exception:
+            # Let the dispatcher retry the notification
+            forget_notification(key)
+            raise
+    return {"accepted": True}
+
+
+def remember_notification(key: str | None):
+    if not key:
+        return
+    notified_payments[key] = None
+    while len(notified_payments) > NOTIFIED_PAYMENTS_LIMIT:
+        notified_payments.popitem(last=False)
+
+
+def forget_notification(key: str | None):
+    if key:
+        notified_payments.pop(key, None)
+
+
+async def stream_llm_events(payload: dict):
+    """
+    Yield ``(event, data)`` pairs from the LLM backend NDJSON stream as they arrive.
+
+    The breaker only judges the request and the stream read: exceptions raised by
+    the consumer (e.g. a failed WhatsApp send) never reach this generator.
+    """
+    with llm_breaker.guard(is_backend_failure):
+        async with back_client.stream(
+            "POST",
+            url=LLM_STREAM_BACKEND,
+            json=payload,
+            headers={"X-Request-Budget": str(LLM_REQUEST_BUDGET)},
+            timeout=LLM_TIMEOUT
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError as exc:
+                    # One garbled line must not abort the relay: skip it and keep reading
+                    print(f"Skipping malformed LLM stream line ({exc}): {line[:200]!r}")
+                    continue
+                if not isinstance(event, dict):
+                    print(f"Skipping unexpected LLM stream line: {line[:200]!r}")
+                    continue
+                yield event.get("event"), event.get("data")
+
+
+async def download_to_file(url: str, destination: Path) -> Path:
+    """Stream a backend file to disk chunk by chunk instead of buffering it in memory."""
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    async with back_client.stream("GET", url, timeout=LLM_TIMEOUT) as response:
+        response.raise_for_status()
+        with destination.open("wb") as file:
+            async for chunk in response.aiter_bytes(64 * 1024):
+                file.write(chunk)
+    return destination
+
+
+async def reply_with_audio(msg: Message, audio_url: str):
+    """Download the synthesized reply from llm_back and send it as a WhatsApp audio."""
+    if not audio_url.startswith(("http://", "https://")):
+        return
+    file_name = audio_url.rstrip("/").split("/")[-1].split(".")[0]
+    try:
+        audio_path = await download_to_file(audio_url, Path("downloads/audios") / f"{file_name}.mp3")
+    except httpx.HTTPError as exc:
+        print(f"Could not download audio reply {audio_url}: {exc}")
+        return
+    try:
+        await msg.reply_audio(audio=audio_path, mime_type="audio/mpeg")
+    finally:
+        audio_path.unlink(missing_ok=True)
+
+
+_last_downloads_cleanup = 0.0
+
+
+def cleanup_downloads():
+    """Delete downloaded media older than the retention window (at most once per interval)."""
+    global _last_downloads_cleanup
+    now = time.time()
+    if now - _last_downloads_cleanup < DOWNLOADS_CLEANUP_INTERVAL:
+        return
+    _last_downloads_cleanup = now
+    for path in DOWNLOADS_DIR.rglob("*"):
+        if path.is_file() and path.name != ".gitkeep" and now - path.stat().st_mtime > DOWNLOADS_RETENTION_SECONDS:
+            path.unlink(missing_ok=True)
+
+
+async def iter_file(path: Path, chunk_size: int = 64 * 1024):
+    with path.open("rb") as file:
+        while chunk := file.read(chunk_size):
+            yield chunk
+
+
+async def hand_off_media(media_path: Path, mime_type: str) -> str:
+    """Stream a downloaded file to llm_back's media store and return its ``media://`` source."""
+    with llm_breaker.guard(is_backend_failure):
+        response = await back_client.put(
+            url=LLM_MEDIA_BACKEND,
+            content=iter_file(media_path),
+            headers={"Content-Type": mime_type},
+            timeout=LLM_TIMEOUT
+        )
+        response.raise_for_status()
+    media_path.unlink(missing_ok=True)
+    return response.json()["source"]
+
+
+async def relay_media(msg: Message, media_type: str, media_path: Path, mime_type: str, number_notify: str | None):
+    """Hand the media file to llm_back and relay the streamed reply."""
+    cleanup_downloads()
+    try:
+        source = await hand_off_media(media_path, mime_type)
+    except CircuitOpenError:
+        await msg.reply_text("Paguito is having trouble right now. Please try again in a minute 🙏")
+        return
+    except httpx.HTTPError as exc:
+        await msg.reply_text("I ran into a technical issue. Please try again shortly.")
+        print(f"Media upload to LLM backend failed: {exc}")
+        return
+    payload = {
+        "wa_id": msg.from_user.wa_id,
+        "name": msg.from_user.name,
+        "message": msg.caption if msg.caption else "",
+        "media": [
+            {
+                "type": media_type,
+                "source": source
+            }
+        ]
+    }
+    await relay_llm_stream(msg, payload, number_notify)
+
+
+async def relay_llm_stream(msg: Message, payload: dict, number_notify: str | None):
+    """Relay a message to llm_back, logging the run in /admin/slow-handlers if it is slow."""
+    started = time.monotonic()
+    phases: dict[str, float] = {}
+    try:
+        await _relay_llm_stream(msg, payload, number_notify, phases, started)
+    finally:
+        slow_handlers.observe(started, phases, wa_id=msg.from_user.wa_id,
+                              media=[item.get("type") for item in payload.get("media") or []])
+
+
+async def _relay_llm_stream(msg: Message, payload: dict, number_notify: str | None,
+                            phases: dict[str, float], started: float):
+    """Send the LLM reply as soon as it is streamed, then handle the payment confirmation."""
+    # Echoed back by llm_back when its payment outbox notifies /payments/notify
+    payload["reply_context"] = {"name": msg.from_user.name, "number_notify": number_notify}
+    payment_commits = []
+    replied = False
+    try:
+        async with aclosing(stream_llm_events(payload)) as events:
+            async for event, data in events:
+                if event == "response":
+                    phases["llm_first_response"] = time.monotonic() - started
+                    llm_response = data.get("response", "")
+                    if llm_response:
+                        await msg.reply_text(llm_response)
+                        replied = True
+                elif event == "audio_url":
+                    audio_started = time.monotonic()
+                    await reply_with_audio(msg, data)
+                    phases["audio_reply"] = time.monotonic() - audio_started
+                elif event == "payment_confirmation":
+                    payment_commits.append(data)
+                elif event == "payments":
+                    # One message paying several recipients
+                    payment_commits.extend(
+                        result["service_response"] for result in data
+                        if isinstance(result.get("service_response"), dict)
+                        and result["service_response"].get("paymentId")
+                    )
+                elif event == "done":
+                    print(f"LLM response data: {data}")
+                elif event == "error":
+                    print(f"LLM backend stream error: {data}")
+                    if not replied:
+                        await msg.reply_text("I ran into a technical issue. Please try again shortly.")
+                    return
+    except CircuitOpenError:
+        await msg.reply_text("Paguito is having trouble right now. Please try again in a minute 🙏")
+        return
+    except httpx.ReadTimeout:
+        if not replied:
+            await msg.reply_text("I'm still processing your request. Please try again in a few seconds.")
+        print("LLM backend request timed out for message:", msg.text)
+        return
+    except httpx.HTTPError as exc:
+        if not replied:
+            await msg.reply_text("I ran into a technical issue. Please try again shortly.")
+        print(f"LLM backend request failed: {exc}")
+        return
+    finally:
+        phases["llm_stream"] = time.monotonic() - started
+    to, sender_name = msg.from_user.wa_id, msg.from_user.name
+    confirmation_started = time.monotonic()
+    try:
+        if len(payment_commits) == 1:
+            await confirm_payment_with_op_api(to, sender_name, "Tap the button below to confirm your payment 👇", payment_commits[0], number_notify)
+        elif payment_commits:
+            await asyncio.gather(*(
+                confirm_payment_with_op_api(to, sender_name, f"Payment {i} of {len(payment_commits)}: tap the button below to confirm 👇", commit, number_notify)
+                for i, commit in enumerate(payment_commits, start=1)
+            ))
+    finally:
+        phases["confirmation"] = time.monotonic() - confirmation_started
+
+
+async def fetch_transactions(wa_id: str, cursor: str | None = None) -> dict:
+    params = {"limit": TRANSACTIONS_PAGE_SIZE}
+    if cursor:
+        params["cursor"] = cursor
+    with llm_breaker.guard(is_backend_failure):
+        response = await back_client.get(
+            url=f"{LLM_TRANSACTIONS_BACKEND}/{wa_id}",
+            params=params,
+            timeout=10.0
+        )
+        response.raise_for_status()
+    return response.json()
+
+
+def format_transaction(tx: dict) -> str:
+    when = datetime.fromtimestamp(tx["created_at"]).strftime("%d/%m %H:%M")
+    try:
+        amount = f"${int(tx['amount']) / 10 ** (tx.get('asset_scale') or 0):,.2f}"
+    except (TypeError, ValueError):
+        amount = tx.get("amount") or "?"
+    status = "✅" if tx.get("status") == "success" else "⚠️"
+    recipient = tx.get("destinatario") or tx.get("receiver") or "unknown"
+    return f"{status} {when} · {amount} {tx.get('asset_code') or ''} → {recipient}"
+
+
+async def reply_transactions(clb: CallbackButton, cursor: str | None = None):
+    try:
+        page = await fetch_transactions(clb.from_user.wa_id, cursor)
+    except CircuitOpenError:
+        await clb.reply_text("Paguito is having trouble right now. Please try again in a minute 🙏")
+        return
+    except httpx.HTTPError as exc:
+        print(f"Transactions request failed: {exc}")
+        await clb.reply_text("I couldn't load your transactions. Please try again shortly.")
+        return
+    items = page.get("items", [])
+    if not items:
+        await clb.reply_text("You don't have any transactions yet." if not cursor else "No more transactions.")
+        return
+    text = "*Your recent transactions* 🔍\n" + "\n".join(format_transaction(tx) for tx in items)
+    next_cursor = page.get("next_cursor")
+    if next_cursor:
+        await clb.reply_text(
+            text=text,
+            buttons=[Button(title="Show more", callback_data=f"transactions:{next_cursor}")]
+        )
+    else:
+        await clb.reply_text(text)
 
 
 @wa.on_message(filters.contains("Hello", "Hi", "Hola", ignore_case=True))
@@ -124,8 +521,23 @@ async def hello(_: WhatsApp, msg: Message):
     )
 
 
+async def save_language(wa_id: str, language: str):
+    """Store the chosen language in llm_back so its replies use it."""
+    try:
+        with llm_breaker.guard(is_backend_failure):
+            response = await back_client.put(
+                f"{LLM_SESSIONS_BACKEND}/{wa_id}/language",
+                json={"language": language},
+                timeout=10.0
+            )
+            response.raise_for_status()
+    except (CircuitOpenError, httpx.HTTPError) as exc:
+        print(f"Could not save language for {wa_id}: {exc}")
+
+
 @wa.on_callback_selection(filters.startswith('language:'))
 async def select_action(_: WhatsApp, sel: CallbackSelection):
+    await save_language(sel.from_user.wa_id, sel.data.split(':', 1)[-1])
     await sel.reply_text(
         text=f"Great, {sel.from_user.name}! Now, please select the action you would like to perform:",
         buttons=[
@@ -161,7 +573,12 @@ You can do this via voice note, regular text message or by sending an image of t
         )
         await clb.reply_text(text="Feel free to choose how you make the request! 🤠")
     elif action == "check":
-        await clb.reply_text(text="Check transactions action")
+        await reply_transactions(clb)
+
+
+@wa.on_callback_button(filters.startswith('transactions:'))
+async def more_transactions(_: WhatsApp, clb: CallbackButton):
+    await reply_transactions(clb, clb.data.split(':', 1)[-1])
 
 
 @wa.on_message(filters.audio)
@@ -170,20 +587,7 @@ async def reply_audio(_: WhatsApp, msg: Message):
     audio_id = msg.audio.id
     media_path: Path = await msg.download_media(filepath="downloads/audios/", filename=f"{audio_id}.mp3")
     print(f"Audio saved as {media_path}")
-    payload = {
-        "wa_id": msg.from_user.wa_id,
-        "name": msg.from_user.name,
-        "message": msg.caption if msg.caption else "",
-        "media": [
-            {
-                "type": "audio",
-                "source": f"{media_path.resolve()}"
-            }
-        ]
-    }
-    response = await back_client.post(url=LLM_BACKEND, json=payload, timeout=60.0)
-    data = response.json()
-    await msg.reply(data['response'])
+    await relay_media(msg, "audio", media_path, msg.audio.mime_type or "audio/ogg", None)
 
 
 @wa.on_message(filters.image)
@@ -192,39 +596,7 @@ async def reply_image(_: WhatsApp, msg: Message):
     image_id = msg.image.id
     media_path = await msg.download_media(filepath="downloads/images/", filename=f"{image_id}.jpg")
     print(f"Image saved as {media_path}")
-    payload = {
-        "wa_id": msg.from_user.wa_id,
-        "name": msg.from_user.name,
-        "message": msg.caption if msg.caption else "",
-        "media": [
-            {
-                "type": "image",
-                "source": f"{CALLBACK_URL}/{media_path}"
-            }
-        ]
-    }
-    try:
-        response = await back_client.post(
-            url=LLM_BACKEND,
-            json=payload,
-            timeout=60.0
-        )
-        data = response.json()
-    except httpx.ReadTimeout:
-        await msg.reply_text("I'm still processing your request. Please try again in a few seconds.")
-        print("LLM backend request timed out for message:", msg.text)
-        return
-    except httpx.HTTPError as exc:
-        await msg.reply_text("I ran into a technical issue. Please try again shortly.")
-        print(f"LLM backend request failed: {exc}")
-        return
-    print(f"LLM response data: {data}")
-    llm_response = data.get("response", "")
-    payment_commit = data.get("payment_confirmation", None)
-    if payment_commit:
-        await confirm_payment_with_op_api(msg, llm_response, payment_commit, "5639228716")
-    if llm_response and not payment_commit:
-        await msg.reply_text(llm_response)
+    await relay_media(msg, "image", media_path, msg.image.mime_type or "image/jpeg", "5639228716")
 
 
 @wa.on_message(filters.text)
@@ -236,28 +608,7 @@ async def echo(_: WhatsApp, msg: Message):
         "message": msg.text,
         "media": []
     }
-    try:
-        response = await back_client.post(
-            url=LLM_BACKEND,
-            json=payload,
-            timeout=60.0
-        )
-        data = response.json()
-    except httpx.ReadTimeout:
-        await msg.reply_text("I'm still processing your request. Please try again in a few seconds.")
-        print("LLM backend request timed out for message:", msg.text)
-        return
-    except httpx.HTTPError as exc:
-        await msg.reply_text("I ran into a technical issue. Please try again shortly.")
-        print(f"LLM backend request failed: {exc}")
-        return
-    print(f"LLM response data: {data}")
-    llm_response = data.get("response", "")
-    payment_commit = data.get("payment_confirmation", None)
-    if payment_commit:
-        await confirm_payment_with_op_api(msg, llm_response, payment_commit, "5513076942")
-    if llm_response and not payment_commit:
-        await msg.reply_text(llm_response)
+    await relay_llm_stream(msg, payload, "5513076942")
 
 
 @wa.on_message(filters.contacts)
@@ -0,0 +1,92 @@
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+# Where the event loop sits while it has nothing to run
+LOOP_IDLE_LEAF = ("selectors.py", "select")
+
+_profile_lock = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    """Raised when another profile is already running."""
+
+
+def _cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def sample_loop(loop_thread: int, seconds: float, interval: float = 0.005,
+                max_seconds: float = 30.0) -> tuple[str, dict]:
+    """Sample the event loop thread, where every handler runs, for up to `max_seconds`.
+
+    Returns collapsed stacks (flamegraph format) in which waiting shows up as a
+    single `(idle)` frame, so the graph covers wall time, plus a summary with
+    the process CPU time and the share of samples the loop was busy.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already running")
+    try:
+        seconds = max(0.0, min(seconds, max_seconds))
+        interval = max(0.001, interval)
+        counts = Counter()
+        samples = busy = 0
+        cpu_start, wall_start = _cpu_seconds(), time.monotonic()
+        while time.monotonic() - wall_start < seconds:
+            frame = sys._current_frames().get(loop_thread)
+            if frame is not None:
+                samples += 1
+                if (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) == LOOP_IDLE_LEAF:
+                    counts["(idle)"] += 1
+                else:
+                    busy += 1
+                    labels = []
+                    while frame is not None:
+                        labels.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+                        frame = frame.f_back
+                    counts[";".join(reversed(labels))] += 1
+            time.sleep(interval)
+        summary = {
+            "samples": samples,
+            "wall_seconds": round(time.monotonic() - wall_start, 3),
+            "cpu_seconds": round(_cpu_seconds() - cpu_start, 3),
+            "loop_busy": round(busy / samples, 3) if samples else 0.0,
+        }
+        return "\n".join(f"{stack} {count}" for stack, count in counts.most_common()), summary
+    finally:
+        _profile_lock.release()
+
+
+def rss_bytes() -> int | None:
+    try:
+        with open("/proc/self/statm", "r", encoding="ascii") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class SlowLog:
+    """Ring buffer of handler runs slower than a threshold, with per-phase timings."""
+
+    def __init__(self, threshold: float, size: int = 50):
+        self.threshold = threshold
+        self.records = deque(maxlen=max(1, size))
+
+    def observe(self, started_at: float, phases: dict[str, float], **details):
+        elapsed = time.monotonic() - started_at
+        if elapsed < self.threshold:
+            return
+        self.records.append({
+            "at": time.time(),
+            "elapsed": round(elapsed, 3),
+            **details,
+            "phases": {name: round(value, 3) for name, value in phases.items()},
+            "rss_bytes": rss_bytes(),
+        })
+
+    def recent(self, limit: int) -> list[dict]:
+        return list(self.records)[::-1][:max(0, limit)]